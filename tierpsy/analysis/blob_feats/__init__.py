@@ -4,7 +4,8 @@ def args_(fn, param):
     # arguments for getBlobsTable
     argkws_d = {'skeletons_file':fn['skeletons'], 
                 'masked_image_file':fn['masked_image'],
-                'strel_size' : param.p_dict['strel_size']
+                'strel_size' : param.p_dict['strel_size'],
+                'n_cores_used' : param.p_dict['n_cores_used']
                 }
 
     #arguments used by AnalysisPoints.py
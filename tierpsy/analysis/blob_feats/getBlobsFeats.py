@@ -8,7 +8,7 @@ import tables
 
 from tierpsy.analysis.ske_create.getSkeletonsTables import getWormMask
 from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI
-from tierpsy.helper.misc import TABLE_FILTERS
+from tierpsy.helper.misc import TABLE_FILTERS, imap_ordered
 
 
 def _getBlobFeatures(blob_cnt, blob_mask, roi_image, roi_corner):
@@ -63,7 +63,12 @@ def _getBlobFeatures(blob_cnt, blob_mask, roi_image, roi_corner):
     return mask_feats
 
 
-def getBlobsFeats(skeletons_file, masked_image_file, strel_size):
+def getBlobsFeats(skeletons_file, masked_image_file, strel_size, n_cores_used = 1):
+    '''
+    Calculate the features of the blob in each ROI of trajectories_data and save them in /blob_features.
+    If n_cores_used > 1 the blocks of ROIs are processed by a pool of threads (opencv releases the GIL)
+    while the next ROIs are read from the masked video in the main thread.
+    '''
     # extract the base name from the masked_image_file. This is used in the
     # progress status.
     base_name = masked_image_file.rpartition('.')[0].rpartition(os.sep)[-1]
@@ -102,38 +107,37 @@ def getBlobsFeats(skeletons_file, masked_image_file, strel_size):
             yield block
 
 
-    def _roi2feats(block):
-        #from a
-        output= []
-        for irow, (roi_image, roi_corner) in block:
-            row_data = trajectories_data.loc[irow]
-            blob_mask, blob_cnt, _ = getWormMask(roi_image,
-                                                 row_data['threshold'],
-                                                 strel_size,
-                                                 min_blob_area=row_data['area'] / 2,
-                                                 is_light_background = is_light_background)
-            feats = _getBlobFeatures(blob_cnt, blob_mask, roi_image, roi_corner)
-
-            output.append((irow, feats))
-        return output
-
-
     # initialize output data as a numpy recarray (pytables friendly format)
     feats_names = ['coord_x', 'coord_y', 'area', 'perimeter',
     'box_length', 'box_width', 'quirkiness', 'compactness',
     'box_orientation', 'solidity', 'intensity_mean', 'intensity_std',
     'hu0', 'hu1', 'hu2', 'hu3', 'hu4', 'hu5', 'hu6']
+    
+    #the recarray is a view of a 2D array, so a block of rows can be assigned at once
+    feats_arr = np.full((len(trajectories_data), len(feats_names)), np.nan, dtype = np.float32)
+    features_df = feats_arr.view(dtype = [(x, np.float32) for x in feats_names])[:, 0].view(np.recarray)
+    
+    thresholds = trajectories_data['threshold'].values
+    min_blob_areas = trajectories_data['area'].values / 2
 
-    features_df = np.recarray(len(trajectories_data),
-                              dtype = [(x, np.float32) for x in feats_names])
-
-
-    feats_generator = map(_roi2feats, _gen_rows_blocks())
-
-
-    for block in feats_generator:
-        for irow, row_dat in block:
-            features_df[irow] = row_dat
+    def _roi2feats(block):
+        irows = []
+        block_feats = np.full((len(block), len(feats_names)), np.nan)
+        for ii, (irow, (roi_image, roi_corner)) in enumerate(block):
+            blob_mask, blob_cnt, _ = getWormMask(roi_image,
+                                                 thresholds[irow],
+                                                 strel_size,
+                                                 min_blob_area=min_blob_areas[irow],
+                                                 is_light_background = is_light_background)
+            feats = _getBlobFeatures(blob_cnt, blob_mask, roi_image, roi_corner)
+            if feats is not None:
+                block_feats[ii] = feats
+            irows.append(irow)
+        return irows, block_feats
+
+    feats_generator = imap_ordered(_roi2feats, _gen_rows_blocks(), n_cores_used)
+    for irows, block_feats in feats_generator:
+        feats_arr[irows] = block_feats
 
     with tables.File(skeletons_file, 'r+') as fid:
         if '/blob_features' in fid:
@@ -1,6 +1,5 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-import numpy.ma as ma
 import cv2
 import tables
 from  tierpsy.analysis.compress.selectVideoReader import selectVideoReader
@@ -79,6 +78,8 @@ class BackgroundSubtractorStream(BackgroundSubtractorBase):
         assert self.frame_gap > 0
 
         self.reduce_func = np.max if self.is_light_background else np.min
+        #element-wise version of reduce_func
+        self.reduce_pair = np.maximum if self.is_light_background else np.minimum
         
         #internal variables
         self.last_frame = -1
@@ -125,9 +126,6 @@ class BackgroundSubtractorVideo(BackgroundSubtractorStream):
         super().__init__(*args, **argkws)
         
     def init_buffer(self):
-        ret = 1
-        current_frame = 0
-
         vid = selectVideoReader(self.video_file)
         
         d_info = np.iinfo(vid.dtype)
@@ -142,33 +140,12 @@ class BackgroundSubtractorVideo(BackgroundSubtractorStream):
 
         max_frames = self.buff_size*self.frame_gap
 
-        if vid.__class__.__name__ != 'readLoopBio':
-            # for non-loopbio videos
-            while current_frame < max_frames:
-                ret, image = vid.read()
-                #if not valid frame is returned return.
-                if ret == 0:
-                    break
-    
-                if image.ndim == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-                
-                if self.is_update_frame(current_frame):
-                    self.update_buffer(image, current_frame)
-                
-                current_frame += 1
-            self.last_frame = current_frame - 1
-                
+        if hasattr(vid, 'read_frame'):
+            # the reader can seek exactly to any frame (hdf5, images, .dat or loopbio), 
+            # so only decode the frames used by the buffer
+            self._init_buffer_seek(vid, max_frames)
         else:
-            # loopbio videos:
-            for fc in range(self.buff_size):
-                frame_to_read = fc * self.frame_gap
-                ret, image = vid.read_frame(frame_to_read)
-                # if not valid frame is returned return.
-                if ret == 0:
-                    break
-                self.update_buffer(image, frame_to_read)
-            self.last_frame = frame_to_read - self.frame_gap
+            self._init_buffer_sequential(vid, max_frames)
 
         vid.release()
 
@@ -180,6 +157,50 @@ class BackgroundSubtractorVideo(BackgroundSubtractorStream):
             #not enough frames to fill the buffer, reduce its size
             self.buffer = self.buffer[:(self.buffer_ind+1)]
     
+    def _init_buffer_seek(self, vid, max_frames):
+        current_frame = 0
+        while current_frame < max_frames:
+            ret, image = vid.read_frame(current_frame)
+            #if not valid frame is returned return.
+            if ret == 0:
+                break
+
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+            self.update_buffer(image, current_frame)
+
+            #same frames as reading sequentially: if the image was rejected (black) try the next one
+            if self.last_frame == current_frame:
+                current_frame += self.frame_gap
+            else:
+                current_frame += 1
+        self.last_frame = min(current_frame, max_frames) - 1
+
+    def _init_buffer_sequential(self, vid, max_frames):
+        current_frame = 0
+        if hasattr(vid, 'read_into'):
+            #decode all the frames into the same array, only the ones used to update the buffer are copied.
+            image = np.empty((vid.height, vid.width), vid.dtype)
+
+        while current_frame < max_frames:
+            if hasattr(vid, 'read_into'):
+                ret = vid.read_into(image)
+            else:
+                ret, image = vid.read()
+            #if not valid frame is returned return.
+            if ret == 0:
+                break
+
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+            
+            if self.is_update_frame(current_frame):
+                self.update_buffer(image, current_frame)
+            
+            current_frame += 1
+        self.last_frame = current_frame - 1
+    
     def calculate_bgnd(self):
         '''Calculate the background from the buffer.'''
         self.bgnd = self.reduce_func(self.buffer, axis=0)
@@ -216,8 +237,17 @@ class BackgroundSubtractorMasked(BackgroundSubtractorStream):
     
     def __init__(self, *args, **argkws):
         self.full_img = None
+        self.buffer_bgnd = None
         super().__init__(*args, **argkws)
-        
+
+    def _fill_masked(self, image):
+        #the zeroed pixels must be ignored by the reducing function. Instead of using a masked array 
+        #I replace them by a value that never wins: 0 for the maximum (already the case) and 255 for the minimum.
+        if self.is_light_background:
+            return image
+        image = image.copy()
+        image[image == 0] = 255
+        return image
 
     def init_buffer(self):    
         #we only accept masked files
@@ -226,10 +256,8 @@ class BackgroundSubtractorMasked(BackgroundSubtractorStream):
         with tables.File(self.video_file, 'r') as fid:
             masks = fid.get_node('/mask')
             
-            #here i am using a masked numpy array to deal with the zeroed background
             last_frame = self.buff_size*self.frame_gap - 1
-            self.buffer = masks[:last_frame + 1:self.frame_gap]
-            self.buffer = ma.masked_array(self.buffer, self.buffer==0)
+            self.buffer = self._fill_masked(masks[:last_frame + 1:self.frame_gap])
             
             self.buffer_ind = self.buffer.shape[0] - 1
             self.last_frame = last_frame
@@ -239,20 +267,36 @@ class BackgroundSubtractorMasked(BackgroundSubtractorStream):
                 full_data = fid.get_node('/full_data')
                 self.full_img = self.reduce_func(full_data, axis=0)
                 
-             
-            
     def calculate_bgnd(self):
-        fill_value = 0 if self.is_light_background else 255
-        self.bgnd = self.reduce_func(self.buffer, axis=0).filled(fill_value)
+        self.buffer_bgnd = self.reduce_func(self.buffer, axis=0)
+        self._combine_full_img()
+    
+    def _combine_full_img(self):
+        self.bgnd = self.buffer_bgnd
         if self.full_img is not None:
-            dd = (self.bgnd, self.full_img)
-            self.bgnd = self.reduce_func(dd, axis=0)
-        
+            self.bgnd = self.reduce_pair(self.bgnd, self.full_img)
     
-    def _update_background(self, image, frame_n):
-        super()._update_background(image, frame_n)
-        dd = self.buffer[self.buffer_ind]
-        self.buffer[self.buffer_ind] = ma.masked_array(dd, dd ==0)
+    def update_background(self, image, current_frame):
+        if image.sum() == 0:
+            #this is a black image that sometimes occurs, ignore it...
+            return
+        
+        old_img = self.buffer[(self.buffer_ind + 1) % self.buffer.shape[0]].copy()
+        new_img = self._fill_masked(image)
+        self.update_buffer(new_img, current_frame)
+        
+        #only the pixels where the replaced frame was the extreme value and the new one is not 
+        #have to be recalculated, in the rest the pair-wise reduction is enough.
+        is_stale = (old_img == self.buffer_bgnd) & (self.reduce_pair(old_img, new_img) != new_img)
+        self.buffer_bgnd = self.reduce_pair(self.buffer_bgnd, new_img)
+        
+        n_stale = np.count_nonzero(is_stale)
+        if 4*n_stale > is_stale.size:
+            self.buffer_bgnd = self.reduce_func(self.buffer, axis=0)
+        elif n_stale > 0:
+            self.buffer_bgnd[is_stale] = self.reduce_func(self.buffer[:, is_stale], axis=0)
+        
+        self._combine_full_img()
     
     def subtract_bgnd(self, image):
         return self._subtract_bgnd_from_mask(image)
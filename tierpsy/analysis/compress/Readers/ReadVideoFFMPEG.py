@@ -93,18 +93,38 @@ class ReadVideoFFMPEG:
 
     def read(self):
         # retrieve an image as numpy array
-        raw_image = self.proc.stdout.read(self.tot_pix)
-        if len(raw_image) < self.tot_pix:
+        image = np.empty((self.height, self.width), dtype=np.uint8)
+        ret = self.read_into(image)
+        if ret == 0:
             return (0, [])
+        return (1, image)
+
+    def read_into(self, image):
+        '''
+        Read the next frame directly into a preallocated C-contiguous uint8 
+        array of shape (height, width), e.g. a slice of an image buffer.
+        This avoids allocating a new bytes object and array for every frame.
+        Returns 1 if a complete frame was read and 0 otherwise.
+        '''
+        assert image.dtype == np.uint8 and image.size == self.tot_pix
+        assert image.flags['C_CONTIGUOUS']
+
+        buff = memoryview(image).cast('B')
+        n_read = 0
+        while n_read < self.tot_pix:
+            n = self.proc.stdout.readinto(buff[n_read:])
+            if not n:
+                break
+            n_read += n
 
-        image = np.fromstring(raw_image, dtype='uint8')
-        image = image.reshape(self.height, self.width)
+        if n_read < self.tot_pix:
+            return 0
 
         # i need to read this here because otherwise the err buff will get
         # full.
         self.get_timestamp()
 
-        return (1, image)
+        return 1
 
     def release(self):
         # close the buffer
@@ -49,29 +49,38 @@ class readDatFiles:
     def read(self):
         self.curr_frame += 1
         if self.curr_frame < self.num_frames:
-            fname = self.files[self.dat_order[self.curr_frame]] # is this indexing correct, or do we need to shift down by one?
-            bin_dat = np.fromfile(fname, np.uint8)
-            # every 3 bytes will correspond two pixel levels.
-            D1 = bin_dat[:-40:3]
-            D2 = bin_dat[1:-40:3]
-            D3 = bin_dat[2:-40:3]
+            return (1, self._decode_frame(self.curr_frame))
+        else:
+            return (0, [], [], [])
 
-            # the image format is mono 12 packed (see web)
-            # the first and third bytes represent the higher bits of the pixel intensity
-            # while the second byte is divided into the lower bits.
-            D1s = np.left_shift(D1.astype(np.uint16), 4) + \
-                np.bitwise_and(D2, 15)
-            D3s = np.left_shift(D3.astype(np.uint16), 4) + \
-                np.right_shift(D2, 4)
+    def read_frame(self, frame_number):
+        if 0 <= frame_number < self.num_frames:
+            return (1, self._decode_frame(frame_number))
+        else:
+            return (0, [])
 
-            # the pixels seemed to be organized in this order
-            image_decoded = np.zeros((self.height, self.width), np.uint16)
-            image_decoded[::-1, -2::-2] = D3s.reshape((self.height, -1))
-            image_decoded[::-1, ::-2] = D1s.reshape((self.height, -1))
+    def _decode_frame(self, frame_number):
+        fname = self.files[self.dat_order[frame_number]] # is this indexing correct, or do we need to shift down by one?
+        bin_dat = np.fromfile(fname, np.uint8)
+        # every 3 bytes will correspond two pixel levels.
+        D1 = bin_dat[:-40:3]
+        D2 = bin_dat[1:-40:3]
+        D3 = bin_dat[2:-40:3]
 
-            return (1, image_decoded)
-        else:
-            return (0, [], [], [])
+        # the image format is mono 12 packed (see web)
+        # the first and third bytes represent the higher bits of the pixel intensity
+        # while the second byte is divided into the lower bits.
+        D1s = np.left_shift(D1.astype(np.uint16), 4) + \
+            np.bitwise_and(D2, 15)
+        D3s = np.left_shift(D3.astype(np.uint16), 4) + \
+            np.right_shift(D2, 4)
+
+        # the pixels seemed to be organized in this order
+        image_decoded = np.zeros((self.height, self.width), np.uint16)
+        image_decoded[::-1, -2::-2] = D3s.reshape((self.height, -1))
+        image_decoded[::-1, ::-2] = D1s.reshape((self.height, -1))
+
+        return image_decoded
 
     def release(self):
         pass
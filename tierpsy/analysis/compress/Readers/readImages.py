@@ -53,5 +53,12 @@ class readImages:
         else:
             return(0, [])
 
+    def read_frame(self, frame_number):
+        if 0 <= frame_number < self.num_frames:
+            image = cv2.imread(self.files[frame_number], self.imread_flag)
+            return (1, image)
+        else:
+            return(0, [])
+
     def release(self):
         pass
@@ -34,6 +34,7 @@ class readVideoHDF5:
 
         # how often we get a full frame
         self.full_img_period = full_img_period
+        self._full_img_ind = -1
 
     def read(self):
         self.curr_frame += 1
@@ -49,6 +50,25 @@ class readVideoHDF5:
         else:
             return (0, [])
 
+    def read_frame(self, frame_number):
+        # random access to a frame, the zeros are replaced using the closest previous full frame
+        if frame_number < 0 or frame_number >= self.tot_frames:
+            return (0, [])
+
+        if np.isfinite(self.full_img_period):
+            full_img_ind = frame_number - frame_number % self.full_img_period
+        else:
+            full_img_ind = 0
+
+        if full_img_ind != self._full_img_ind:
+            self._full_img_ind = full_img_ind
+            self.full_img = self.dataset[full_img_ind, :, :]
+            self.value2replace = np.median(self.full_img)
+
+        image = self.dataset[frame_number, :, :]
+        image[image == 0] = self.value2replace
+        return (1, image)
+
     def release(self):
         # close the buffer
         self.fid.close()
@@ -47,6 +47,7 @@ def args_(fn, param):
             'microns_per_pixel' : p['microns_per_pixel'],
             'is_extract_timestamp': p['is_extract_timestamp'],
             'fovsplitter_param': fovsplitter_param,
+            'n_cores_used': p['n_cores_used']
         }
 
     argkws_d = {
@@ -5,6 +5,8 @@ Created on Thu Apr  2 13:19:58 2015
 @author: ajaver
 """
 import os
+from functools import partial
+from queue import Queue, Empty
 
 import cv2
 import tables
@@ -13,8 +15,9 @@ import numpy as np
 from tierpsy.analysis.compress.BackgroundSubtractor import BackgroundSubtractorVideo
 from tierpsy.analysis.compress.extractMetaData import store_meta_data, read_and_save_timestamp
 from tierpsy.analysis.compress.selectVideoReader import selectVideoReader
+from tierpsy.analysis.compress.Readers.readVideoHDF5 import readVideoHDF5
 from tierpsy.helper.params import compress_defaults, set_unit_conversions
-from tierpsy.helper.misc import TimeCounter, print_flush, TABLE_FILTERS
+from tierpsy.helper.misc import TimeCounter, print_flush, TABLE_FILTERS, iter_prefetch, imap_ordered
 from tierpsy.analysis.split_fov.helper import parse_camera_serial
 from tierpsy.analysis.split_fov.FOVMultiWellsSplitter import FOVMultiWellsSplitter
 
@@ -209,10 +212,151 @@ def initMasksGroups(fid, expected_frames, im_height, im_width,
 
 
 
+def _initBuffer(buffer_size, im_height, im_width, buffers_pool=None):
+    # reuse a buffer that was already saved if there is any available, 
+    # otherwise allocate a new one.
+    try:
+        buff = buffers_pool.get_nowait()
+    except (AttributeError, Empty):
+        buff = np.empty((buffer_size, im_height, im_width), dtype=np.uint8)
+
+    buff_data = {
+        'buffer' : buff,
+        'full_frames' : [],
+        'mean_intensity' : [],
+        'normalization_range' : []
+        }
+    return buff_data
+
+def _releaseBuffer(buff_data, buffers_pool=None):
+    if buffers_pool is not None:
+        buffers_pool.put(buff_data['buffer'])
+
+def _iterVideoBuffers(vid, buffer_size, save_full_interval, max_frame, 
+        bgnd_subtractor=None, buffers_pool=None):
+    '''
+    Read the video and group the frames into buffers of buffer_size images.
+    For each buffer it yields a dictionary with the buffer (Ibuff), the image
+    used to calculate the mask (Ibuff_b, background subtracted if required),
+    and the extra data that must be saved together with it (full frames, mean
+    intensities, normalization ranges).
+    If the reader has a read_into method, the frames are decoded directly into the 
+    buffer. The buffers are recycled from buffers_pool (a Queue) if it is given, 
+    use _releaseBuffer once the buffer data was saved.
+    '''
+    is_read_into = hasattr(vid, 'read_into')
+
+    frame_number = 0
+    buff_data = None
+    while frame_number < max_frame:
+        # buffer index
+        ind_buff = frame_number % buffer_size
+
+        # initialize the buffer when the index correspond to 0
+        if buff_data is None:
+            buff_data = _initBuffer(buffer_size, vid.height, vid.width, buffers_pool)
+        Ibuff = buff_data['buffer']
+        
+        img_norm_range = None
+        if is_read_into:
+            ret = vid.read_into(Ibuff[ind_buff])
+        else:
+            ret, image = vid.read()
+        
+        if ret == 0:
+            break
+
+        # increase frame number
+        frame_number += 1
+
+        if not is_read_into:
+            # opencv can give an artificial rgb image. Let's get it back to
+            # gray scale.
+            if image.ndim == 3:
+                image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+
+            if image.dtype != np.uint8:
+                # normalise image intensities if the data type is other
+                # than uint8
+                image, img_norm_range = normalizeImage(image)
+
+            # add image to the buffer
+            assert image.dtype == np.uint8
+            Ibuff[ind_buff] = image
+        
+        #limit the image range to 1 to 255, 0 is a reserved value for the background
+        image = Ibuff[ind_buff]
+        np.clip(image, 1, 255, out=image)
+
+        # Add a full frame every save_full_interval. 
+        # I need a copy since the buffer will be masked in place.
+        if frame_number % save_full_interval == 1:
+            buff_data['full_frames'].append(image.copy())
+
+        mean_int = np.mean(image)
+        assert mean_int >= 0
+        buff_data['mean_intensity'].append(mean_int)
+
+        if img_norm_range is not None:
+            buff_data['normalization_range'].append(img_norm_range)
+
+        if ind_buff == buffer_size - 1:
+            buff_data['Ibuff'] = Ibuff
+            yield _closeBuffer(buff_data, frame_number, bgnd_subtractor)
+            buff_data = None
+
+    # the video finished before the buffer was full, close the buffer
+    if buff_data is not None:
+        tot_buff = len(buff_data['mean_intensity'])
+        if tot_buff > 0:
+            buff_data['Ibuff'] = buff_data['buffer'][:tot_buff]
+            yield _closeBuffer(buff_data, frame_number, bgnd_subtractor)
+        else:
+            _releaseBuffer(buff_data, buffers_pool)
+
+def _closeBuffer(buff_data, frame_number, bgnd_subtractor):
+    buff_data['frame_number'] = frame_number
+    # the background subtractor is updated as the video is read, so it must be
+    # applied sequentially here and not by the workers of the pipelined mode
+    if bgnd_subtractor is not None:
+        buff_data['Ibuff_b'] = bgnd_subtractor.apply(buff_data['Ibuff'], frame_number)
+    else:
+        buff_data['Ibuff_b'] = buff_data['Ibuff']
+    return buff_data
+
+def _maskBuffer(buff_data, mask_param, fovsplitter=None):
+    Ibuff = buff_data['Ibuff']
+
+    #calculate the max/min in the of the buffer
+    img_reduce = reduceBuffer(buff_data['Ibuff_b'], mask_param['is_light_background'])
+
+    mask = getROIMask(img_reduce, **mask_param)
+
+    Ibuff *= mask
+
+    # now apply the well_mask if is MWP
+    if fovsplitter is not None:
+        fovsplitter.apply_wells_mask(Ibuff) # Ibuff will be modified after this
+
+    return buff_data
+
+def _saveBuffer(buff_data, mask_dataset, full_dataset, mean_intensity, normalization_range=None):
+    for image in buff_data['full_frames']:
+        full_dataset.append(image[np.newaxis, :, :])
+
+    mean_intensity.append(np.array(buff_data['mean_intensity']))
+
+    if normalization_range is not None and buff_data['normalization_range']:
+        normalization_range.append(np.array(buff_data['normalization_range']))
+
+    # add buffer to the hdf5 file
+    mask_dataset.append(buff_data['Ibuff'])
+
+
 def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
                   microns_per_pixel=None, bgnd_param ={}, buffer_size=-1,
                   save_full_interval=-1, max_frame=1e32, is_extract_timestamp=False,
-                  fovsplitter_param={}):
+                  fovsplitter_param={}, n_cores_used=1):
     '''
     Compresses video by selecting pixels that are likely to have worms on it and making the rest of
     the image zero. By creating a large amount of redundant data, any lossless compression
@@ -227,6 +371,8 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
      save_full_interval -- have often a full image is saved
      max_frame -- last frame saved (default a very large number, so it goes until the end of the video)
      mask_param -- parameters used to calculate the mask
+     n_cores_used -- if larger than one, the video is decoded in a background thread and the masks are calculated 
+     by a pool of n_cores_used threads while the data is written in order.
     '''
 
     #get the default values if there is any bad parameter
@@ -251,6 +397,8 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
     else:
         is_fov_tosplit = False
 
+    is_pipelined = n_cores_used > 1
+
     # processes identifier.
     base_name = masked_image_file.rpartition('.')[0].rpartition(os.sep)[-1]
     
@@ -272,17 +420,11 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
         expected_frames = 1
     
     # Initialize background subtraction if required
-
+    bgnd_subtractor = None
     if is_bgnd_subtraction:
         print_flush(base_name + ' Initializing background subtraction.')
         bgnd_subtractor = BackgroundSubtractorVideo(video_file, **bgnd_param)
 
-    # intialize some variables
-    max_intensity, min_intensity = np.nan, np.nan
-    frame_number = 0
-    full_frame_number = 0
-    image_prev = np.zeros([])
-    
     # Initialise FOV splitting if needed
     if is_fov_tosplit:
         # masked video does not exist yet so have to initialise from data  
@@ -334,7 +476,8 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
             # because we only save the one background:
             bg_dataset._v_attrs['save_interval'] = vid.frame_max-vid.first_frame + 1 
             bg_dataset[0,:,:] = img_fov
-            
+        
+        normalization_range = None
         if vid.dtype != np.uint8:
             # this will worm as flags to be sure that the normalization took place.
             normalization_range = mask_fid.create_earray('/', 
@@ -345,86 +488,40 @@ def compressVideo(video_file, masked_image_file, mask_param,  expected_fps=25,
                                         filters=TABLE_FILTERS
                                         )
     
-        while frame_number < max_frame:
+        if is_fov_tosplit:
+            mask_func = partial(_maskBuffer, mask_param=mask_param, fovsplitter=fovsplitter)
+        else:
+            mask_func = partial(_maskBuffer, mask_param=mask_param)
+
+        # the buffers are recycled after they are saved to avoid allocating them every time
+        buffers_pool = Queue()
+        buff_generator = _iterVideoBuffers(vid, 
+                                           buffer_size, 
+                                           save_full_interval, 
+                                           max_frame, 
+                                           bgnd_subtractor=bgnd_subtractor, 
+                                           buffers_pool=buffers_pool)
+        if is_pipelined:
+            # decode the video in a background thread, mask the buffers using a pool
+            # of threads, and write them in order here (pytables is not thread safe, 
+            # so hdf5 videos are still read in this thread).
+            if not isinstance(vid, readVideoHDF5):
+                buff_generator = iter_prefetch(buff_generator, max_size=2)
+            masked_generator = imap_ordered(mask_func, buff_generator, n_cores_used, max_pending=n_cores_used+1)
+        else:
+            masked_generator = map(mask_func, buff_generator)
 
-            ret, image = vid.read()
-            if ret != 0:
-                # increase frame number
-                frame_number += 1
-
-                # opencv can give an artificial rgb image. Let's get it back to
-                # gray scale.
-                if image.ndim == 3:
-                    image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
-
-                if image.dtype != np.uint8:
-                    # normalise image intensities if the data type is other
-                    # than uint8
-                    image, img_norm_range = normalizeImage(image)
-                    normalization_range.append(img_norm_range)
-
-                #limit the image range to 1 to 255, 0 is a reserved value for the background
-                assert image.dtype == np.uint8
-                image = np.clip(image, 1,255)
-
-                # Add a full frame every save_full_interval
-                if frame_number % save_full_interval == 1:
-                    full_dataset.append(image[np.newaxis, :, :])
-                    full_frame_number += 1
-
-                # buffer index
-                ind_buff = (frame_number - 1) % buffer_size
-
-                # initialize the buffer when the index correspond to 0
-                if ind_buff == 0:
-                    Ibuff = np.zeros(
-                        (buffer_size, vid.height, vid.width), dtype=np.uint8)
-
-                # add image to the buffer
-                Ibuff[ind_buff, :, :] = image.copy()
-                mean_int = np.mean(image)
-                assert mean_int >= 0
-                mean_intensity.append(np.array([mean_int]))
-
-            else:
-                # sometimes the last image is all zeros, control for this case
-                if np.all(Ibuff[ind_buff] == 0):
-                    frame_number -= 1
-                    ind_buff -= 1
-
-                # close the buffer
-                Ibuff = Ibuff[:ind_buff + 1]
-
-            # mask buffer and save data into the hdf5 file
-            if (ind_buff == buffer_size - 1 or ret == 0) and Ibuff.size > 0:                
-                if is_bgnd_subtraction:
-                    Ibuff_b  = bgnd_subtractor.apply(Ibuff, frame_number)
-                else:
-                    Ibuff_b = Ibuff
-                
-                #calculate the max/min in the of the buffer
-                img_reduce = reduceBuffer(Ibuff_b, mask_param['is_light_background'])
-
-                mask = getROIMask(img_reduce, **mask_param)
-                
-                Ibuff *= mask
-
-                # now apply the well_mask if is MWP
-                if is_fov_tosplit:
-                    fovsplitter.apply_wells_mask(Ibuff) # Ibuff will be modified after this
-                    
-                # add buffer to the hdf5 file
-                frame_first_buff = frame_number - Ibuff.shape[0]
-                mask_dataset.append(Ibuff)
-
-            if frame_number % 500 == 0:
+        last_progress_frame = 0
+        for buff_data in masked_generator:
+            _saveBuffer(buff_data, mask_dataset, full_dataset, mean_intensity, normalization_range)
+            _releaseBuffer(buff_data, buffers_pool)
+            
+            frame_number = buff_data['frame_number']
+            if frame_number // 500 > last_progress_frame // 500:
                 # calculate the progress and put it in a string
                 progress_str = progressTime.get_str(frame_number)
                 print_flush(base_name + ' ' + progress_str)
-                
-            # finish process
-            if ret == 0:
-                break
+                last_progress_frame = frame_number
 
         # close the video
         vid.release()
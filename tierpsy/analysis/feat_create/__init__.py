@@ -3,9 +3,12 @@ from ..ske_filt import get_feat_filt_param
 
 def _get_feats_param(param):
   p = param.p_dict
+  #comma separated list of openworm features. If it is empty all the features are calculated.
+  feat_names = [x.strip() for x in p['feat_openworm_names'].split(',') if x.strip()]
   return {
     'feat_filt_param': get_feat_filt_param(p),
     'split_traj_time' : p['split_traj_time'],
+    'feat_names' : feat_names if feat_names else None,
     'is_single_worm': param.is_WT2
     }
 
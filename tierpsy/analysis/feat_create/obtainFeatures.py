@@ -6,7 +6,7 @@ Created on Thu Jun  4 11:30:53 2015
 """
 from tierpsy.helper.misc import TimeCounter, print_flush, WLAB, TABLE_FILTERS, get_base_name
 from tierpsy.analysis.ske_filt.getFilteredSkels import getValidIndexes
-from tierpsy.analysis.feat_create.obtainFeaturesHelper import WormStats, WormFromTable
+from tierpsy.analysis.feat_create.obtainFeaturesHelper import WormStats, WormFromTable, WormTableIndex
 from tierpsy.helper.params import copy_unit_conversions, read_fps, min_num_skel_defaults
 
 import tierpsy.features.open_worm_analysis_toolbox as mv
@@ -46,16 +46,15 @@ def getFeatStats(worm, wStats):
         
     worm_openworm = worm.to_open_worm()
     assert worm_openworm.skeleton.shape[1] == 2
-    worm_features = mv.WormFeatures(worm_openworm)
+    #only the features selected in wStats (and the ones they depend on) are calculated
+    worm_features = mv.WormFeatures(worm_openworm, specs=wStats.openworm_specs)
     
-    def _get_worm_stat(func):
-        # calculate the mean value of each feature
-        worm_stat = wStats.getWormStats(worm_features, func)
+    # calculate all the stats of each feature sharing the subdivisions of the data
+    worm_stats = wStats.getWormStatsMulti(worm_features, FUNC_FOR_DIV)
+    for worm_stat in worm_stats.values():
         for field in wStats.extra_fields:
             worm_stat[field] = getattr(worm, field)
-        return worm_stat
-        
-    worm_stats = {stat: _get_worm_stat(FUNC_FOR_DIV[stat]) for stat in FUNC_FOR_DIV}
+    
     return worm_features, worm_stats
 
 def getOpenWormData(worm, wStats=[]):
@@ -77,6 +76,8 @@ def getOpenWormData(worm, wStats=[]):
         'locomotion.motion_mode'].value
 
     for feat in wStats.feat_timeseries:
+        if not feat in wStats.feat_selected:
+            continue
         feat_obj = wStats.features_info.loc[feat, 'feat_name_obj']
         if feat_obj in worm_features._features:
             timeseries_data[feat] = worm_features._features[feat_obj].value
@@ -84,6 +85,8 @@ def getOpenWormData(worm, wStats=[]):
     # convert the events features into a dictionary
     events_data = {}
     for feat in wStats.feat_events:
+        if not feat in wStats.feat_selected:
+            continue
         feat_obj = wStats.features_info.loc[feat, 'feat_name_obj']
         if feat_obj in worm_features._features:
             events_data[feat] = worm_features._features[feat_obj].value
@@ -155,8 +158,12 @@ def getWormFeaturesFilt(
         use_manual_join,
         is_single_worm,
         feat_filt_param,
-        split_traj_time):
-    
+        split_traj_time,
+        feat_names = None):
+    '''
+    feat_names - list of the features to calculate (the rest are saved as nan). 
+                If None all the openworm features are calculated.
+    '''
     feat_filt_param = min_num_skel_defaults(skeletons_file, **feat_filt_param)
 
 
@@ -240,7 +247,7 @@ def getWormFeaturesFilt(
             return
 
         # initialize by getting the specs data subdivision
-        wStats = WormStats()
+        wStats = WormStats(feat_names)
         all_splitted_feats = {stat:[] for stat in FUNC_FOR_DIV}
     
 
@@ -250,6 +257,9 @@ def getWormFeaturesFilt(
 
 
 
+        # read the trajectories table only once for all the worms
+        table_index = WormTableIndex(skeletons_file, worm_index_type)
+
         _displayProgress(0)
         # start to calculate features for each worm trajectory
         for ind_N, worm_index in enumerate(good_traj_index):
@@ -259,7 +269,8 @@ def getWormFeaturesFilt(
             worm_index,
             use_skel_filter=use_skel_filter,
             worm_index_type=worm_index_type,
-            smooth_window=5)
+            smooth_window=5,
+            table_index=table_index)
             
             if is_single_worm:
                 #worm with the stage correction applied
@@ -51,6 +51,65 @@ def _h_smooth_curve_all(curves, window=5, pol_degree=3):
     return curves
 
 
+def _h_read_rows(node, rows, max_gap=1000, max_chunk_size=10000):
+    '''
+    Read the given rows of a pytables array. The rows are sorted and read 
+    in contiguous slices (allowing gaps of up to max_gap rows and with at most 
+    max_chunk_size rows per slice). This is much faster than the pytables fancy 
+    indexing when reading many rows of a large table.
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    tot = rows.size
+    
+    sorted_ind = np.argsort(rows, kind='stable')
+    rows_s = rows[sorted_ind]
+
+    data_s = np.empty((tot,) + node.shape[1:], node.dtype)
+    ini = 0
+    while ini < tot:
+        first_row = rows_s[ini]
+        fin = np.searchsorted(rows_s, first_row + max_chunk_size, side='left')
+        
+        #split the chunk if there is a large gap
+        large_gaps = np.flatnonzero(np.diff(rows_s[ini:fin]) > max_gap)
+        if large_gaps.size > 0:
+            fin = ini + large_gaps[0] + 1
+
+        last_row = rows_s[fin - 1]
+        data_s[ini:fin] = node[first_row:last_row + 1][rows_s[ini:fin] - first_row]
+        ini = fin
+    
+    #return the data in the original order
+    data = np.empty_like(data_s)
+    data[sorted_ind] = data_s
+    return data
+
+class WormTableIndex():
+    '''
+    Read the /trajectories_data table of a skeletons file only once and index it by worm. 
+    It can be shared by all the WormFromTable objects created from the same file, 
+    instead of reading the whole table for each worm.
+    '''
+    def __init__(self, file_name, worm_index_type='worm_index_joined'):
+        self.file_name = file_name
+        self.worm_index_type = worm_index_type
+        
+        #if it does not exists return 1 as a default, like that we can still calculate the features in pixels and frames, instead of micrometers and seconds.
+        self.microns_per_pixel = read_microns_per_pixel(file_name, dflt=1)
+        self.fps = read_fps(file_name, dflt=1)
+
+        with pd.HDFStore(file_name, 'r') as ske_file_id:
+            self.trajectories_data = ske_file_id['/trajectories_data']
+        
+        assert worm_index_type in self.trajectories_data
+        #positional indexes of the rows of each worm
+        self.worm_rows = self.trajectories_data.groupby(worm_index_type).indices
+
+    def __getitem__(self, worm_index):
+        rows = self.worm_rows.get(worm_index, np.zeros(0, np.int64))
+        return self.trajectories_data.iloc[rows]
+
+
 class WormFromTableSimple():
     def __init__(self, 
                 file_name, 
@@ -58,11 +117,21 @@ class WormFromTableSimple():
                 use_skel_filter=True,
                 worm_index_type='worm_index_joined',
                 smooth_window=-1, 
-                POL_DEGREE_DFLT=3):
+                POL_DEGREE_DFLT=3,
+                table_index=None):
         # Populates an empty normalized worm.
-        #if it does not exists return 1 as a default, like that we can still calculate the features in pixels and frames, instead of micrometers and seconds.
-        self.microns_per_pixel = read_microns_per_pixel(file_name, dflt=1)
-        self.fps = read_fps(file_name, dflt=1)
+        
+        #table_index is a WormTableIndex shared between the worms of the same file. 
+        if table_index is not None:
+            assert table_index.file_name == file_name
+            assert table_index.worm_index_type == worm_index_type
+            self.microns_per_pixel = table_index.microns_per_pixel
+            self.fps = table_index.fps
+        else:
+            #if it does not exists return 1 as a default, like that we can still calculate the features in pixels and frames, instead of micrometers and seconds.
+            self.microns_per_pixel = read_microns_per_pixel(file_name, dflt=1)
+            self.fps = read_fps(file_name, dflt=1)
+        self.table_index = table_index
         
         # savitzky-golay filter polynomial order default
         self.POL_DEGREE_DFLT = POL_DEGREE_DFLT
@@ -99,48 +168,50 @@ class WormFromTableSimple():
         Get the relevant info from the trajectory_data table for a single worm. skeleton_id, timestamp.
         '''
         # intialize just to make clear the relevant variables for this function
-
-        with pd.HDFStore(self.file_name, 'r') as ske_file_id:
-            trajectories_data_f = ske_file_id['/trajectories_data']
+        if self.table_index is not None:
+            trajectories_data = self.table_index[self.worm_index]
+        else:
+            with pd.HDFStore(self.file_name, 'r') as ske_file_id:
+                trajectories_data_f = ske_file_id['/trajectories_data']
 
             # get the rows of valid skeletons
             assert self.worm_index_type in trajectories_data_f
             good = trajectories_data_f[self.worm_index_type] == self.worm_index
             trajectories_data = trajectories_data_f.loc[good]
-                        
-            try:
-                # try to read the time stamps, if there are repeated or not a
-                # number use the frame nuber instead
-                timestamp_raw = trajectories_data['timestamp_raw'].values
-                if np.any(np.isnan(timestamp_raw)):
-                    raise ValueError
-                else:
-                    timestamp_inds = timestamp_raw.astype(np.int)
-                    
-                    #deal in the case they are repeating indexes (this happends sometimes in the last frame)
-                    timestamp_inds, ind = np.unique(timestamp_inds, return_index=True)
-                    trajectories_data = trajectories_data.iloc[ind]
                     
+        try:
+            # try to read the time stamps, if there are repeated or not a
+            # number use the frame nuber instead
+            timestamp_raw = trajectories_data['timestamp_raw'].values
+            if np.any(np.isnan(timestamp_raw)):
+                raise ValueError
+            else:
+                timestamp_inds = timestamp_raw.astype(np.int)
+                
+                #deal in the case they are repeating indexes (this happends sometimes in the last frame)
+                timestamp_inds, ind = np.unique(timestamp_inds, return_index=True)
+                trajectories_data = trajectories_data.iloc[ind]
+                
 
-            except (ValueError, KeyError):
-                # if the time stamp fails use the frame_number value instead
-                # (the index of the mask) and return nan as the fps
-                timestamp_inds = trajectories_data['frame_number'].values
-            
+        except (ValueError, KeyError):
+            # if the time stamp fails use the frame_number value instead
+            # (the index of the mask) and return nan as the fps
+            timestamp_inds = trajectories_data['frame_number'].values
+        
 
-            skel_table_id = trajectories_data['skeleton_id'].values
-            # we need to use (.values) to be able to use the & operator
-            good_skeletons = (trajectories_data['has_skeleton'] == 1).values
-            if self.use_skel_filter and 'is_good_skel' in trajectories_data:
-                # only keep skeletons that where labeled as good skeletons in
-                # the filtering step
-                good_skeletons &= (
-                    trajectories_data['is_good_skel'] == 1).values
-            skel_table_id = skel_table_id[good_skeletons]
-            timestamp_inds = timestamp_inds[good_skeletons]
-            
-            
-            return skel_table_id, timestamp_inds
+        skel_table_id = trajectories_data['skeleton_id'].values
+        # we need to use (.values) to be able to use the & operator
+        good_skeletons = (trajectories_data['has_skeleton'] == 1).values
+        if self.use_skel_filter and 'is_good_skel' in trajectories_data:
+            # only keep skeletons that where labeled as good skeletons in
+            # the filtering step
+            good_skeletons &= (
+                trajectories_data['is_good_skel'] == 1).values
+        skel_table_id = skel_table_id[good_skeletons]
+        timestamp_inds = timestamp_inds[good_skeletons]
+        
+        
+        return skel_table_id, timestamp_inds
 
 
     def _h_read_data(self):
@@ -157,32 +228,31 @@ class WormFromTableSimple():
         # get the apropiate index in the object array
         ind_ff = timestamp_inds - first_frame
 
-        # get the number of segments from the normalized skeleton
         with tables.File(self.file_name, 'r') as ske_file_id:
+            # get the number of segments from the normalized skeleton
             self.n_segments = ske_file_id.get_node('/skeleton').shape[1]
  
-        # add the data from the skeleton_id's and timestamps used
-        self.timestamp = np.arange(first_frame, last_frame + 1)
-        
-        self.skeleton_id = np.full(n_frames, -1, np.int32)
-        self.skeleton_id[ind_ff] = skel_table_id
-        
-        # initialize the rest of the arrays
-        self.skeleton = np.full((n_frames, self.n_segments, 2), np.nan)
-        self.ventral_contour = np.full((n_frames, self.n_segments, 2), np.nan)
-        self.dorsal_contour = np.full((n_frames, self.n_segments, 2), np.nan)
-        self.widths = np.full((n_frames, self.n_segments), np.nan)
+            # add the data from the skeleton_id's and timestamps used
+            self.timestamp = np.arange(first_frame, last_frame + 1)
+            
+            self.skeleton_id = np.full(n_frames, -1, np.int32)
+            self.skeleton_id[ind_ff] = skel_table_id
+            
+            # initialize the rest of the arrays
+            self.skeleton = np.full((n_frames, self.n_segments, 2), np.nan)
+            self.ventral_contour = np.full((n_frames, self.n_segments, 2), np.nan)
+            self.dorsal_contour = np.full((n_frames, self.n_segments, 2), np.nan)
+            self.widths = np.full((n_frames, self.n_segments), np.nan)
 
-        # read data from the skeletons table
-        with tables.File(self.file_name, 'r') as ske_file_id:
+            # read data from the skeletons table
             self.skeleton[ind_ff] = \
-            ske_file_id.get_node('/skeleton')[skel_table_id, :, :] * self.microns_per_pixel
+            _h_read_rows(ske_file_id.get_node('/skeleton'), skel_table_id) * self.microns_per_pixel
             self.ventral_contour[ind_ff] = \
-            ske_file_id.get_node('/contour_side1')[skel_table_id, :, :] * self.microns_per_pixel
+            _h_read_rows(ske_file_id.get_node('/contour_side1'), skel_table_id) * self.microns_per_pixel
             self.dorsal_contour[ind_ff] = \
-            ske_file_id.get_node('/contour_side2')[skel_table_id, :, :] * self.microns_per_pixel
+            _h_read_rows(ske_file_id.get_node('/contour_side2'), skel_table_id) * self.microns_per_pixel
             self.widths[ind_ff] = \
-            ske_file_id.get_node('/contour_width')[skel_table_id, :] * self.microns_per_pixel
+            _h_read_rows(ske_file_id.get_node('/contour_width'), skel_table_id) * self.microns_per_pixel
             
             
     def _h_assert_data_dim(self):
@@ -311,8 +381,12 @@ class WormFromTable(WormFromTableSimple):
 
 class WormStats():
 
-    def __init__(self):
-        '''get the info for each feature chategory'''
+    def __init__(self, feat_names=None):
+        '''get the info for each feature chategory
+        
+        feat_names - if given, only this features (either the name of the feature or of any of its 
+                    subdivisions, e.g. 'length' or 'length_forward') are calculated. The rest are set to nan.
+        '''
         
         feat_names_file = os.path.join(AUX_FILES_DIR, 'features_names.csv')
         #feat_names_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'aux', 'features_names.csv')
@@ -334,9 +408,36 @@ class WormStats():
         self.feat_events = list(
             self.features_info[
                 self.features_info['is_time_series'] == 0].index.values)
+        
+        self.setSelectedFeatures(feat_names)
+    
+    def setSelectedFeatures(self, feat_names=None):
+        '''
+        Select the features to calculate and the openworm features that must be requested to WormFeatures 
+        (only these ones and their dependencies are calculated).
+        '''
+        if feat_names is None:
+            self.feat_selected = set(self.features_info.index)
+            self.openworm_specs = 'all'
+            return
+        
+        feat_selected = set()
+        for feat in feat_names:
+            if feat in self.features_info.index:
+                feat_selected.add(feat)
+            elif feat in self.feat_avg2base:
+                feat_selected.add(self.feat_avg2base[feat])
+            else:
+                raise KeyError('{} is not a valid openworm feature. Only the names in features_names.csv (or their subdivisions) are supported.'.format(feat))
+        self.feat_selected = feat_selected
+        
+        #the motion mode is always required to subdivide the timeseries
+        feat_objs = self.features_info.loc[self.features_info.index.isin(feat_selected), 'feat_name_obj']
+        self.openworm_specs = ['locomotion.motion_mode'] + [x for x in feat_objs if x != 'locomotion.motion_mode']
 
     def builtFeatAvgNames(self):
         feat_avg_names = self.extra_fields[:]
+        feat_avg2base = {}
         for feat_name, feat_info in self.features_info.iterrows():
 
             motion_types = ['']
@@ -346,11 +447,14 @@ class WormStats():
             for mtype in motion_types:
                 sub_name = feat_name + mtype
                 feat_avg_names.append(sub_name)
+                feat_avg2base[sub_name] = feat_name
                 if feat_info['is_signed']:
                     for atype in ['_abs', '_neg', '_pos']:
                         feat_avg_names.append(sub_name + atype)
+                        feat_avg2base[sub_name + atype] = feat_name
 
         self.feat_avg_names = feat_avg_names
+        self.feat_avg2base = feat_avg2base
 
     def getFieldData(worm_features, name):
         data = worm_features
@@ -366,6 +470,14 @@ class WormStats():
 
             Return the feature list as an ordered dictionary.
         '''
+        return self.getWormStatsMulti(worm_features, {'stat' : stat_func})['stat']
+    
+    def getWormStatsMulti(self, worm_features, stat_funcs):
+        ''' Same as getWormStats but for a dictionary of stat_funcs. The subdivisions
+            of each feature are calculated only once and shared by all the functions.
+
+            Return a dictionary with a recarray for each key in stat_funcs.
+        '''
         
         if isinstance(worm_features, (dict, pd.DataFrame)):
             def read_feat(feat_name):
@@ -386,28 +498,32 @@ class WormStats():
 
 
         # return data as a numpy recarray
-        feat_stats = np.full(1, np.nan, dtype=self.feat_avg_dtype)
+        feats_stats = {key : np.full(1, np.nan, dtype=self.feat_avg_dtype) for key in stat_funcs}
         
         for feat_name, feat_props in self.features_info.iterrows():
+            if not feat_name in self.feat_selected:
+                continue
+            
             tmp_data = read_feat(feat_name)
             if tmp_data is None:
-                feat_stats[feat_name] = np.nan
+                continue
 
             elif isinstance(tmp_data, (int, float)):
-                feat_stats[feat_name] = tmp_data
+                for feat_stats in feats_stats.values():
+                    feat_stats[feat_name] = tmp_data
 
             else:
-                feat_avg = self._featureStat(
-                    stat_func,
+                feat_subdivisions = self._featureSubdivide(
                     tmp_data,
                     feat_name,
                     feat_props['is_signed'],
                     feat_props['is_time_series'],
                     motion_mode)
-                for feat_avg_name in feat_avg:
-                    feat_stats[feat_avg_name] = feat_avg[feat_avg_name]
+                for key, stat_func in stat_funcs.items():
+                    for feat_avg_name, valid_data in feat_subdivisions.items():
+                        feats_stats[key][feat_avg_name] = stat_func(valid_data)
 
-        return feat_stats
+        return feats_stats
 
     @staticmethod
     def _featureStat(
@@ -419,6 +535,20 @@ class WormStats():
             motion_mode=np.zeros(0)):
         # I prefer to keep this function quite independend and pass the stats and moition_mode argument
         # rather than save those values in the class
+        feat_subdivisions = WormStats._featureSubdivide(data, name, is_signed, is_time_series, motion_mode)
+        stats = OrderedDict()
+        for sub_name, valid_data in feat_subdivisions.items():
+            stats[sub_name] = stat_func(valid_data)
+        return stats
+    
+    @staticmethod
+    def _featureSubdivide(
+            data,
+            name,
+            is_signed,
+            is_time_series,
+            motion_mode=np.zeros(0)):
+        #get the valid data of each of the subdivisions of the feature
         if data is None:
             data = np.zeros(0)
 
@@ -438,7 +568,7 @@ class WormStats():
             motion_types['paused'] = motion_mode == 0
             motion_types['backward'] = motion_mode == -1
 
-        stats = OrderedDict()
+        subdivisions = OrderedDict()
         for key in motion_types:
             
             if key == 'all':
@@ -451,18 +581,18 @@ class WormStats():
 
             assert not np.any(np.isnan(valid_data))
             
-            stats[sub_name] = stat_func(valid_data)
+            subdivisions[sub_name] = valid_data
             if is_signed:
                 # if the feature is signed we can subdivide in positive,
                 # negative and absolute
-                stats[sub_name + '_abs'] = stat_func(np.abs(valid_data))
+                subdivisions[sub_name + '_abs'] = np.abs(valid_data)
 
                 neg_valid = (valid_data < 0)
-                stats[sub_name + '_neg'] = stat_func(valid_data[neg_valid])
+                subdivisions[sub_name + '_neg'] = valid_data[neg_valid]
 
                 pos_valid = (valid_data > 0) 
-                stats[sub_name + '_pos'] = stat_func(valid_data[pos_valid])
-        return stats
+                subdivisions[sub_name + '_pos'] = valid_data[pos_valid]
+        return subdivisions
                 
 if __name__ == '__main__':
     
@@ -14,7 +14,7 @@ from scipy.interpolate import interp1d
 from tierpsy.features.tierpsy_features import SmoothedWorm
 from tierpsy.features.tierpsy_features.food import _h_smooth_cnt
 
-from tierpsy.analysis.feat_create.obtainFeaturesHelper import WormFromTable
+from tierpsy.analysis.feat_create.obtainFeaturesHelper import WormFromTable, WormTableIndex
 from tierpsy.analysis.stage_aligment.alignStageMotion import _h_get_stage_inv
 
 from tierpsy.helper.misc import TimeCounter, print_flush, get_base_name, TABLE_FILTERS
@@ -253,6 +253,9 @@ def smooth_skeletons_table(skeletons_file,
                 filters=TABLE_FILTERS)
             
     
+        # read the trajectories table only once for all the worms
+        table_index = WormTableIndex(skeletons_file, 'worm_index_joined')
+
         tot_skeletons = 0
         for ind_n, (worm_index, worm_data) in enumerate(trajectories_data_g):
             if worm_data['was_skeletonized'].sum() < 2:
@@ -260,7 +263,8 @@ def smooth_skeletons_table(skeletons_file,
             
             worm = WormFromTable(skeletons_file,
                                 worm_index,
-                                worm_index_type = 'worm_index_joined'
+                                worm_index_type = 'worm_index_joined',
+                                table_index = table_index
                                 )
         
             if is_WT2:
@@ -5,6 +5,9 @@ Created on Tue Sep  5 18:31:24 2017
 
 @author: ajaver
 """
+import multiprocessing as mp
+from functools import partial
+
 import numpy as np
 import pandas as pd
 import tables
@@ -12,12 +15,76 @@ import tables
 from tierpsy.features.tierpsy_features import get_timeseries_features, timeseries_all_columns
 from tierpsy.features.tierpsy_features.summary_stats import get_summary_stats
 
-from tierpsy.helper.misc import TimeCounter, print_flush, get_base_name, TABLE_FILTERS
+from tierpsy.helper.misc import TimeCounter, print_flush, get_base_name, TABLE_FILTERS, imap_ordered_pool
 from tierpsy.helper.params import read_fps, read_ventral_side
 
 from tierpsy.analysis.split_fov.FOVMultiWellsSplitter import FOVMultiWellsSplitter
+from tierpsy.analysis.feat_create.obtainFeaturesHelper import _h_read_rows
+
+def _h_read_worm_coords(fid, worm_data):
+    skel_id = worm_data['skeleton_id'].values
+    
+    #deal with any nan in the skeletons
+    good_id = skel_id>=0
+    skel_id_val = skel_id[good_id]
+    traj_size = skel_id.size
+
+    args = []
+    for p in ('skeletons', 'widths', 'dorsal_contours', 'ventral_contours'):
+        
+        node_str = '/coordinates/' + p
+        if node_str in fid:
+            node = fid.get_node(node_str)
+            dat = np.full((traj_size, *node.shape[1:]), np.nan)
+            if skel_id_val.size > 0:
+                dat[good_id] = _h_read_rows(node, skel_id_val)
+        else:
+            dat = None
+        
+        args.append(dat)
+    return args
+
+def _h_get_worm_timeseries_feats(worm_input, food_cnt, fps, ventral_side, derivate_delta_time):
+    # calculate the features of a single worm. It is executed by the workers if n_cores_used > 1
+    worm_index, well_name, timestamp, args = worm_input
+
+    feats = get_timeseries_features(*args, 
+                                   timestamp = timestamp,
+                                   food_cnt = food_cnt,
+                                   fps = fps,
+                                   ventral_side = ventral_side,
+                                   derivate_delta_time = derivate_delta_time
+                                   )
+    #save timeseries features data
+    feats = feats.astype(np.float32)
+    feats['worm_index'] = worm_index
+    feats['well_name'] = well_name
+    # cast well_name to the correct type 
+    # (before shuffling columns, so it remains the last entry)
+    # needed because for some reason this does not work:
+    # feats['well_name'] = feats['well_name'].astype('S3')
+    feats['_well_name'] = feats['well_name'].astype('S3')
+    feats.drop(columns='well_name', inplace=True)
+    feats.rename(columns={'_well_name':'well_name'}, inplace=True)
+    
+    #move the last fields to the first columns
+    cols = feats.columns.tolist()
+    cols = cols[-2:] + cols[:-2]
+    cols[1], cols[2] = cols[2], cols[1]
+    
+    feats = feats[cols]
+    
+    feats['worm_index'] = feats['worm_index'].astype(np.int32)
+    feats['timestamp'] = feats['timestamp'].astype(np.int32)
+    feats = feats.to_records(index=False)
+    return feats
 
-def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param={}):
+def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param={}, n_cores_used=1):
+    '''
+    Calculate the tierpsy timeseries features of each worm and save them in /timeseries_data.
+    If n_cores_used > 1 the worms are processed by a pool of processes. At most 2*n_cores_used 
+    worms are sent to the pool before their results are saved, so the memory is bounded.
+    '''
     timeseries_features = []
     fps = read_fps(features_file)
     
@@ -62,98 +129,78 @@ def save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_
             ' Total time:' +
             progress_timer.get_time_str())
     
-    _display_progress(0)
-    with tables.File(features_file, 'r+') as fid:
+    #the pool must be created before opening the features file, so the workers do not inherit its handle
+    pool = mp.Pool(n_cores_used) if n_cores_used > 1 else None
+    is_finished = False
+    try:
+        _display_progress(0)
+        with tables.File(features_file, 'r+') as fid:
         
-        for gg in ['/timeseries_data', '/event_durations', '/timeseries_features']:
-            if gg in fid:
-                fid.remove_node(gg)
+            for gg in ['/timeseries_data', '/event_durations', '/timeseries_features']:
+                if gg in fid:
+                    fid.remove_node(gg)
                 
         
-        feat_dtypes = [(x, np.float32) for x in timeseries_all_columns]
+            feat_dtypes = [(x, np.float32) for x in timeseries_all_columns]
             
-        feat_dtypes = [('worm_index', np.int32),
-                       ('timestamp', np.int32),
-                       ('well_name', 'S3')] + feat_dtypes 
+            feat_dtypes = [('worm_index', np.int32),
+                           ('timestamp', np.int32),
+                           ('well_name', 'S3')] + feat_dtypes 
                        
-        timeseries_features = fid.create_table(
-                '/',
-                'timeseries_data',
-                obj = np.recarray(0, feat_dtypes),
-                filters = TABLE_FILTERS)
+            timeseries_features = fid.create_table(
+                    '/',
+                    'timeseries_data',
+                    obj = np.recarray(0, feat_dtypes),
+                    filters = TABLE_FILTERS)
         
-        if '/food_cnt_coord' in fid:
-            food_cnt = fid.get_node('/food_cnt_coord')[:]
-        else:
-            food_cnt = None
-    
-        #If i find the ventral side in the multiworm case this has to change
-        ventral_side = read_ventral_side(features_file)
-            
-        for ind_n, (worm_index, worm_data) in enumerate(trajectories_data_g):
-
-            skel_id = worm_data['skeleton_id'].values
-            
-            #deal with any nan in the skeletons
-            good_id = skel_id>=0
-            skel_id_val = skel_id[good_id]
-            traj_size = skel_id.size
-
-            args = []
-            for p in ('skeletons', 'widths', 'dorsal_contours', 'ventral_contours'):
-                
-                node_str = '/coordinates/' + p
-                if node_str in fid:
-                    node = fid.get_node(node_str)
-                    dat = np.full((traj_size, *node.shape[1:]), np.nan)
-                    if skel_id_val.size > 0:
-                        if len(node.shape) == 3:
-                            dd = node[skel_id_val, :, :]
-                        else:
-                            dd = node[skel_id_val, :]
-                        dat[good_id] = dd
-                else:
-                    dat = None
-                
-                args.append(dat)
-
-            timestamp = worm_data['timestamp_raw'].values.astype(np.int32)
-            
-            feats = get_timeseries_features(*args, 
-                                           timestamp = timestamp,
-                                           food_cnt = food_cnt,
-                                           fps = fps,
-                                           ventral_side = ventral_side,
-                                           derivate_delta_time = derivate_delta_time
-                                           )
-            #save timeseries features data
-            feats = feats.astype(np.float32)
-            feats['worm_index'] = worm_index
-            if is_fov_tosplit:
-                feats['well_name'] = fovsplitter.find_well_from_trajectories_data(worm_data)
+            if '/food_cnt_coord' in fid:
+                food_cnt = fid.get_node('/food_cnt_coord')[:]
             else:
-                feats['well_name'] = 'n/a'
-            # cast well_name to the correct type 
-            # (before shuffling columns, so it remains the last entry)
-            # needed because for some reason this does not work:
-            # feats['well_name'] = feats['well_name'].astype('S3')
-            feats['_well_name'] = feats['well_name'].astype('S3')
-            feats.drop(columns='well_name', inplace=True)
-            feats.rename(columns={'_well_name':'well_name'}, inplace=True)
-            
-            #move the last fields to the first columns
-            cols = feats.columns.tolist()
-            cols = cols[-2:] + cols[:-2]
-            cols[1], cols[2] = cols[2], cols[1]
-            
-            feats = feats[cols]
-            
-            feats['worm_index'] = feats['worm_index'].astype(np.int32)
-            feats['timestamp'] = feats['timestamp'].astype(np.int32)
-            feats = feats.to_records(index=False)
+                food_cnt = None
     
-            timeseries_features.append(feats)
-            _display_progress(ind_n)
+            #If i find the ventral side in the multiworm case this has to change
+            ventral_side = read_ventral_side(features_file)
+        
+            def _worms_input_generator():
+                #the data is read in the main process since pytables is not process safe
+                for worm_index, worm_data in trajectories_data_g:
+                    args = _h_read_worm_coords(fid, worm_data)
+                    timestamp = worm_data['timestamp_raw'].values.astype(np.int32)
+                    if is_fov_tosplit:
+                        well_name = fovsplitter.find_well_from_trajectories_data(worm_data)
+                    else:
+                        well_name = 'n/a'
+                    yield worm_index, well_name, timestamp, args
+        
+            f_worm_feats = partial(_h_get_worm_timeseries_feats, 
+                                   food_cnt = food_cnt,
+                                   fps = fps,
+                                   ventral_side = ventral_side,
+                                   derivate_delta_time = derivate_delta_time
+                                   )
+        
+            if pool is not None:
+                feats_generator = imap_ordered_pool(pool, 
+                                                    f_worm_feats, 
+                                                    _worms_input_generator(), 
+                                                    max_pending = 2*n_cores_used)
+            else:
+                feats_generator = map(f_worm_feats, _worms_input_generator())
+        
+            for ind_n, feats in enumerate(feats_generator):
+                timeseries_features.append(feats)
+                _display_progress(ind_n)
+        
+            #index the timestamp so the summaries of a time window only read the rows they need
+            timeseries_features.cols.timestamp.create_csindex()
+        is_finished = True
+    finally:
+        if pool is not None:
+            if is_finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
             
 
 def save_feats_stats(features_file, derivate_delta_time):
@@ -231,9 +278,9 @@ def save_feats_stats(features_file, derivate_delta_time):
 
 
             
-def get_tierpsy_features(features_file, derivate_delta_time = 1/3, fovsplitter_param={}):
+def get_tierpsy_features(features_file, derivate_delta_time = 1/3, fovsplitter_param={}, n_cores_used=1):
     #I am adding this so if I add the parameters to calculate the features i can pass it to this function
-    save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param)
+    save_timeseries_feats_table(features_file, derivate_delta_time, fovsplitter_param, n_cores_used)
     save_feats_stats(features_file, derivate_delta_time)
     
 
@@ -12,6 +12,7 @@ import pandas as pd
 import tables
 from scipy.interpolate import RectBivariateSpline
 from scipy.interpolate import interp1d
+from scipy.interpolate import make_interp_spline
 from scipy.signal import savgol_filter
 
 from tierpsy.analysis.ske_create.helperIterROI import getWormROI
@@ -24,19 +25,22 @@ def smoothSkeletons(
         length_resampling=131,
         smooth_win=11,
         pol_degree=3):
-    xx = savgol_filter(skeleton[:, 0], smooth_win, pol_degree)
-    yy = savgol_filter(skeleton[:, 1], smooth_win, pol_degree)
+    '''
+    Smooth and resample a skeleton (n_points, 2) or a stack of skeletons (n_skeletons, n_points, 2).
+    '''
+    xx = savgol_filter(skeleton[..., 0], smooth_win, pol_degree, axis=-1)
+    yy = savgol_filter(skeleton[..., 1], smooth_win, pol_degree, axis=-1)
 
-    ii = np.arange(xx.size)
-    ii_new = np.linspace(0, xx.size - 1, length_resampling)
+    ii = np.arange(xx.shape[-1])
+    ii_new = np.linspace(0, xx.shape[-1] - 1, length_resampling)
 
-    fx = interp1d(ii, xx)
-    fy = interp1d(ii, yy)
+    fx = interp1d(ii, xx, axis=-1)
+    fy = interp1d(ii, yy, axis=-1)
 
     xx_new = fx(ii_new)
     yy_new = fy(ii_new)
 
-    skel_new = np.vstack((xx_new, yy_new)).T
+    skel_new = np.stack((xx_new, yy_new), axis=-1)
     return skel_new
 
 
@@ -88,6 +92,133 @@ def getStraightenWormInt(worm_img, skeleton, half_width, width_resampling):
     return straighten_worm, grid_x, grid_y
 
 
+def _h_get_spline_matrix(n_points):
+    '''
+    Matrix that maps the values in a regular grid of n_points to the coefficients of the
+    cubic spline that interpolates them, and the knots of the spline. The knots are the
+    "not-a-knot" ones used by RectBivariateSpline with s=0, so the splines are the same
+    ones fitted in getStraightenWormInt.
+    '''
+    spl = make_interp_spline(np.arange(n_points), np.eye(n_points), k=3)
+    return spl.c, spl.t
+
+
+def _h_get_bspline_basis(knots, x, n_coeffs):
+    '''
+    Values of the four cubic b-splines that are not zero at each point in x, and the index
+    of the first of them. As in FITPACK, points outside the knots are moved to the border.
+    '''
+    x = np.clip(x, knots[0], knots[-1])
+    ind = np.searchsorted(knots, x, side='right') - 1
+    ind = np.clip(ind, 3, n_coeffs - 1)
+
+    #de Boor recursion
+    basis = [np.ones_like(x)]
+    left = [None]
+    right = [None]
+    for j in range(1, 4):
+        left.append(x - knots[ind + 1 - j])
+        right.append(knots[ind + j] - x)
+        saved = 0.
+        for r in range(j):
+            term = basis[r] / (right[r + 1] + left[j - r])
+            basis[r] = saved + right[r + 1] * term
+            saved = left[j - r] * term
+        basis.append(saved)
+
+    return basis, ind - 3
+
+
+def getStraightenWormIntBatch(worm_imgs, skeletons, half_widths, width_resampling):
+    '''
+        Vectorized version of getStraightenWormInt for several worms with ROIs of the same size.
+        worm_imgs - stack of images (n_worms, n_rows, n_cols) containing the worms
+        skeletons - smoothed skeletons (n_worms, length_resampling, 2)
+        half_widths - half width of each worm
+        width_resampling - number of data points used in the intensity map along the worm width
+
+        Returns the stack of straighten worms (n_worms, width_resampling, length_resampling).
+    '''
+    assert not np.any(np.isnan(skeletons))
+
+    dX = np.diff(skeletons[..., 0], axis=1)
+    dY = np.diff(skeletons[..., 1], axis=1)
+
+    skel_angles = np.arctan2(dY, dX)
+    skel_angles = np.concatenate((skel_angles[:, :1], skel_angles), axis=1)
+    perp_angles = skel_angles - np.pi / 2
+
+    r_ind = np.linspace(-half_widths, half_widths, width_resampling, axis=1)
+
+    # (n_worms, width_resampling, length_resampling)
+    grid_x = skeletons[:, np.newaxis, :, 0] + r_ind[..., np.newaxis] * np.cos(perp_angles)[:, np.newaxis, :]
+    grid_y = skeletons[:, np.newaxis, :, 1] + r_ind[..., np.newaxis] * np.sin(perp_angles)[:, np.newaxis, :]
+
+    # spline coefficients of all the worms
+    n_worms, n_rows, n_cols = worm_imgs.shape
+    coeffs_y, knots_y = _h_get_spline_matrix(n_rows)
+    coeffs_x, knots_x = _h_get_spline_matrix(n_cols)
+    coeffs = np.matmul(np.matmul(coeffs_y, worm_imgs.astype(np.float64)), coeffs_x.T)
+
+    # evaluate the splines at the grid points
+    basis_y, ind_y = _h_get_bspline_basis(knots_y, grid_y, n_rows)
+    basis_x, ind_x = _h_get_bspline_basis(knots_x, grid_x, n_cols)
+
+    coeffs = coeffs.ravel()
+    ind_first = (np.arange(n_worms)[:, np.newaxis, np.newaxis] * n_rows + ind_y) * n_cols + ind_x
+    straighten_worms = np.zeros(grid_x.shape)
+    for iy in range(4):
+        row_int = np.zeros(grid_x.shape)
+        for ix in range(4):
+            row_int += basis_x[ix] * coeffs[ind_first + (iy * n_cols + ix)]
+        straighten_worms += basis_y[iy] * row_int
+
+    return straighten_worms
+
+
+class ChunkedRowsWriter():
+    '''
+    Write rows given in any order into a chunked pytables array. The rows are kept in
+    memory until all the rows of their chunk are ready, and then the whole chunk is written at once.
+    rows_frame - frame number of each row of the array. A chunk is written by flush(frame_number)
+    once frame_number is larger or equal to the frames of all its rows.
+    '''
+    def __init__(self, dataset, rows_frame):
+        self.dataset = dataset
+        self.chunk_size = dataset.chunkshape[0]
+
+        chunk_starts = np.arange(0, dataset.shape[0], self.chunk_size)
+        chunks_last_frame = np.maximum.reduceat(rows_frame, chunk_starts)
+        self.flush_order = np.argsort(chunks_last_frame, kind='stable')
+        self.flush_frames = chunks_last_frame[self.flush_order]
+        self.tot_flushed = 0
+        self.buffers = {}
+
+    def add(self, rows, data):
+        chunk_ids = rows // self.chunk_size
+        for chunk_id in np.unique(chunk_ids):
+            if not chunk_id in self.buffers:
+                ini = chunk_id * self.chunk_size
+                n_rows = min(self.chunk_size, self.dataset.shape[0] - ini)
+                self.buffers[chunk_id] = np.full((n_rows,) + self.dataset.shape[1:],
+                                                np.nan, self.dataset.dtype)
+            good = chunk_ids == chunk_id
+            self.buffers[chunk_id][rows[good] - chunk_id * self.chunk_size] = data[good]
+
+    def flush(self, frame_number=None):
+        if frame_number is None:
+            tot = self.flush_frames.size
+        else:
+            tot = np.searchsorted(self.flush_frames, frame_number, side='right')
+
+        for chunk_id in self.flush_order[self.tot_flushed:tot]:
+            buf = self.buffers.pop(chunk_id, None)
+            if buf is not None:
+                ini = chunk_id * self.chunk_size
+                self.dataset[ini:ini + buf.shape[0]] = buf
+        self.tot_flushed = max(self.tot_flushed, tot)
+
+
 def getWidthWinLimits(width_resampling, width_percentage):
     # let's calculate the window along the minor axis of the skeleton to be
     # average, as a percentage of the total interpolated width
@@ -151,7 +282,8 @@ def getIntensityProfile(
         smooth_win=11,
         pol_degree=3,
         width_percentage=0.5,
-        save_maps=False):
+        save_maps=False,
+        frames_block_size=64):
     
     min_num_skel = min_num_skel_defaults(skeletons_file, min_num_skel=min_num_skel)
 
@@ -211,7 +343,8 @@ def getIntensityProfile(
         filters = tables.Filters(complevel=5, complib='zlib', shuffle=True)
 
         # we are using Float16 to save space, I am assuing the intensities are
-        # between uint8
+        # between uint8. The rows are written in chunks of ~64kB (see ChunkedRowsWriter).
+        chunk_rows = int(max(1, min(tot_rows, 2**15 // length_resampling)))
         worm_int_avg_tab = int_file_id.create_carray(
             "/",
             "straighten_worm_intensity_median",
@@ -220,14 +353,20 @@ def getIntensityProfile(
             (tot_rows,
              length_resampling),
             chunkshape=(
-                1,
+                chunk_rows,
                 length_resampling),
             filters=table_filters)
 
         worm_int_avg_tab._v_attrs['has_finished'] = 0
         worm_int_avg_tab.attrs['width_win_ind'] = width_win_ind
 
+        # the rows are ordered by worm, so they must be buffered until their chunk is complete
+        rows_frame = trajectories_data_valid['frame_number'].values
+        rows_frame = rows_frame[np.argsort(trajectories_data_valid['int_map_id'].values)]
+        writers = [ChunkedRowsWriter(worm_int_avg_tab, rows_frame)]
+
         if save_maps:
+            chunk_rows = int(max(1, min(tot_rows, 2**15 // (length_resampling*width_resampling))))
             worm_int_tab = int_file_id.create_carray(
                 "/",
                 "straighten_worm_intensity",
@@ -237,57 +376,87 @@ def getIntensityProfile(
                  length_resampling,
                  width_resampling),
                 chunkshape=(
-                    1,
+                    chunk_rows,
                     length_resampling,
                     width_resampling),
                 filters=table_filters)
+            writers.append(ChunkedRowsWriter(worm_int_tab, rows_frame))
+
+        # sort the rows by frame
+        trajectories_data_valid = trajectories_data_valid.sort_values(
+            by=['frame_number', 'int_map_id'])
+        frame_numbers = trajectories_data_valid['frame_number'].values
+        skeleton_ids = trajectories_data_valid['skeleton_id'].values.astype(np.int64)
+        int_map_ids = trajectories_data_valid['int_map_id'].values.astype(np.int64)
+        coord_x = trajectories_data_valid['coord_x'].values
+        coord_y = trajectories_data_valid['coord_y'].values
+        roi_sizes = trajectories_data_valid['roi_size'].values
+
+        frames, frames_ini = np.unique(frame_numbers, return_index=True)
+        frames_fin = np.append(frames_ini[1:], frame_numbers.size)
 
-        grouped_frames = trajectories_data_valid.groupby('frame_number')
         # variables used to report progress
         base_name = skeletons_file.rpartition(
             '.')[0].rpartition(os.sep)[-1].rpartition('_')[0]
-        progressTime = TimeCounter('Obtaining intensity maps.', len(grouped_frames))
-
-        for frame, frame_data in grouped_frames:
-            img = mask_dataset[frame, :, :]
-            for ii, row_data in frame_data.iterrows():
-                skeleton_id = int(row_data['skeleton_id'])
-                worm_index = int(row_data['worm_index_joined'])
-                int_map_id = int(row_data['int_map_id'])
-
-                # read ROI and skeleton, and put them in the same coordinates
-                # map
-                worm_img, roi_corner = getWormROI(
-                    img, row_data['coord_x'], row_data['coord_y'], row_data['roi_size'])
-                skeleton = skel_tab[skeleton_id, :, :] - roi_corner
-
-                half_width = skel_width_tab[skeleton_id] / 2
-                assert not np.isnan(skeleton[0, 0])
-
-                skel_smooth = smoothSkeletons(
-                    skeleton,
-                    length_resampling=length_resampling,
-                    smooth_win=smooth_win,
-                    pol_degree=pol_degree)
-                straighten_worm, grid_x, grid_y = getStraightenWormInt(
-                    worm_img, skel_smooth, half_width=half_width, width_resampling=width_resampling)
-
-                # if you use the mean it is better to do not use float16
-                int_avg = np.median(
-                    straighten_worm[
-                        width_win_ind[0]:width_win_ind[1],
-                        :],
-                    axis=0)
-
-                worm_int_avg_tab[int_map_id] = int_avg
-
-                # only save the full map if it is specified by the user
-                if save_maps:
-                    worm_int_tab[int_map_id] = straighten_worm.T
-
-            if frame % 500 == 0:
-                progress_str = progressTime.get_str(frame)
-                print_flush(base_name + ' ' + progress_str)
+        progressTime = TimeCounter('Obtaining intensity maps.', len(frames))
+
+        for block_ini in range(0, len(frames), frames_block_size):
+            block_fin = min(block_ini + frames_block_size, len(frames))
+            rows_ini, rows_fin = frames_ini[block_ini], frames_fin[block_fin - 1]
+
+            # preload the skeletons of all the frames in the block
+            skel_ids = skeleton_ids[rows_ini:rows_fin]
+            skel_ids_s, skel_ids_inv = np.unique(skel_ids, return_inverse=True)
+            skel_ids_s = skel_ids_s.tolist() # a list so pytables uses a fancy selection
+            skeletons = skel_tab[skel_ids_s, :, :][skel_ids_inv]
+            half_widths = skel_width_tab[skel_ids_s][skel_ids_inv].astype(np.float64) / 2
+            assert not np.any(np.isnan(skeletons[:, 0, 0]))
+
+            for iframe in range(block_ini, block_fin):
+                frame = frames[iframe]
+                img = mask_dataset[frame, :, :]
+
+                # read ROIs and put the skeletons in the same coordinates map
+                # ROIs with the same size are processed together
+                rois_by_shape = {}
+                for irow in range(frames_ini[iframe], frames_fin[iframe]):
+                    worm_img, roi_corner = getWormROI(
+                        img, coord_x[irow], coord_y[irow], roi_sizes[irow])
+                    rois_by_shape.setdefault(worm_img.shape, []).append((irow - rows_ini, worm_img, roi_corner))
+
+                for rois_data in rois_by_shape.values():
+                    ind, worm_imgs, roi_corners = map(np.array, zip(*rois_data))
+                    skels_smooth = smoothSkeletons(
+                        skeletons[ind] - roi_corners[:, np.newaxis, :],
+                        length_resampling=length_resampling,
+                        smooth_win=smooth_win,
+                        pol_degree=pol_degree)
+                    straighten_worms = getStraightenWormIntBatch(
+                        worm_imgs, skels_smooth, half_widths[ind], width_resampling=width_resampling)
+
+                    # if you use the mean it is better to do not use float16
+                    int_avg = np.median(
+                        straighten_worms[:,
+                            width_win_ind[0]:width_win_ind[1],
+                            :],
+                        axis=1)
+
+                    map_ids = int_map_ids[rows_ini + ind]
+                    writers[0].add(map_ids, int_avg)
+
+                    # only save the full map if it is specified by the user
+                    if save_maps:
+                        writers[1].add(map_ids, np.transpose(straighten_worms, (0, 2, 1)))
+
+                if frame % 500 == 0:
+                    progress_str = progressTime.get_str(frame)
+                    print_flush(base_name + ' ' + progress_str)
+
+            for writer in writers:
+                writer.flush(frames[block_fin - 1])
+
+        for writer in writers:
+            writer.flush()
 
         worm_int_avg_tab._v_attrs['has_finished'] = 1
 
@@ -18,8 +18,78 @@ from tierpsy.helper.misc import RESERVED_EXT
 
 model_path = '/Users/avelinojaver/OneDrive - Nexus365/worms/bertie_worms_l1_20181210_162006_unet_adam_lr0.0001_wd0.0_batch16.pth.tar'
 
-def _add_bgnd(fname, _model_path = model_path, _int_scale = (0, 255), cuda_id = 0):
+def _tiles_limits(size, tile_size, tile_pad):
+    '''
+    Split a dimension in tiles of tile_size. Each tile is predicted using a window with 
+    tile_pad extra pixels of context on each side. All the windows have the same size
+    (they are shifted to stay inside the image), so they can be stacked in a batch.
+    Returns a list of (window_ini, output_ini, output_end).
+    '''
+    win_size = tile_size + 2*tile_pad
+    if tile_size <= 0 or win_size >= size:
+        return [(0, 0, size)]
     
+    limits = []
+    for ini in range(0, size, tile_size):
+        win_ini = min(max(ini - tile_pad, 0), size - win_size)
+        limits.append((win_ini, ini, min(ini + tile_size, size)))
+    return limits
+
+def _predict_batch(model, X, device, batch_size):
+    #X is a numpy array with shape (n, 1, height, width) already normalized
+    out = np.empty_like(X)
+    with torch.no_grad():
+        for ini in range(0, X.shape[0], batch_size):
+            xb = torch.from_numpy(X[ini:ini + batch_size]).to(device)
+            out[ini:ini + batch_size] = model(xb).cpu().numpy()
+    return out
+
+def _predict_frames(model, imgs, device, batch_size, tile_size, tile_pad, _int_scale):
+    n_imgs, img_h, img_w = imgs.shape
+    
+    #normalize in place in the float32 array that is passed to the model
+    X = np.empty((n_imgs, 1, img_h, img_w), np.float32)
+    X[:, 0] = imgs
+    X -= _int_scale[0]
+    X /= (_int_scale[1] - _int_scale[0])
+    
+    if tile_size <= 0:
+        xhat = _predict_batch(model, X, device, batch_size)[:, 0]
+    else:
+        tiles_h = _tiles_limits(img_h, tile_size, tile_pad)
+        tiles_w = _tiles_limits(img_w, tile_size, tile_pad)
+        win_h = min(img_h, tile_size + 2*tile_pad)
+        win_w = min(img_w, tile_size + 2*tile_pad)
+        
+        tiles = [(ii, th, tw) for ii in range(n_imgs) for th in tiles_h for tw in tiles_w]
+        X_tiles = np.stack([X[ii, :, th[0]:th[0] + win_h, tw[0]:tw[0] + win_w] for ii, th, tw in tiles])
+        
+        xhat_tiles = _predict_batch(model, X_tiles, device, batch_size)[:, 0]
+        
+        #only keep the center of each window
+        xhat = np.empty((n_imgs, img_h, img_w), np.float32)
+        for (ii, (wh, h_ini, h_end), (ww, w_ini, w_end)), xt in zip(tiles, xhat_tiles):
+            xhat[ii, h_ini:h_end, w_ini:w_end] = xt[h_ini - wh:h_end - wh, w_ini - ww:w_end - ww]
+    
+    xhat *= (_int_scale[1] - _int_scale[0])
+    xhat += _int_scale[0]
+    return xhat.round().astype(imgs.dtype)
+
+def _add_bgnd(fname, 
+              _model_path = model_path, 
+              _int_scale = (0, 255), 
+              cuda_id = 0,
+              batch_size = 4,
+              tile_size = -1,
+              tile_pad = 64,
+              n_threads = -1
+              ):
+    '''
+    batch_size - number of frames (or tiles if tile_size > 0) passed to the model at once.
+    tile_size - if larger than zero the frames are split in tiles of this size, with tile_pad pixels 
+                of context on each side. Useful to keep the memory bounded in the cpu.
+    n_threads - number of threads used by torch (-1 uses the torch default).
+    '''
     if torch.cuda.is_available():
         print("THIS IS CUDA!!!!")
         dev_str = "cuda:" + str(cuda_id)
@@ -27,6 +97,9 @@ def _add_bgnd(fname, _model_path = model_path, _int_scale = (0, 255), cuda_id =
         dev_str = 'cpu'
     device = torch.device(dev_str)
     
+    if n_threads > 0:
+        torch.set_num_threads(n_threads)
+    
     model = UNet(n_channels = 1, n_classes = 1)
     state = torch.load(_model_path, map_location = 'cpu')
     model.load_state_dict(state['state_dict'])
@@ -39,27 +112,33 @@ def _add_bgnd(fname, _model_path = model_path, _int_scale = (0, 255), cuda_id =
         
         if '/bgnd' in fid:
             fid.remove_node('/bgnd')
-            
+        
+        imgs = full_data[:]
+        bgnd_data = np.empty_like(imgs)
+        
+        #consecutive identical full frames give the same background, only calculate the first one.
+        is_new = np.ones(imgs.shape[0], bool)
+        is_new[1:] = [not np.array_equal(x, y) for x, y in zip(imgs[1:], imgs[:-1])]
+        new_inds = np.where(is_new)[0]
+        
+        #use blocks of batch_size frames to keep the memory of the float arrays bounded
+        frames_per_block = max(1, batch_size)
+        for ini in tqdm.trange(0, len(new_inds), frames_per_block):
+            inds = new_inds[ini:ini + frames_per_block]
+            bgnd_data[inds] = _predict_frames(model, 
+                                               imgs[inds], 
+                                               device, 
+                                               batch_size, 
+                                               tile_size, 
+                                               tile_pad, 
+                                               _int_scale)
+        
+        #copy the results of the repeated frames
+        bgnd_data = bgnd_data[np.maximum.accumulate(np.where(is_new, np.arange(imgs.shape[0]), 0))]
+        
         bgnd = createImgGroup(fid, "/bgnd", *full_data.shape, is_expandable = False)
         bgnd._v_attrs['save_interval'] = full_data._v_attrs['save_interval']
-        
-        for ii in tqdm.trange(full_data.shape[0]):
-            img = full_data[ii]
-            
-            x = img.astype(np.float32)
-            x = (x - _int_scale[0])/(_int_scale[1] - _int_scale[0])
-            
-            
-            with torch.no_grad():
-                X = torch.from_numpy(x[None, None])
-                X = X.to(device)
-                Xhat = model(X)
-            
-            xhat = Xhat.squeeze().detach().cpu().numpy()
-            
-            bg = xhat*(_int_scale[1] - _int_scale[0]) + _int_scale[0]
-            bg = bg.round().astype(img.dtype)
-            bgnd[ii] = bg
+        bgnd[:] = bgnd_data
 
 if __name__ == '__main__':
     
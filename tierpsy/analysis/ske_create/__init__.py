@@ -19,7 +19,8 @@ def args_(fn, param):
         'min_blob_area': p['traj_min_area'],
         'strel_size': p['strel_size'],
         'analysis_type': p['analysis_type'],
-        'skel_args' : skel_args
+        'skel_args' : skel_args,
+        'n_cores_used' : p['n_cores_used']
         }
 
     #arguments used by AnalysisPoints.py
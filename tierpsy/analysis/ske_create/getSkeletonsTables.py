@@ -13,6 +13,9 @@ Created on Fri Mar 13 19:39:41 2015
 """
 import json
 import os
+import multiprocessing as mp
+from functools import partial
+from itertools import starmap
 
 import cv2
 import numpy as np
@@ -22,7 +25,7 @@ import tables
 from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI
 from tierpsy.analysis.ske_create.segWormPython.mainSegworm import getSkeleton, resampleAll
 from tierpsy.analysis.ske_create.zebrafishAnalysis import zebrafishAnalysis, zebrafishSkeleton
-from tierpsy.helper.misc import TABLE_FILTERS
+from tierpsy.helper.misc import TABLE_FILTERS, iter_prefetch
 
 def _zebra_func(worm_img, skel_args, resampling_N):
     # Get zebrafish mask
@@ -233,6 +236,63 @@ def _initSkeletonsArrays(ske_file_id, tot_rows, resampling_N, worm_midbody):
 
 
 
+def _skeletonize_worm_rois(worm_rois, 
+                           prev_skeleton, 
+                           is_light_background, 
+                           strel_size, 
+                           resampling_N, 
+                           analysis_type, 
+                           skel_args):
+    '''
+    Skeletonize the ROIs (worm_img, threshold, area) of a single worm. The ROIs must be sorted by 
+    frame since the previous skeleton is used to orient the next one.
+    -> Used by trajectories2Skeletons
+    '''
+    outputs = []
+    for worm_img, threshold, area in worm_rois:
+        if analysis_type == "ZEBRAFISH":
+             output = _zebra_func(worm_img, skel_args, resampling_N)
+        else:
+            _, worm_cnt, _ = getWormMask(worm_img, 
+                                         threshold, 
+                                         strel_size,
+                                         min_blob_area=area / 2, 
+                                         is_light_background = is_light_background)
+            # get skeletons
+            output = getSkeleton(worm_cnt, prev_skeleton, resampling_N, **skel_args)
+        
+        if output is not None and output[0].size > 0:
+            prev_skeleton = output[0].copy()
+        else:
+            output = None
+        outputs.append(output)
+    
+    return outputs, prev_skeleton
+
+def _generateWormsBatches(ROIs_generator, worm_indexes, batch_size):
+    '''
+    Group the ROIs of consecutive frames by worm. A batch is yielded 
+    each time it contains at least batch_size ROIs.
+    -> Used by trajectories2Skeletons
+    '''
+    batch = {}
+    n_rois = 0
+    for worms_in_frame in ROIs_generator:
+        for ind, (worm_img, roi_corner) in worms_in_frame.items():
+            worm_index = worm_indexes[ind]
+            if worm_index not in batch:
+                batch[worm_index] = []
+            batch[worm_index].append((ind, worm_img, roi_corner))
+        
+        n_rois += len(worms_in_frame)
+        if n_rois >= batch_size:
+            yield batch
+            batch = {}
+            n_rois = 0
+    
+    if batch:
+        yield batch
+
 def trajectories2Skeletons(skeletons_file, 
                             masked_image_file,
                             resampling_N=49, 
@@ -241,7 +301,9 @@ def trajectories2Skeletons(skeletons_file,
                             worm_midbody=(0.35, 0.65),
                             analysis_type="WORM", 
                             skel_args = {'num_segments' : 24, 
-                                         'head_angle_thresh' : 60}
+                                         'head_angle_thresh' : 60},
+                            n_cores_used = 1,
+                            batch_size = 2000
                             ):
     
     #get the index number for the width limit
@@ -252,6 +314,13 @@ def trajectories2Skeletons(skeletons_file,
     with pd.HDFStore(skeletons_file, 'r') as ske_file_id:
         trajectories_data = ske_file_id['/trajectories_data']
     
+    #the rows are accessed using numpy arrays, make sure the index is the same as the row number
+    trajectories_data = trajectories_data.reset_index(drop=True)
+    skeleton_ids = trajectories_data['skeleton_id'].values.astype(np.int64)
+    worm_indexes = trajectories_data['worm_index_joined'].values
+    thresholds = trajectories_data['threshold'].values
+    areas = trajectories_data['area'].values
+    
     # extract the base name from the masked_image_file. This is used in the
     # progress status.
     base_name = masked_image_file.rpartition('.')[0].rpartition(os.sep)[-1]
@@ -259,102 +328,118 @@ def trajectories2Skeletons(skeletons_file,
         
     
     
-    # open skeleton file for append and #the compressed videos as read
-    with tables.File(skeletons_file, "r+") as ske_file_id:
-
-        #attribute useful to understand if we are dealing with dark or light worms
-        bgnd_param = ske_file_id.get_node('/trajectories_data')._v_attrs['bgnd_param']
-        bgnd_param = json.loads(bgnd_param.decode("utf-8"))
-
-        is_light_background = ske_file_id.get_node('/trajectories_data')._v_attrs['is_light_background']
-        if len(bgnd_param) > 0:
-            #invert (at least if is_light_background is true)
-            is_light_background = not is_light_background
+    #the pool must be created before opening the skeletons file, so the workers do not inherit its handle
+    pool = mp.Pool(n_cores_used) if n_cores_used > 1 else None
+    is_finished = False
+    try:
+        # open skeleton file for append and #the compressed videos as read
+        with tables.File(skeletons_file, "r+") as ske_file_id:
+
+            #attribute useful to understand if we are dealing with dark or light worms
+            bgnd_param = ske_file_id.get_node('/trajectories_data')._v_attrs['bgnd_param']
+            bgnd_param = json.loads(bgnd_param.decode("utf-8"))
+
+            is_light_background = ske_file_id.get_node('/trajectories_data')._v_attrs['is_light_background']
+            if len(bgnd_param) > 0:
+                #invert (at least if is_light_background is true)
+                is_light_background = not is_light_background
 
         
-        #get generators to get the ROI for each frame
-        ROIs_generator = generateMoviesROI(masked_image_file, 
-                                         trajectories_data, 
-                                         bgnd_param = bgnd_param,
-                                         progress_prefix = progress_prefix)
-
-        # add data from the experiment info (currently only for singleworm)
-        with tables.File(masked_image_file, "r") as mask_fid:  
-            if '/experiment_info' in ske_file_id:
-                    ske_file_id.remove_node('/', 'experiment_info')
-            if '/experiment_info' in mask_fid:
-                dd = mask_fid.get_node('/experiment_info').read()
-                ske_file_id.create_array('/', 'experiment_info', obj=dd)
+            #get generators to get the ROI for each frame
+            ROIs_generator = generateMoviesROI(masked_image_file, 
+                                             trajectories_data, 
+                                             bgnd_param = bgnd_param,
+                                             progress_prefix = progress_prefix)
+
+            # add data from the experiment info (currently only for singleworm)
+            with tables.File(masked_image_file, "r") as mask_fid:  
+                if '/experiment_info' in ske_file_id:
+                        ske_file_id.remove_node('/', 'experiment_info')
+                if '/experiment_info' in mask_fid:
+                    dd = mask_fid.get_node('/experiment_info').read()
+                    ske_file_id.create_array('/', 'experiment_info', obj=dd)
         
                 
-        #initialize arrays to save the skeletons data
-        tot_rows = len(trajectories_data)
-#        skel_arrays, has_skeleton = _initSkeletonsArrays(ske_file_id, 
-        skel_arrays, has_skeleton, inram_skel_arrays = _initSkeletonsArrays(ske_file_id, 
-                                                                                tot_rows, 
-                                                                                resampling_N, 
-                                                                                worm_midbody)
+            #initialize arrays to save the skeletons data
+            tot_rows = len(trajectories_data)
+    #        skel_arrays, has_skeleton = _initSkeletonsArrays(ske_file_id, 
+            skel_arrays, has_skeleton, inram_skel_arrays = _initSkeletonsArrays(ske_file_id, 
+                                                                                    tot_rows, 
+                                                                                    resampling_N, 
+                                                                                    worm_midbody)
+            inram_has_skeleton = has_skeleton[:]
         
-        # dictionary to store previous skeletons
-        prev_skeleton = {}
+            # dictionary to store previous skeletons
+            prev_skeleton = {}
         
-        for worms_in_frame in ROIs_generator:
-            for ind, roi_dat in worms_in_frame.items():
-                row_data = trajectories_data.loc[ind]
-                worm_img, roi_corner = roi_dat
-                skeleton_id = int(row_data['skeleton_id'])
-                
-                # get the previous worm skeletons to orient them
-                worm_index = row_data['worm_index_joined']
-                if worm_index not in prev_skeleton:
-                    prev_skeleton[worm_index] = np.zeros(0)
-
-                if analysis_type == "ZEBRAFISH":
-                     output = _zebra_func(worm_img, skel_args, resampling_N)
-                else:
-                    _, worm_cnt, _ = getWormMask(worm_img, 
-                                                 row_data['threshold'], 
-                                                 strel_size,
-                                                 min_blob_area=row_data['area'] / 2, 
-                                                 is_light_background = is_light_background)
-                    # get skeletons
-                    output = getSkeleton(worm_cnt, prev_skeleton[worm_index], resampling_N, **skel_args)
-
-                
-                
+            f_skel = partial(_skeletonize_worm_rois, 
+                             is_light_background = is_light_background, 
+                             strel_size = strel_size, 
+                             resampling_N = resampling_N, 
+                             analysis_type = analysis_type, 
+                             skel_args = skel_args)
+        
+            batches_generator = _generateWormsBatches(ROIs_generator, worm_indexes, batch_size)
+        
+            if pool is not None:
+                # read the ROIs of the next batch while the current batch is skeletonized
+                batches_generator = iter_prefetch(batches_generator, max_size=1)
+        
+            try:
+                for batch in batches_generator:
+                    worms_inputs = []
+                    for worm_index, worm_rois in batch.items():
+                        worm_data = [(worm_img, thresholds[ind], areas[ind]) for ind, worm_img, _ in worm_rois]
+                        worms_inputs.append((worm_data, prev_skeleton.get(worm_index, np.zeros(0))))
+            
+                    if pool is not None:
+                        worms_outputs = pool.starmap(f_skel, worms_inputs)
+                    else:
+                        worms_outputs = starmap(f_skel, worms_inputs)
+            
+                    for (worm_index, worm_rois), (outputs, worm_prev_skeleton) in zip(batch.items(), worms_outputs):
+                        # keep the last skeleton to orient the ROIs of this worm in the next batch
+                        prev_skeleton[worm_index] = worm_prev_skeleton
                 
-                if output is not None and output[0].size > 0:
-                    skeleton, ske_len, cnt_side1, cnt_side2, cnt_widths, cnt_area = output
-                    prev_skeleton[worm_index] = skeleton.copy()
-
-                    #mark row as a valid skeleton
-                    has_skeleton[skeleton_id] = True
+                        for (ind, _, roi_corner), output in zip(worm_rois, outputs):
+                            if output is None:
+                                continue
+                    
+                            skeleton_id = skeleton_ids[ind]
+                            skeleton, ske_len, cnt_side1, cnt_side2, cnt_widths, cnt_area = output
+                    
+                            #mark row as a valid skeleton
+                            inram_has_skeleton[skeleton_id] = True
                     
-                    # save segwrom_results
-#                    skel_arrays['skeleton_length'][skeleton_id] = ske_len
-#                    skel_arrays['contour_width'][skeleton_id, :] = cnt_widths
-                    inram_skel_arrays['skeleton_length'][skeleton_id] = ske_len
-                    inram_skel_arrays['contour_width'][skeleton_id, :] = cnt_widths
+                            # save segwrom_results
+                            inram_skel_arrays['skeleton_length'][skeleton_id] = ske_len
+                            inram_skel_arrays['contour_width'][skeleton_id, :] = cnt_widths
                     
-                    mid_width = np.median(cnt_widths[midbody_ind[0]:midbody_ind[1]+1])
-#                    skel_arrays['width_midbody'][skeleton_id] = mid_width
-                    inram_skel_arrays['width_midbody'][skeleton_id] = mid_width
-
-                    # convert into the main image coordinates
-#                    skel_arrays['skeleton'][skeleton_id, :, :] = skeleton + roi_corner
-#                    skel_arrays['contour_side1'][skeleton_id, :, :] = cnt_side1 + roi_corner
-#                    skel_arrays['contour_side2'][skeleton_id, :, :] = cnt_side2 + roi_corner
-#                    skel_arrays['contour_area'][skeleton_id] = cnt_area
-                    inram_skel_arrays['skeleton'][skeleton_id, :, :] = skeleton + roi_corner
-                    inram_skel_arrays['contour_side1'][skeleton_id, :, :] = cnt_side1 + roi_corner
-                    inram_skel_arrays['contour_side2'][skeleton_id, :, :] = cnt_side2 + roi_corner
-                    inram_skel_arrays['contour_area'][skeleton_id] = cnt_area
-#        import pdb
-#        pdb.set_trace()
+                            mid_width = np.median(cnt_widths[midbody_ind[0]:midbody_ind[1]+1])
+                            inram_skel_arrays['width_midbody'][skeleton_id] = mid_width
+
+                            # convert into the main image coordinates
+                            inram_skel_arrays['skeleton'][skeleton_id, :, :] = skeleton + roi_corner
+                            inram_skel_arrays['contour_side1'][skeleton_id, :, :] = cnt_side1 + roi_corner
+                            inram_skel_arrays['contour_side2'][skeleton_id, :, :] = cnt_side2 + roi_corner
+                            inram_skel_arrays['contour_area'][skeleton_id] = cnt_area
+
+            finally:
+                #stop the reading thread (if any) before the files are closed
+                batches_generator.close()
         
-#         now write on disk
-        for key in inram_skel_arrays:
-            skel_arrays[key][:] = inram_skel_arrays[key].astype(np.float32)
+    #         now write on disk
+            has_skeleton[:] = inram_has_skeleton
+            for key in inram_skel_arrays:
+                skel_arrays[key][:] = inram_skel_arrays[key].astype(np.float32)
+        is_finished = True
+    finally:
+        if pool is not None:
+            if is_finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
         
 if __name__ == '__main__':
     
@@ -122,17 +122,28 @@ def generateMoviesROI(masked_file,
                                        frames = frames, 
                                        bgnd_param = bgnd_param)
         
-        traj_group_by_frame = trajectories_data.groupby('frame_number')
+        #rows of each frame. I use numpy arrays rather than pandas since accessing rows in pandas is slow
+        rows_by_frame = trajectories_data.groupby('frame_number').indices
+        rows_index = trajectories_data.index.values
+        coord_x = trajectories_data['coord_x'].values
+        coord_y = trajectories_data['coord_y'].values
+        if roi_size > 0:
+            rois_size = np.full(len(trajectories_data), roi_size)
+        else:
+            rois_size = trajectories_data['roi_size'].values
+        
         progress_time = TimeCounter(progress_prefix, max(frames))
         
         fps = read_fps(masked_file, dflt=25)
         progress_refresh_rate = int(round(fps*progress_refresh_rate_s))
 
         for ii, (current_frame, img) in enumerate(img_generator):
-            frame_data = traj_group_by_frame.get_group(current_frame)
-            
             #dictionary where keys are the table row and the values the worms ROIs
-            yield getAllImgROI(img, frame_data, roi_size)
+            worms_in_frame = {}
+            for irow in rows_by_frame[current_frame]:
+                worms_in_frame[rows_index[irow]] = getWormROI(img, coord_x[irow], coord_y[irow], rois_size[irow])
+            
+            yield worms_in_frame
             
             if current_frame % progress_refresh_rate == 0:
                 print_flush(progress_time.get_str(current_frame))
@@ -207,10 +207,244 @@ def _h_calcArea(cnt):
     signed_area = np.sum(cnt[:-1, 0] * cnt[1:, 1] - cnt[1:, 0] * cnt[:-1, 1])
     return np.abs(signed_area / 2)
 
+def _h_isGoodSkel(
+        skeleton,
+        contour_side1,
+        contour_side2,
+        contour_width,
+        ht_limits,
+        max_width_ratio,
+        max_area_ratio):
+    '''
+    Check if a single skeleton is likely to be a coil. 
+    It is used by filterPossibleCoils for the skeletons that are not clearly
+    classified by _h_isGoodSkelBlock.
+    '''
+    # the idea is that when the worm coils and there is an skeletons, it is
+    # likely to be a cnonsequence of the head/tail protuding, therefore we can
+    # use the head/tail withd to get a good ratio of the worm width
+
+    # calculate head and tail width
+    head_w = contour_width[ht_limits]
+    tail_w = contour_width[-ht_limits]
+    midbody_w = np.max(contour_width)
+
+    '''
+    Does the worm more than double its width from the head/tail?
+    Note: if the worm coils, its width will grow to more than
+    double that at the end of the head.
+    '''
+    if midbody_w / head_w > max_width_ratio or midbody_w / \
+            tail_w > max_width_ratio or max(head_w / tail_w, tail_w / head_w) > max_width_ratio:
+        return False
+
+    # calculate the head and tail area (it is an approximation the
+    # limits are not super well defined, but it is enough for
+    # filtering)
+    head_skel_lim = skeleton[np.newaxis, ht_limits]
+    tail_skel_lim = skeleton[np.newaxis, -ht_limits]
+
+    cnt_side1_ind_h, cnt_side2_ind_h = _h_getPerpContourInd(
+        skeleton, ht_limits, contour_side1, contour_side2, contour_width)
+    cnt_side1_ind_t, cnt_side2_ind_t = _h_getPerpContourInd(
+        skeleton, -ht_limits, contour_side1, contour_side2, contour_width)
+
+    if cnt_side1_ind_h > cnt_side1_ind_t or cnt_side2_ind_h > cnt_side2_ind_t or \
+    np.any(np.isnan([cnt_side1_ind_h, cnt_side2_ind_h, cnt_side1_ind_t, cnt_side2_ind_t])):    
+        return False
+
+    cnt_head = np.concatenate((contour_side1[:cnt_side1_ind_h + 1], head_skel_lim,
+                                   contour_side2[:cnt_side2_ind_h + 1][::-1]))
+
+    cnt_tail = np.concatenate(
+        (contour_side2[cnt_side2_ind_t:][::-1],
+            tail_skel_lim,
+            contour_side1[cnt_side1_ind_t:]))
+
+    area_head = _h_calcArea(cnt_head)
+    area_tail = _h_calcArea(cnt_tail)
+
+    '''Is the tail too small (or the head too large)?
+    Note: the area of the head and tail should be roughly the same size.
+    A 2-fold difference is huge!
+    '''
+    if area_tail == 0 or area_head == 0 or area_head / \
+            area_tail > max_width_ratio or area_tail / area_head > max_width_ratio:
+        return False
+
+    # calculate the area of the rest of the body
+    cnt_rest = np.concatenate(
+        (head_skel_lim,
+         contour_side1[
+             cnt_side1_ind_h:cnt_side1_ind_t + 1],
+            tail_skel_lim,
+            contour_side2[
+             cnt_side2_ind_h:cnt_side2_ind_t + 1][
+             ::-1],
+            head_skel_lim))
+    area_rest = _h_calcArea(cnt_rest)
+
+    '''
+    Are the head and tail too small (or the body too large)?
+    Note: earlier, the head and tail were each chosen to be 4/24 = 1/6
+    the body length of the worm. The head and tail are roughly shaped
+    like rounded triangles with a convex taper. And, the width at their
+    ends is nearly the width at the center of the worm. Imagine they were
+    2 triangles that, when combined, formed a rectangle similar to the
+    midsection of the worm. The area of this rectangle would be greater
+    than a 1/6 length portion from the midsection of the worm (the
+    maximum area per length in a worm is located at its midsection). The
+    combined area of the right and left sides is 4/6 of the worm.
+    Therefore, the combined area of the head and tail must be greater
+    than (1/6) / (4/6) = 1/4 the combined area of the left and right
+    sides.
+    '''
+    if area_rest / (area_head + area_tail) > max_area_ratio:
+        return False
+    
+    return True
+
+def _h_getPerpContourIndBlock(
+        skeletons,
+        skel_ind,
+        contour_side1s,
+        contour_side2s,
+        contour_widths):
+    '''
+    Vectorized version of _h_getPerpContourInd over a block of skeletons.
+    Returns the contour indexes and a flag of the rows where they are valid.
+    '''
+    dR = skeletons[:, skel_ind + 1] - skeletons[:, skel_ind - 1]
+    a = -dR[:, 0:1]
+    b = +dR[:, 1:2]
+    skel_point = skeletons[:, skel_ind]
+    c = b * skel_point[:, 1:2] - a * skel_point[:, 0:1]
+    
+    max_width_squared = np.max(contour_widths, axis=1)[:, None]**2
+    
+    def _get_ind(contour_sides):
+        dist2cnt = np.sum((contour_sides - skel_point[:, None, :])**2, axis=2)
+        d = np.abs(a * contour_sides[..., 0] - b * contour_sides[..., 1] + c)
+        d[dist2cnt > max_width_squared] = np.nan
+        
+        is_valid = ~np.all(np.isnan(d), axis=1)
+        d[np.isnan(d)] = np.inf
+        return np.argmin(d, axis=1), is_valid
+    
+    cnt1_ind, is_valid1 = _get_ind(contour_side1s)
+    cnt2_ind, is_valid2 = _get_ind(contour_side2s)
+    return cnt1_ind, cnt2_ind, is_valid1 & is_valid2
+
+def _h_isGoodSkelBlock(
+        skeletons,
+        contour_side1s,
+        contour_side2s,
+        contour_widths,
+        ht_limits,
+        max_width_ratio,
+        max_area_ratio):
+    '''
+    Vectorized version of _h_isGoodSkel over a block of skeletons. 
+    The width and contour index tests are done with the same operations as 
+    _h_isGoodSkel so their results are identical. The areas are calculated 
+    using cumulative sums, so their rounding errors are different. The 
+    rows where the area tests are closer to the limits than the possible 
+    rounding errors are returned as ambiguous and must be checked with _h_isGoodSkel.
+    '''
+    n_skels = skeletons.shape[0]
+    rows = np.arange(n_skels)
+    
+    #width test
+    head_w = contour_widths[:, ht_limits]
+    tail_w = contour_widths[:, -ht_limits]
+    midbody_w = np.max(contour_widths, axis=1)
+    
+    ht_ratio = head_w / tail_w
+    th_ratio = tail_w / head_w
+    #same as the builtin max(ht_ratio, th_ratio) even with nan
+    max_ratio = np.where(th_ratio > ht_ratio, th_ratio, ht_ratio)
+    is_good = ~((midbody_w / head_w > max_width_ratio) | 
+                (midbody_w / tail_w > max_width_ratio) | 
+                (max_ratio > max_width_ratio))
+    
+    #contour indexes test
+    h1, h2, is_valid_h = _h_getPerpContourIndBlock(
+            skeletons, ht_limits, contour_side1s, contour_side2s, contour_widths)
+    t1, t2, is_valid_t = _h_getPerpContourIndBlock(
+            skeletons, -ht_limits, contour_side1s, contour_side2s, contour_widths)
+    is_good &= is_valid_h & is_valid_t & (h1 <= t1) & (h2 <= t2)
+    
+    #areas using the shoelace formula. The terms between consecutive points of each side 
+    #are accumulated so the area of any segment can be obtained by a subtraction.
+    cnt1 = contour_side1s.astype(np.float64)
+    cnt2 = contour_side2s.astype(np.float64)
+    head_p = skeletons[:, ht_limits].astype(np.float64)
+    tail_p = skeletons[:, -ht_limits].astype(np.float64)
+    
+    def _cross(u, v):
+        return u[..., 0]*v[..., 1] - v[..., 0]*u[..., 1]
+    
+    def _cross_abs(u, v):
+        return np.abs(u[..., 0]*v[..., 1]) + np.abs(v[..., 0]*u[..., 1])
+    
+    def _cumsum0(x):
+        return np.concatenate((np.zeros((x.shape[0], 1)), np.cumsum(x, axis=1)), axis=1)
+    
+    S1 = _cumsum0(_cross(cnt1[:, :-1], cnt1[:, 1:]))
+    S2 = _cumsum0(_cross(cnt2[:, :-1], cnt2[:, 1:]))
+    SA1 = _cumsum0(_cross_abs(cnt1[:, :-1], cnt1[:, 1:]))
+    SA2 = _cumsum0(_cross_abs(cnt2[:, :-1], cnt2[:, 1:]))
+    
+    #use valid indexes in the rows that are already discarded
+    h1, h2, t1, t2 = [np.where(is_good, x, 0) for x in (h1, h2, t1, t2)]
+    c1_h, c2_h = cnt1[rows, h1], cnt2[rows, h2]
+    c1_t, c2_t = cnt1[rows, t1], cnt2[rows, t2]
+    
+    # cnt_head = side1[:h1+1], head, side2[:h2+1][::-1]
+    head_sum = S1[rows, h1] + _cross(c1_h, head_p) + _cross(head_p, c2_h) - S2[rows, h2]
+    head_abs = SA1[rows, h1] + _cross_abs(c1_h, head_p) + _cross_abs(head_p, c2_h) + SA2[rows, h2]
+    head_n = h1 + h2 + 2
+    
+    # cnt_tail = side2[t2:][::-1], tail, side1[t1:]
+    last = cnt1.shape[1] - 1
+    tail_sum = -(S2[:, -1] - S2[rows, t2]) + _cross(c2_t, tail_p) + _cross(tail_p, c1_t) + (S1[:, -1] - S1[rows, t1])
+    tail_abs = (SA2[:, -1] - SA2[rows, t2]) + _cross_abs(c2_t, tail_p) + _cross_abs(tail_p, c1_t) + (SA1[:, -1] - SA1[rows, t1])
+    tail_n = 2*last - t1 - t2 + 2
+    
+    # cnt_rest = head, side1[h1:t1+1], tail, side2[h2:t2+1][::-1], head
+    rest_sum = _cross(head_p, c1_h) + (S1[rows, t1] - S1[rows, h1]) + _cross(c1_t, tail_p) + \
+                _cross(tail_p, c2_t) - (S2[rows, t2] - S2[rows, h2]) + _cross(c2_h, head_p)
+    rest_abs = _cross_abs(head_p, c1_h) + (SA1[rows, t1] - SA1[rows, h1]) + _cross_abs(c1_t, tail_p) + \
+                _cross_abs(tail_p, c2_t) + (SA2[rows, t2] - SA2[rows, h2]) + _cross_abs(c2_h, head_p)
+    rest_n = (t1 - h1) + (t2 - h2) + 4
+    
+    area_head, area_tail, area_rest = [np.abs(x)/2 for x in (head_sum, tail_sum, rest_sum)]
+    
+    #generous bound of the rounding errors of the float32 calculation in _h_calcArea
+    eps = np.finfo(np.float32).eps
+    err_head, err_tail, err_rest = [2*(n + 4)*eps*x/2 for x, n in 
+                                    ((head_abs, head_n), (tail_abs, tail_n), (rest_abs, rest_n))]
+    
+    is_bad_area = (area_head / area_tail > max_width_ratio) | \
+                (area_tail / area_head > max_width_ratio) | \
+                (area_rest / (area_head + area_tail) > max_area_ratio)
+    
+    is_ambiguous = (area_head <= err_head) | (area_tail <= err_tail) | \
+        (np.abs(area_head - max_width_ratio*area_tail) <= err_head + max_width_ratio*err_tail) | \
+        (np.abs(area_tail - max_width_ratio*area_head) <= err_tail + max_width_ratio*err_head) | \
+        (np.abs(area_rest - max_area_ratio*(area_head + area_tail)) <= err_rest + max_area_ratio*(err_head + err_tail)) | \
+        ~np.isfinite(area_head + area_tail + area_rest)
+    
+    is_ambiguous &= is_good
+    is_good &= ~is_bad_area
+    
+    return is_good, is_ambiguous
+
 def filterPossibleCoils(
         skeletons_file,
         max_width_ratio=2.25,
-        max_area_ratio=6):
+        max_area_ratio=6,
+        block_size=10000):
     with pd.HDFStore(skeletons_file, 'r') as table_fid:
         trajectories_data = table_fid['/trajectories_data']
 
@@ -230,129 +464,32 @@ def filterPossibleCoils(
         sample_N = contour_widths.shape[1]
 
         ht_limits = int(round(sample_N / 6))
-        mid_limits = (int(round(3 * sample_N / 6)),
-                      int(round(4 * sample_N / 6)) + 1)
-
-        for skel_id in range(tot_skeletons):
-            if is_good_skel[skel_id] == 0:
-                continue
-
-            contour_width = contour_widths[skel_id]
-            contour_side1 = contour_side1s[skel_id]
-            contour_side2 = contour_side2s[skel_id]
-            skeleton = skeletons[skel_id]
-
-
-            #%%
-            edge_length = 8
-            p1 = contour_side1[:-edge_length]
-            p2 = contour_side1[edge_length:]
-
-            points = contour_side1[edge_length // 2:-edge_length // 2]
-            ang2 = np.arctan2(points[:, 0] - p2[:, 0], points[:, 1] - p2[:, 1])
-            ang1 = np.arctan2(p1[:, 0] - points[:, 0], p1[:, 1] - points[:, 1])
-            angles = ang2 - ang1
-
-            for i in range(angles.size):
-                if angles[i] > np.pi:
-                    angles[i] = angles[i] - 2 * np.pi
-                elif angles[i] < -np.pi:
-                    angles[i] = angles[i] + 2 * np.pi
-            angles = angles * 180 / np.pi
-
-            blurWin = np.full(edge_length, 1. / edge_length)
-            anglesb = np.convolve(angles, blurWin, 'same')
-            #%%
-            # the idea is that when the worm coils and there is an skeletons, it is
-            # likely to be a cnonsequence of the head/tail protuding, therefore we can
-            # use the head/tail withd to get a good ratio of the worm width
-
-            # calculate head and tail width
-            head_w = contour_width[ht_limits]
-            tail_w = contour_width[-ht_limits]
-            midbody_w = np.max(contour_width)
-
-            '''
-            Does the worm more than double its width from the head/tail?
-            Note: if the worm coils, its width will grow to more than
-            double that at the end of the head.
-            '''
-            if midbody_w / head_w > max_width_ratio or midbody_w / \
-                    tail_w > max_width_ratio or max(head_w / tail_w, tail_w / head_w) > max_width_ratio:
-                is_good_skel[skel_id] = 0
-                continue
-
-            # calculate the head and tail area (it is an approximation the
-            # limits are not super well defined, but it is enough for
-            # filtering)
-            head_skel_lim = skeleton[np.newaxis, ht_limits]
-            tail_skel_lim = skeleton[np.newaxis, -ht_limits]
-
-            cnt_side1_ind_h, cnt_side2_ind_h = _h_getPerpContourInd(
-                skeleton, ht_limits, contour_side1, contour_side2, contour_width)
-            cnt_side1_ind_t, cnt_side2_ind_t = _h_getPerpContourInd(
-                skeleton, -ht_limits, contour_side1, contour_side2, contour_width)
-
-            if cnt_side1_ind_h > cnt_side1_ind_t or cnt_side2_ind_h > cnt_side2_ind_t or \
-            np.any(np.isnan([cnt_side1_ind_h, cnt_side2_ind_h, cnt_side1_ind_t, cnt_side2_ind_t])):    
-                is_good_skel[skel_id] = 0
+        
+        #process the skeletons in blocks to avoid reading each row from the disk
+        for ini in range(0, tot_skeletons, block_size):
+            fin = min(ini + block_size, tot_skeletons)
+            skel_ids, = np.where(is_good_skel[ini:fin] != 0)
+            if skel_ids.size == 0:
                 continue
             
-            # if cnt_side1_ind_h>cnt_side1_ind_t:
-            #    cnt_side1_ind_h, cnt_side1_ind_t = cnt_side1_ind_t, cnt_side1_ind_h
-            # if cnt_side2_ind_h>cnt_side2_ind_t:
-            #    cnt_side2_ind_h, cnt_side2_ind_t = cnt_side2_ind_t, cnt_side2_ind_h
-
-            cnt_head = np.concatenate((contour_side1[:cnt_side1_ind_h + 1], head_skel_lim,
-                                           contour_side2[:cnt_side2_ind_h + 1][::-1]))
-
-            cnt_tail = np.concatenate(
-                (contour_side2[cnt_side2_ind_t:][::-1],
-                    tail_skel_lim,
-                    contour_side1[cnt_side1_ind_t:]))
-
-            area_head = _h_calcArea(cnt_head)
-            area_tail = _h_calcArea(cnt_tail)
-
-            '''Is the tail too small (or the head too large)?
-            Note: the area of the head and tail should be roughly the same size.
-            A 2-fold difference is huge!
-            '''
-            if area_tail == 0 or area_head == 0 or area_head / \
-                    area_tail > max_width_ratio or area_tail / area_head > max_width_ratio:
-                is_good_skel[skel_id] = 0
-                continue
-
-            # calculate the area of the rest of the body
-            cnt_rest = np.concatenate(
-                (head_skel_lim,
-                 contour_side1[
-                     cnt_side1_ind_h:cnt_side1_ind_t + 1],
-                    tail_skel_lim,
-                    contour_side2[
-                     cnt_side2_ind_h:cnt_side2_ind_t + 1][
-                     ::-1],
-                    head_skel_lim))
-            area_rest = _h_calcArea(cnt_rest)
-
-            '''
-            Are the head and tail too small (or the body too large)?
-            Note: earlier, the head and tail were each chosen to be 4/24 = 1/6
-            the body length of the worm. The head and tail are roughly shaped
-            like rounded triangles with a convex taper. And, the width at their
-            ends is nearly the width at the center of the worm. Imagine they were
-            2 triangles that, when combined, formed a rectangle similar to the
-            midsection of the worm. The area of this rectangle would be greater
-            than a 1/6 length portion from the midsection of the worm (the
-            maximum area per length in a worm is located at its midsection). The
-            combined area of the right and left sides is 4/6 of the worm.
-            Therefore, the combined area of the head and tail must be greater
-            than (1/6) / (4/6) = 1/4 the combined area of the left and right
-            sides.
-            '''
-            if area_rest / (area_head + area_tail) > max_area_ratio:
-                is_good_skel[skel_id] = 0
-                continue
+            block_data = [x[ini:fin][skel_ids] for x in 
+                          (skeletons, contour_side1s, contour_side2s, contour_widths)]
+            
+            with np.errstate(divide='ignore', invalid='ignore'):
+                is_good, is_ambiguous = _h_isGoodSkelBlock(*block_data, 
+                                                           ht_limits, 
+                                                           max_width_ratio, 
+                                                           max_area_ratio)
+                
+                #the rows near the limits are checked one by one
+                for ii in np.where(is_ambiguous)[0]:
+                    is_good[ii] = _h_isGoodSkel(*[x[ii] for x in block_data], 
+                                                ht_limits, 
+                                                max_width_ratio, 
+                                                max_area_ratio)
+            
+            is_good_skel[ini + skel_ids[~is_good]] = 0
+    
     trajectories_data['is_good_skel'] = is_good_skel
     save_modified_table(skeletons_file, trajectories_data, 'trajectories_data')
 
@@ -1,11 +1,11 @@
 import pandas as pd
-from functools import partial
 import numpy as np
 import tables
 import os
 
 try:
     from keras.models import load_model
+    import tensorflow as tf
 except ImportError:
     import warnings
     warnings.warn("`keras` is not found, this will break filter trajectories and contour finding on *_AEX analysis")
@@ -13,6 +13,7 @@ except ImportError:
 
 from tierpsy.analysis.ske_create.helperIterROI import generateMoviesROI, getROIFixSize
 from tierpsy.helper.params import read_fps
+from tierpsy.helper.misc import iter_prefetch
 
 def shift_and_normalize(data):
     '''
@@ -47,21 +48,47 @@ def getWormProba(worms_in_frame, roi_size, model):
     worms_roi_f = reformat_for_model(worm_imgs)
     worm_prob = model.predict(worms_roi_f, verbose=0)[:, 1]
     return indexes, worm_prob
-                
+
+def _iterROIBatches(ROIs_generator, roi_size, batch_size):
+    '''
+    Group the ROIs of consecutive frames in batches of batch_size (the last one can be smaller)
+    already formated for the model. Yields the table rows and the ROIs of each batch.
+    '''
+    batch_indexes, batch_imgs = [], []
+    n_rois = 0
+    for worms_in_frame in ROIs_generator:
+        indexes, worm_imgs, _ = getROIFixSize(worms_in_frame, roi_size)
+        batch_indexes.append(indexes)
+        batch_imgs.append(worm_imgs)
+        n_rois += len(indexes)
+        
+        while n_rois >= batch_size:
+            indexes = np.concatenate(batch_indexes)
+            worm_imgs = np.concatenate(batch_imgs)
+            yield indexes[:batch_size], reformat_for_model(worm_imgs[:batch_size])
+            
+            batch_indexes, batch_imgs = [indexes[batch_size:]], [worm_imgs[batch_size:]]
+            n_rois -= batch_size
+    
+    if n_rois > 0:
+        yield np.concatenate(batch_indexes), reformat_for_model(np.concatenate(batch_imgs))
                 
 def indentifyValidWorms(masked_file, 
                          trajectories_data,
                          model_path, 
-                         frame_subsampling):
+                         frame_subsampling,
+                         batch_size = 256):
     ''' Use a pre-trained nn to identify blobs that correspond to worms or worm aggregates 
     
         frame_subsamplig - number of frames skipped. We do not need to calculate in 
                             every frame. A value of near the number of fps is sensible.
+        batch_size - number of ROIs, collected across frames, passed to the model at once.
     '''
-    model = load_model(model_path)
+    #the model is small, the overhead of moving the data to a GPU is not worth it.
+    with tf.device('/cpu:0'):
+        model = load_model(model_path)
 
     roi_size = model.input_shape[2]
-    proba_func = partial(getWormProba, roi_size=roi_size, model=model)
     
     frame_numbers = trajectories_data['frame_number'].unique()
 
@@ -78,13 +105,18 @@ def indentifyValidWorms(masked_file,
                                          roi_size=roi_size,
                                          progress_prefix=progress_prefix)
     
-    worm_probs_gen = map(proba_func, ROIs_generator)
+    #the frames are read and the ROIs are prepared in a background thread while the model runs
+    batches_gen = iter_prefetch(_iterROIBatches(ROIs_generator, roi_size, batch_size), max_size=2)
     
     #here we really execute the code
-    out_per_frame = [x for x in worm_probs_gen]
+    out_per_batch = []
+    with tf.device('/cpu:0'):
+        for indexes, worms_roi_f in batches_gen:
+            worm_prob = model.predict(worms_roi_f, batch_size=batch_size, verbose=0)[:, 1]
+            out_per_batch.append((indexes, worm_prob))
     
     #pull all the outputs into a nice format and add the results into the table
-    indexes, worm_probs = [np.concatenate(x) for x in zip(*out_per_frame)]
+    indexes, worm_probs = [np.concatenate(x) for x in zip(*out_per_batch)]
     trajectories_data_rec['worm_prob'] = pd.Series(worm_probs, indexes)
     
     worm_ind_prob = trajectories_data_rec.groupby('worm_index_joined').aggregate({'worm_prob':np.median})['worm_prob']
@@ -92,7 +124,7 @@ def indentifyValidWorms(masked_file,
     
     return valid_worms_indexes
 
-def filterModelWorms(masked_image_file, trajectories_data, model_path, frame_subsampling = -1):
+def filterModelWorms(masked_image_file, trajectories_data, model_path, frame_subsampling = -1, batch_size = 256):
     if frame_subsampling ==-1:
         #use the expected number of frames per seconds as the subsampling period 
         frame_subsampling = read_fps(masked_image_file)
@@ -101,7 +133,8 @@ def filterModelWorms(masked_image_file, trajectories_data, model_path, frame_sub
     valid_worms = indentifyValidWorms(masked_image_file, 
                                         trajectories_data,
                                         model_path,
-                                        frame_subsampling)
+                                        frame_subsampling,
+                                        batch_size)
     
     good_rows = trajectories_data['worm_index_joined'].isin(valid_worms)
     trajectories_data = trajectories_data[good_rows].copy()
@@ -5,7 +5,7 @@ def args_(fn, param):
     p = param.p_dict
     trajectories_param_f = ['traj_min_area', 'traj_min_box_width',
         'worm_bw_thresh_factor', 'strel_size', 'analysis_type', 'thresh_block_size',
-        'n_cores_used']
+        'n_cores_used', 'traj_n_threads']
     
 
     trajectories_param = {x.replace('traj_', ''):p[x] for x in trajectories_param_f}
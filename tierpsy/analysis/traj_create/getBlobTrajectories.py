@@ -8,6 +8,9 @@ from pathlib import Path
 import json
 import multiprocessing as mp
 import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import cv2
@@ -31,7 +34,9 @@ def _thresh_bw(pix_valid):
 
     # calculate the histogram
     pix_hist = np.bincount(pix_valid)
+    return _thresh_bw_refine(pix_hist, otsu_thresh)
 
+def _thresh_bw_refine(pix_hist, otsu_thresh):
     # the higher limit is the most frequent value in the distribution
     # (background)
     largest_peak = np.argmax(pix_hist)
@@ -66,6 +71,91 @@ def _thresh_bodywallmuscle(pix_valid):
         thresh = 255 - _thresh_bw(255 - pix_valid) #correct for fluorescence images
     return thresh
 
+def _otsu_from_hists(pix_hists):
+    '''
+    Vectorized version of skf.threshold_otsu. Each row of pix_hists is the 256 bins histogram 
+    of a uint8 image. The results are the same as applying threshold_otsu to each image.
+    '''
+    pix_hists = pix_hists.astype(np.int64)
+    bin_centers = np.arange(pix_hists.shape[1])
+
+    weight1 = np.cumsum(pix_hists, axis=1)
+    weight2 = np.cumsum(pix_hists[:, ::-1], axis=1)[:, ::-1]
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = np.cumsum(pix_hists * bin_centers, axis=1) / weight1
+        mean2 = (np.cumsum((pix_hists * bin_centers)[:, ::-1], axis=1) / weight2[:, ::-1])[:, ::-1]
+        variance12 = weight1[:, :-1] * weight2[:, 1:] * (mean1[:, :-1] - mean2[:, 1:]) ** 2
+    
+    # the values outside the range of each image are not defined (nan)
+    variance12[np.isnan(variance12)] = -np.inf
+    otsu_thresh = np.argmax(variance12, axis=1)
+
+    #if the image only has one intensity value, threshold_otsu returns that value
+    is_single = np.sum(pix_hists > 0, axis=1) == 1
+    otsu_thresh[is_single] = np.argmax(pix_hists[is_single], axis=1)
+
+    return otsu_thresh
+
+def _thresh_bw_hists(pix_hists):
+    # same as _thresh_bw but using the histograms (one per row) of the valid pixels.
+    otsu_thresh = _otsu_from_hists(pix_hists)
+
+    thresh = np.full(pix_hists.shape[0], np.nan)
+    for ii, (pix_hist, otsu) in enumerate(zip(pix_hists, otsu_thresh)):
+        valid_ind = np.flatnonzero(pix_hist)
+        if valid_ind.size > 0:
+            #trim the histogram so it is the same as the one returned by np.bincount(pix_valid)
+            thresh[ii] = _thresh_bw_refine(pix_hist[:valid_ind[-1] + 1], otsu)
+    return thresh
+
+def _mean_median_hists(pix_hists):
+    #calculate the mean and median (same as np.mean and np.median) of the pixels using their histograms
+    values = np.arange(pix_hists.shape[1])
+    tot = pix_hists.sum(axis=1)
+    cumhist = np.cumsum(pix_hists, axis=1)
+    
+    # the k-th smallest value is the first bin where cumhist > k
+    def _kth_value(k):
+        return np.sum(cumhist <= k[:, None], axis=1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pix_mean = (pix_hists*values).sum(axis=1) / tot
+        pix_median = (_kth_value((tot - 1) // 2) + _kth_value(tot // 2)) / 2
+    return pix_mean, pix_median
+
+def getBuffersThresh(ROI_buffers, worm_bw_thresh_factor, is_light_background, analysis_type):
+    ''' 
+    Same as getBufferThresh, but calculates the thresholds of a list of ROI buffers at once, 
+    using a vectorized otsu over the stacked histograms of the nonzero pixels.
+    '''
+    if analysis_type == "ZEBRAFISH":
+        # Override threshold
+        return [255]*len(ROI_buffers)
+    
+    if len(ROI_buffers) == 0:
+        return []
+
+    MAX_PIX = 255 #for uint8 images
+    pix_hists = np.array([np.bincount(x.ravel(), minlength=MAX_PIX + 1) for x in ROI_buffers])
+    pix_hists[:, 0] = 0 #zero is the background
+    
+    if is_light_background:
+        thresh = _thresh_bw_hists(pix_hists)
+    else:
+        #correct for fluorescence images. Reversing the histogram is equivalent to MAX_PIX - pix_valid
+        thresh = MAX_PIX - _thresh_bw_hists(pix_hists[:, ::-1])
+
+        if analysis_type == "WORM":
+            #see _thresh_bodywallmuscle
+            pix_mean, pix_median = _mean_median_hists(pix_hists)
+            thresh = np.where(pix_mean > pix_median*1.1, pix_mean, thresh)
+
+    thresh = thresh*worm_bw_thresh_factor
+    thresh[pix_hists.sum(axis=1) == 0] = np.nan
+
+    return list(thresh)
+
 def getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, analysis_type):
     ''' calculate threshold using the nonzero pixels.  Using the
      buffer instead of a single image, improves the threshold
@@ -199,11 +289,46 @@ def getBlobDimesions(worm_cnt, ROI_bbox):
     blob_dims = (CMx, CMy, L, W, angle)
     return blob_dims, area, blob_bbox
     
+def _get_chunk_runs(frames, chunk_size):
+    '''
+    Group the frames in runs of consecutive chunks. Each run is returned as the 
+    chunk-aligned (first, last) frame range, so it can be read with a single hyperslab 
+    without decompressing chunks that are not needed.
+    '''
+    if len(frames) == 0:
+        return []
+    
+    chunk_ids = np.unique(np.asarray(frames) // chunk_size)
+    breaks = np.where(np.diff(chunk_ids) > 1)[0]
+    ini_chunks = np.concatenate(([chunk_ids[0]], chunk_ids[breaks + 1]))
+    end_chunks = np.concatenate((chunk_ids[breaks], [chunk_ids[-1]]))
+    return [(ini*chunk_size, (fin + 1)*chunk_size) for ini, fin in zip(ini_chunks, end_chunks)]
+
+def _read_frames_block(mask_dataset, frames):
+    '''
+    Read the requested frames using chunk-aligned hyperslabs. 
+    Returns a dictionary with the frame number as key.
+    '''
+    frames_dict = {}
+    chunk_size = mask_dataset.chunkshape[0] if mask_dataset.chunkshape else 1
+    tot_frames = mask_dataset.shape[0]
+    frames_set = set(frames)
+    for ini, fin in _get_chunk_runs(frames, chunk_size):
+        fin = min(fin, tot_frames)
+        block = mask_dataset[ini:fin]
+        for ii, frame in enumerate(block):
+            frame_number = ini + ii
+            if frame_number in frames_set:
+                frames_dict[frame_number] = frame
+    
+    return frames_dict
+
 def generateImages(masked_image_file, 
                    frames=[], 
                    bgnd_param = {},
                    progress_str='', 
-                   progress_refresh_rate_s=20):
+                   progress_refresh_rate_s=20,
+                   block_size=None):
     
     #loop, save data and display progress
     base_name = Path(masked_image_file).stem
@@ -212,8 +337,6 @@ def generateImages(masked_image_file,
     
     progress_refresh_rate = fps*progress_refresh_rate_s
     
-    
-    
     with tables.File(masked_image_file, 'r') as mask_fid:
         mask_dataset = mask_fid.get_node("/mask")
         
@@ -235,20 +358,32 @@ def generateImages(masked_image_file,
         if len(frames) == 0:
             frames = range(mask_dataset.shape[0])
         
-        for frame_number in frames:
-            if frame_number % progress_refresh_rate == 0:
-                print_flush(progress_time.get_str(frame_number))
-                
-            image = mask_dataset[frame_number]
+        if block_size is None:
+            #read up to 64 frames or 32MB at once
+            frame_bytes = max(1, np.prod(mask_dataset.shape[1:])*mask_dataset.dtype.itemsize)
+            block_size = int(max(1, min(64, 2**25 // frame_bytes)))
+        
+        #read the frames in blocks, using one hyperslab for each run of consecutive chunks. 
+        #The masked videos are usually chunked by frame, so every chunk is still decompressed separately.
+        for ini in range(0, len(frames), block_size):
+            frames_in_block = frames[ini:ini + block_size]
+            frames_dict = _read_frames_block(mask_dataset, frames_in_block)
             
-            if bgnd_subtractor is not None:
-                image  = bgnd_subtractor.apply(image, frame_number)
+            for frame_number in frames_in_block:
+                if frame_number % progress_refresh_rate == 0:
+                    print_flush(progress_time.get_str(frame_number))
+                    
+                image = frames_dict[frame_number]
                 
-            yield frame_number, image
+                if bgnd_subtractor is not None:
+                    image  = bgnd_subtractor.apply(image, frame_number)
+                    
+                yield frame_number, image
             
     print_flush( progress_time.get_str(frame_number))
     
     
+    
 
 def generateROIBuff(masked_image_file, buffer_size, **argkws):
     img_generator = generateImages(masked_image_file)
@@ -291,6 +426,9 @@ def generateROIBuff(masked_image_file, buffer_size, **argkws):
 def _cnt_to_ROIs(ROI_cnt, image_buffer, min_box_width):
     #get the corresponding ROI from the contours
     ROI_bbox = cv2.boundingRect(ROI_cnt)
+    return _bbox_to_ROIs(ROI_bbox, image_buffer, min_box_width)
+
+def _bbox_to_ROIs(ROI_bbox, image_buffer, min_box_width):
     # bounding box too small to be a worm - ROI_bbox[2] and [3] are width and height
     if ROI_bbox[2] > min_box_width and ROI_bbox[3] > min_box_width:
         # select ROI for all buffer slides 
@@ -319,42 +457,139 @@ def _cnt_to_props(ROI_worms, current_frame, thresh, min_area, ROI_bbox=(0,0,0,0)
     return props
 
 
-def getBlobsData(buff_data, blob_params):
+def getBlobsData(buff_data, blob_params, executor=None, n_threads=1):
     #I packed input data to be able top to map the function into generateROIBuff
     ROI_cnts, image_buffer, frame_number = buff_data
-    
+    ROI_bboxes = [cv2.boundingRect(x) for x in ROI_cnts]
+    return _getBlobsDataFromBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params, executor, n_threads)
+
+def _getBlobsDataFromBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params, executor=None, n_threads=1):
+    '''
+    executor - optional ThreadPoolExecutor with n_threads workers used to process the ROIs in parallel. 
+    '''
     is_light_background, min_area, min_box_width, worm_bw_thresh_factor, \
     strel_size, analysis_type, thresh_block_size = blob_params
     
-    blobs_data = []
-    # examinate each region of interest
-    for ROI_cnt in ROI_cnts:
-        #get the corresponding ROI from the contours
-        ROI_buffer, ROI_bbox = _cnt_to_ROIs(ROI_cnt, image_buffer, min_box_width)
-        if ROI_buffer is not None:
-            # calculate threshold
-            thresh_buff = getBufferThresh(ROI_buffer, worm_bw_thresh_factor, is_light_background, analysis_type)
+    #get the corresponding ROI from the bounding boxes
+    ROIs_data = [_bbox_to_ROIs(x, image_buffer, min_box_width) for x in ROI_bboxes]
+    ROIs_data = [x for x in ROIs_data if x[0] is not None]
+    if len(ROIs_data) == 0:
+        return []
+    ROI_buffers, ROI_bboxes = zip(*ROIs_data)
+    
+    # calculate the thresholds of all the ROIs at once
+    ROI_threshs = getBuffersThresh(ROI_buffers, worm_bw_thresh_factor, is_light_background, analysis_type)
+    
+    # each ROI in each frame of the buffer is independent
+    jobs = [(ROI_buffer, ROI_bbox, thresh_buff, buff_ind) 
+            for ROI_buffer, ROI_bbox, thresh_buff in zip(ROI_buffers, ROI_bboxes, ROI_threshs)
+            for buff_ind in range(image_buffer.shape[0])]
+    
+    def _process_jobs(jobs_chunk):
+        blobs_data = []
+        for ROI_buffer, ROI_bbox, thresh_buff, buff_ind in jobs_chunk:
+            curr_ROI = ROI_buffer[buff_ind, :, :]
+
+            # get the contour of possible worms
+            ROI_worms, hierarchy = getBlobContours(curr_ROI, 
+                                                    thresh_buff, 
+                                                    strel_size, 
+                                                    is_light_background,
+                                                    analysis_type, 
+                                                    thresh_block_size)
+            current_frame = frame_number + buff_ind
             
-            for buff_ind in range(image_buffer.shape[0]):
-                curr_ROI = ROI_buffer[buff_ind, :, :]
-    
-                # get the contour of possible worms
-                ROI_worms, hierarchy = getBlobContours(curr_ROI, 
-                                                        thresh_buff, 
-                                                        strel_size, 
-                                                        is_light_background,
-                                                        analysis_type, 
-                                                        thresh_block_size)
-                current_frame = frame_number + buff_ind
-                
-                # make sure there are no holes in the contours. This shouldn't occur with the flag RETR_EXTERNAL
-                assert all([hierarchy[0][x][3] == -1 for x in range(len(ROI_worms))])
-                
-                blobs_data += _cnt_to_props(ROI_worms, current_frame, thresh_buff, min_area, ROI_bbox)
+            # make sure there are no holes in the contours. This shouldn't occur with the flag RETR_EXTERNAL
+            assert all([hierarchy[0][x][3] == -1 for x in range(len(ROI_worms))])
+            
+            blobs_data += _cnt_to_props(ROI_worms, current_frame, thresh_buff, min_area, ROI_bbox)
+        return blobs_data
+
+    if executor is not None and len(jobs) > 1:
+        # opencv releases the GIL, so the jobs can be run in parallel using threads.
+        # I group them in contiguous chunks to reduce the overhead, the order is kept.
+        n_chunks = min(len(jobs), 4*n_threads)
+        chunk_size = int(np.ceil(len(jobs)/n_chunks))
+        jobs_chunks = [jobs[ii:ii + chunk_size] for ii in range(0, len(jobs), chunk_size)]
+        
+        blobs_data = sum(executor.map(_process_jobs, jobs_chunks), [])
+    else:
+        blobs_data = _process_jobs(jobs)
                 
     return blobs_data
 
 
+class SharedBuffersRing():
+    '''
+    Ring of image buffers stored in a memory-mapped file (in /dev/shm if it exists). 
+    The buffers are written by the main process and only a handle (file name, 
+    offset, shape) is sent to the workers, avoiding to pickle the images.
+    '''
+    def __init__(self, n_slots, buffer_size, im_h, im_w):
+        self.n_slots = n_slots
+        self.slot_shape = (buffer_size, im_h, im_w)
+        
+        tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        fid, self.file_name = tempfile.mkstemp(suffix='.dat', prefix='tierpsy_', dir=tmp_dir)
+        os.close(fid)
+        self.buffers = np.memmap(self.file_name, dtype=np.uint8, mode='w+', 
+                                shape=(n_slots,) + self.slot_shape)
+    
+    def write(self, slot_ind, image_buffer):
+        tot = image_buffer.shape[0]
+        self.buffers[slot_ind, :tot] = image_buffer
+        offset = slot_ind*self.buffers[0].nbytes
+        return (self.file_name, offset, (tot,) + self.slot_shape[1:])
+    
+    def close(self):
+        #the workers must have finished (they do not keep the file mapped after each task), 
+        #otherwise the file cannot be removed in windows
+        del self.buffers
+        try:
+            os.remove(self.file_name)
+        except OSError:
+            pass
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+def getBlobsDataShared(task_data, blob_params, n_threads=1):
+    #same as getBlobsData but reading the images from a SharedBuffersRing
+    ROI_bboxes, (file_name, offset, shape), frame_number = task_data
+    
+    #the slot is mapped read-only in each task, so the worker always sees the data written by the main 
+    #process and does not keep the file open after the task is finished. 
+    image_buffer = np.memmap(file_name, dtype=np.uint8, mode='r', offset=offset, shape=shape)
+    if n_threads > 1:
+        #the pool workers are separate processes, so the threads cannot be shared with the main process. 
+        #They only live during the task.
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            blobs_data = _getBlobsDataFromBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params, executor, n_threads)
+    else:
+        blobs_data = _getBlobsDataFromBBoxes(ROI_bboxes, image_buffer, frame_number, blob_params)
+    del image_buffer
+    return blobs_data
+
+def _imap_shared_buffers(pool, f_blob_data, buff_generator, ring):
+    '''
+    Send the buffers from generateROIBuff to the pool workers using a SharedBuffersRing.
+    The results are yield in order. A slot is only reused after its results were read.
+    '''
+    pending = deque()
+    for ii, (ROI_cnts, image_buffer, ini_frame) in enumerate(buff_generator):
+        if len(pending) == ring.n_slots:
+            yield pending.popleft().get()
+        
+        handle = ring.write(ii % ring.n_slots, image_buffer)
+        ROI_bboxes = [cv2.boundingRect(x) for x in ROI_cnts]
+        pending.append(pool.apply_async(f_blob_data, ((ROI_bboxes, handle, ini_frame),)))
+    
+    while pending:
+        yield pending.popleft().get()
+
 def getBlobsSimple(in_data, blob_params):
     frame_number, image = in_data
     min_area, worm_bw_thresh_factor, strel_size = blob_params
@@ -389,6 +624,7 @@ def getBlobsTable(masked_image_file,
                     analysis_type="WORM",
                     thresh_block_size=15,
                     n_cores_used = 1, 
+                    n_threads = 1,
                     bgnd_param = {}):
     
     #correct strel if it is not a tuple or list
@@ -469,16 +705,49 @@ def getBlobsTable(masked_image_file,
         f_blob_data = partial(getBlobsSimple, blob_params = blob_params)
     
     
-    if n_cores_used > 1:
-        p = mp.Pool(n_cores_used)
-        blobs_generator = p.imap(f_blob_data, buff_generator)
-    else:
-        blobs_generator = map(f_blob_data, buff_generator)
-    
-    with tables.open_file(trajectories_file, mode='w') as traj_fid:
-        plate_worms = _ini_plate_worms(traj_fid, masked_image_file)
-        for ibuf, blobs_data in enumerate(blobs_generator):
-            if blobs_data:
-                plate_worms.append(blobs_data)
+    p = None
+    ring = None
+    executor = None
+    is_finished = False
+    try:
+        if n_cores_used > 1:
+            p = mp.Pool(n_cores_used)
+            if len(bgnd_param) == 0:
+                #the image buffers are shared using memory maps instead of being pickled
+                with tables.File(masked_image_file, 'r') as mask_fid:
+                    _, im_h, im_w = mask_fid.get_node("/mask").shape
+                ring = SharedBuffersRing(2*n_cores_used, buffer_size, im_h, im_w)
+                f_blob_data = partial(getBlobsDataShared, blob_params = blob_params, n_threads = n_threads)
+                blobs_generator = _imap_shared_buffers(p, f_blob_data, buff_generator, ring)
+            else:
+                blobs_generator = p.imap(f_blob_data, buff_generator)
+        else:
+            if len(bgnd_param) == 0 and n_threads > 1:
+                #the threads used to process the ROIs only live during this call
+                executor = ThreadPoolExecutor(max_workers=n_threads)
+                f_blob_data = partial(f_blob_data, executor = executor, n_threads = n_threads)
+            blobs_generator = map(f_blob_data, buff_generator)
+        
+        with tables.open_file(trajectories_file, mode='w') as traj_fid:
+            plate_worms = _ini_plate_worms(traj_fid, masked_image_file)
+            for ibuf, blobs_data in enumerate(blobs_generator):
+                if blobs_data:
+                    plate_worms.append(blobs_data)
+        is_finished = True
+    
+    finally:
+        if p is not None:
+            if is_finished:
+                p.close()
+            else:
+                p.terminate()
+            p.join()
+        
+        if executor is not None:
+            executor.shutdown()
+        
+        #remove the shared buffers only after the workers are closed
+        if ring is not None:
+            ring.close()
              
   
\ No newline at end of file
@@ -10,7 +10,7 @@ import os
 import numpy as np
 import pandas as pd
 import tables
-from scipy.spatial.distance import cdist
+from scipy.spatial import cKDTree
 
 from tierpsy.helper.misc import TimeCounter, print_flush, TABLE_FILTERS
 
@@ -32,28 +32,56 @@ def assignBlobTraj(trajectories_file, max_allowed_dist=20, area_ratio_lim=(0.5,
 
 def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name=''):
     
-    def _get_cost_matrix(frame_data, frame_data_prev):
-        coord = frame_data[['coord_x', 'coord_y']].values
-        coord_prev = frame_data_prev[['coord_x', 'coord_y']].values
-        costMatrix = cdist(coord_prev, coord)  # calculate the cost matrix
+    def _get_candidate_pairs(frame_data, frame_data_prev):
+        #use a kd-tree to find only the pairs closer than max_allowed_dist 
+        #instead of calculating the whole distance matrix
+        coord = frame_data[['coord_x', 'coord_y']].values.astype(np.float64)
+        coord_prev = frame_data_prev[['coord_x', 'coord_y']].values.astype(np.float64)
         
-        # assign a large value to non-valid combinations by area
+        valid, = np.where(np.all(np.isfinite(coord), axis=1))
+        valid_prev, = np.where(np.all(np.isfinite(coord_prev), axis=1))
+        if valid.size == 0 or valid_prev.size == 0:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0)
+        
+        #the search radius is slightly larger to be sure no pair is lost by rounding errors
+        tree = cKDTree(coord[valid])
+        tree_prev = cKDTree(coord_prev[valid_prev])
+        pairs = tree_prev.sparse_distance_matrix(tree, 
+                                                 max_allowed_dist*(1 + 1e-6) + 1e-6, 
+                                                 output_type='ndarray')
+        ind_prev = valid_prev[pairs['i']]
+        ind = valid[pairs['j']]
+        
+        #recalculate the distance the same way as cdist so the comparisons are exact
+        dx = coord_prev[ind_prev, 0] - coord[ind, 0]
+        dy = coord_prev[ind_prev, 1] - coord[ind, 1]
+        dist = np.sqrt(dx*dx + dy*dy)
+        
+        # remove non-valid combinations by area
         area = frame_data['area'].values
         area_prev = frame_data_prev['area'].values
-        area_ratio = area_prev[:, None]/area[None,:]
-        area_ratio[np.isnan(area_ratio)] = 1e20
+        area_ratio = area_prev[ind_prev]/area[ind]
         
-        bad_ratio = (area_ratio<area_ratio_lim[0]) | \
-        (area_ratio>area_ratio_lim[1]) | \
-        np.isnan(costMatrix)
+        good = (dist <= max_allowed_dist) & \
+        (area_ratio >= area_ratio_lim[0]) & \
+        (area_ratio <= area_ratio_lim[1])
         
-        costMatrix[bad_ratio] = 1e20
-        return costMatrix
-    
-    def _get_prev_ind_match(costMatrix):
-        def _label_bad_ind(indexes, dist, max_allowed_dist):
-            #label as bad the pairs that have a distance larger than max_allowed_dist
-            indexes[dist>max_allowed_dist] = -1
+        return ind_prev[good], ind[good], dist[good]
+    
+    def _get_closest(ind_from, ind_to, dist, n_from):
+        #closest ind_to for each ind_from. Ties are resolved by the smallest index as in np.argmin.
+        #Indexes without a valid pair are labeled as -1.
+        closest = np.full(n_from, -1, np.int64)
+        if ind_from.size > 0:
+            order = np.lexsort((ind_to, dist, ind_from))
+            ind_from_s = ind_from[order]
+            is_first = np.ones(order.size, bool)
+            is_first[1:] = ind_from_s[1:] != ind_from_s[:-1]
+            closest[ind_from_s[is_first]] = ind_to[order[is_first]]
+        return closest
+    
+    def _get_prev_ind_match(frame_data, frame_data_prev):
+        def _label_bad_ind(indexes):
             #remove indexes that where assigned twice (either a merge or a split event)
             uind, counts = np.unique(indexes, return_counts=True)
             duplicated_ind = uind[counts>1]
@@ -61,18 +89,18 @@ def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name=''):
             indexes[bad_ind] = -1
             return indexes
         
+        #pairs located at positions larger than max_allowed_dist or with a bad area ratio are not considered
+        ind_prev, ind, dist = _get_candidate_pairs(frame_data, frame_data_prev)
+        
         #I get the corresponding index in the previous data_frame
-        #I remove pairs located at positions larger than max_allowed_dist
-        #And indexes that where assigned twice or more (split events)
-        map_to_prev = np.argmin(costMatrix, axis=0) #must have dimensions of frame_data
-        min_dist_pp = costMatrix[map_to_prev, np.arange(costMatrix.shape[1])]
-        _label_bad_ind(map_to_prev, min_dist_pp, max_allowed_dist)
+        #And remove indexes that where assigned twice or more (split events)
+        map_to_prev = _get_closest(ind, ind_prev, dist, len(frame_data)) #must have dimensions of frame_data
+        _label_bad_ind(map_to_prev)
         
         #here i am looking at in the prev indexes that would have been 
         #assigned twice or more to the next indexes (merge events)
-        map_to_next = np.argmin(costMatrix, axis=1) #must have dimensions of frame_data_prev
-        min_dist_pp = costMatrix[np.arange(costMatrix.shape[0]), map_to_next]
-        _label_bad_ind(map_to_next, min_dist_pp, max_allowed_dist)
+        map_to_next = _get_closest(ind_prev, ind, dist, len(frame_data_prev)) #must have dimensions of frame_data_prev
+        _label_bad_ind(map_to_next)
         
         
         bad_prev_ind =  np.where(map_to_next==-1)[0] #techincally either index too far away or duplicated
@@ -94,8 +122,7 @@ def assignBlobTrajDF(traj_df, max_allowed_dist, area_ratio_lim, base_name=''):
         #what happens if the frames are not continous?
         if frame_data_prev is not None:    
             _, prev_traj_ind = all_indexes[-1]
-            costMatrix = _get_cost_matrix(frame_data, frame_data_prev)
-            map_to_prev = _get_prev_ind_match(costMatrix)
+            map_to_prev = _get_prev_ind_match(frame_data, frame_data_prev)
             
             traj_indexes = np.zeros_like(map_to_prev)
             unmatched = map_to_prev == -1
@@ -296,6 +323,31 @@ def joinGapsTrajectoriesDF(plate_worms,
 
 
 
+    def _get_tracks_ends(df):
+        '''
+        Get the data of the first and last rows (by frame_number) of each trajectory 
+        larger than min_track_size. The trajectories are sorted by their index.
+        '''
+        worm_index = df[worm_index_type].values
+        frame_number = df['frame_number'].values
+        rows = np.arange(len(df))
+        
+        #sort by trajectory and frame. In case of ties use the first row.
+        first_order = np.lexsort((rows, frame_number, worm_index))
+        last_order = np.lexsort((rows, -frame_number, worm_index))
+        
+        track_ids, track_ini, track_size = np.unique(worm_index[first_order], 
+                                                     return_index=True, 
+                                                     return_counts=True)
+        
+        # filter data only to include trajectories larger than min_track_size
+        good = track_size >= min_track_size
+        track_ids = track_ids[good]
+        first_rows = df.iloc[first_order[track_ini[good]]]
+        last_rows = df.iloc[last_order[track_ini[good]]]
+        
+        return track_ids, first_rows, last_rows
+    
     def _findNextTraj(df, 
                       area_ratio_lim, 
                       min_track_size, 
@@ -304,88 +356,90 @@ def joinGapsTrajectoriesDF(plate_worms,
         area_ratio_lim -- allowed range between the area ratio of consecutive frames
         min_track_size -- minimum tracksize accepted
         max_frames_gap -- time gap between joined trajectories
+        
+        Returns the index of the previous trajectory for each trajectory that can be joined (-1 otherwise)
         '''
     
         df = df[[worm_index_type, 'frame_number',
                  'coord_x', 'coord_y', 'area', 'box_length']].dropna()
-        # select the first and last frame_number for each separate trajectory
-        tracks_data = df[[worm_index_type, 'frame_number']]
-        tracks_data = tracks_data.groupby(worm_index_type)
-        tracks_data = tracks_data.aggregate(
-            {'frame_number': [np.argmin, np.argmax, 'count']})
-    
-        # filter data only to include trajectories larger than min_track_size
-        tracks_data = tracks_data[
-            tracks_data['frame_number']['count'] >= min_track_size]
-        valid_indexes = tracks_data.index
-    
-        # select the corresponding first and last rows of each trajectory
-        first_rows = df.iloc[tracks_data['frame_number']['argmin'].values]
-        last_rows = df.iloc[tracks_data['frame_number']['argmax'].values]
-        # let's use the particle id as index instead of the row number
-        last_rows.index = tracks_data['frame_number'].index
-        first_rows.index = tracks_data['frame_number'].index
-    
+        
+        track_ids, first_rows, last_rows = _get_tracks_ends(df)
+        
+        first_frame = first_rows['frame_number'].values
+        last_frame = last_rows['frame_number'].values
+        
         #% look for trajectories that could be join together in a small time gap
-        join_frames = []
-        for curr_index in valid_indexes:
-            # the possible connected trajectories must have started after the end of the current trajectories,
-            # within a timegap given by max_frames_gap
-            possible_rows = first_rows[
-                (first_rows['frame_number'] > last_rows['frame_number'][curr_index]) & (
-                    first_rows['frame_number'] <= last_rows['frame_number'][curr_index] +
-                    max_frames_gap)]
-    
-            # the area change must be smaller than the one given by area_ratio_lim
-            # it is better to use the last point change of area because we are
-            # considered changes near that occur near time
-            areaR = last_rows['area'][curr_index] / possible_rows['area']
-            possible_rows = possible_rows[
-                (areaR > area_ratio_lim[0]) & (
-                    areaR < area_ratio_lim[1])]
-    
-            # not valid rows left
-            if len(possible_rows) == 0:
-                continue
-    
-            R = np.sqrt((possible_rows['coord_x'] -
-                         last_rows['coord_x'][curr_index]) ** 2 +
-                        (possible_rows['coord_y'] -
-                         last_rows['coord_y'][curr_index]) ** 2)
-    
-            indmin = np.argmin(R)
-            # only join trajectories that move at most one worm body
-            if R[indmin] <= last_rows['box_length'][curr_index]:
-                #print(curr_index, indmin)
-                join_frames.append((indmin, curr_index))
-    
-        relations_dict = dict(join_frames)
-    
-        return relations_dict, valid_indexes
-    
-    
-    def _joinDict2Index(worm_index, relations_dict, valid_indexes):
+        # the possible connected trajectories must have started after the end of the current trajectories,
+        # within a timegap given by max_frames_gap. I use binary search over the sorted first frames.
+        order_by_first = np.argsort(first_frame, kind='stable')
+        first_frame_s = first_frame[order_by_first]
+        ini_ind = np.searchsorted(first_frame_s, last_frame, side='right')
+        fin_ind = np.searchsorted(first_frame_s, last_frame + max_frames_gap, side='right')
+        
+        #all the pairs (current, possible next) 
+        n_possible = fin_ind - ini_ind
+        curr_ind = np.repeat(np.arange(track_ids.size), n_possible)
+        offsets = np.arange(curr_ind.size) - np.repeat(np.cumsum(n_possible) - n_possible, n_possible)
+        next_ind = order_by_first[np.repeat(ini_ind, n_possible) + offsets]
+        
+        # the area change must be smaller than the one given by area_ratio_lim
+        # it is better to use the last point change of area because we are
+        # considered changes near that occur near time
+        areaR = last_rows['area'].values[curr_ind] / first_rows['area'].values[next_ind]
+        good = (areaR > area_ratio_lim[0]) & (areaR < area_ratio_lim[1])
+        curr_ind, next_ind = curr_ind[good], next_ind[good]
+        
+        R = np.sqrt((first_rows['coord_x'].values[next_ind] -
+                     last_rows['coord_x'].values[curr_ind]) ** 2 +
+                    (first_rows['coord_y'].values[next_ind] -
+                     last_rows['coord_y'].values[curr_ind]) ** 2)
+        
+        # select the closest trajectory (the one with the smallest index in case of ties)
+        order = np.lexsort((next_ind, R, curr_ind))
+        curr_ind, next_ind, R = curr_ind[order], next_ind[order], R[order]
+        is_closest = np.ones(curr_ind.size, bool)
+        is_closest[1:] = curr_ind[1:] != curr_ind[:-1]
+        curr_ind, next_ind, R = curr_ind[is_closest], next_ind[is_closest], R[is_closest]
+        
+        # only join trajectories that move at most one worm body
+        good = R <= last_rows['box_length'].values[curr_ind]
+        curr_ind, next_ind = curr_ind[good], next_ind[good]
+        
+        # if several trajectories can be joined to the same next trajectory, 
+        # the one with the largest index is kept
+        prev_traj = np.full(track_ids.size, -1, np.int64)
+        np.maximum.at(prev_traj, next_ind, curr_ind)
+        
+        return prev_traj, track_ids
+    
+    
+    def _joinDict2Index(worm_index, prev_traj, track_ids):
+        # seach the first index in the joined trajectory group
+        # by following the links to the previous trajectories
+        root = np.where(prev_traj >= 0, prev_traj, np.arange(prev_traj.size))
+        while True:
+            new_root = root[root]
+            if np.array_equal(new_root, root):
+                break
+            root = new_root
+        
+        # replace the previous index for the root index
         worm_index_new = np.full_like(worm_index, -1)
-    
-        for ind in valid_indexes:
-            # seach in the dictionary for the first index in the joined trajectory
-            # group
-            ind_joined = ind
-            while ind_joined in relations_dict:
-                ind_joined = relations_dict[ind_joined]
-    
-            # replace the previous index for the root index
-            worm_index_new[worm_index == ind] = ind_joined
+        if track_ids.size > 0:
+            ind = np.searchsorted(track_ids, worm_index)
+            ind[ind >= track_ids.size] = 0
+            valid = track_ids[ind] == worm_index
+            worm_index_new[valid] = track_ids[root[ind[valid]]]
     
         return worm_index_new
     
     
     
-    relations_dict, valid_indexes = _findNextTraj(plate_worms, area_ratio_lim, min_track_size, max_frames_gap)
+    prev_traj, track_ids = _findNextTraj(plate_worms, area_ratio_lim, min_track_size, max_frames_gap)
     # read the worm_index_blob column, this is the index order that have to
     # be conserved in the worm_index_joined column
     worm_index_blob = plate_worms[worm_index_type].values
-    worm_index_joined = _joinDict2Index(worm_index_blob, relations_dict, valid_indexes)
+    worm_index_joined = _joinDict2Index(worm_index_blob, prev_traj, track_ids)
 
     return worm_index_joined
 
@@ -663,14 +663,14 @@ class WormFeatures(object):
         Parameters
         ----------
         nw : NormalizedWorm object
-        specs :
+        specs : {'all', list of feature names, pandas.DataFrame}
+            If a list of feature names is given only those features, and the
+            features they depend on, are computed.
 
         #The options will most likely change. We should have the options
         #be accessible from the specs
         processing_options: movement_validation.features.feature_processing_options
 
-        #TODO: Expose just passing in feature names as well
-
 
         """
         if processing_options is None:
@@ -693,6 +693,8 @@ class WormFeatures(object):
             # This wouldn't be good if the specs have changed.
             # We would need to change the initialize_features() call
             self.get_features(specs['feature_name'])
+        elif isinstance(specs, (list, tuple, set)):
+            self._retrieve_features(specs)
         else:
             self._retrieve_all_features()
 
@@ -798,18 +800,22 @@ class WormFeatures(object):
         """
         Simple function for retrieving all features.
         """
-        spec_dict = self.specs
-        # Trying to avoid 2v3 differences in Python dict iteration
-        for key in spec_dict:
-            spec = spec_dict[key]
+        self._retrieve_features(self.specs)
+
+    def _retrieve_features(self, feature_names):
+        """
+        Retrieve a subset of features. The features they depend on are
+        computed (only once) when they are requested internally.
+        """
+        for feature_name in feature_names:
             # TODO: We could pass in the spec instance ...
             # rather than resolving the instance from the name
             
             try:
                 
-                self._get_and_log_feature(spec.name)
+                self._get_and_log_feature(feature_name)
             except Exception as e:
-                msg_warn = '{} was NOT calculated. {}'.format(spec.name, e)
+                msg_warn = '{} was NOT calculated. {}'.format(feature_name, e)
                 warnings.warn(msg_warn)
             
     def initialize_features(self):
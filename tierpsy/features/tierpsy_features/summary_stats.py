@@ -57,37 +57,55 @@ for k,dat in feats2normalize.items():
     dfeats = ['d_' + x for x in dat if not x.startswith('d_')]
     feats2normalize[k] = list(set(dat) ^ set(dfeats))
 
-def _normalize_by_w_length(timeseries_data, feats2norm):
+def _get_length_conversion(timeseries_data, feats2norm):
     '''
-    Normalize features by body length. This is far from being the most efficient solution, but it is the easier to implement.
+    Get the vectors used to normalize the features of each units type by the median length of each worm.
     '''
-    def _get_conversion_vec(units_t, median_length_vec):
-        '''helper function to find how to make the conversion'''
+    median_length = timeseries_data.groupby('worm_index').agg({'length':'median'})
+    median_length_vec = timeseries_data['worm_index'].map(median_length['length']).values
+    
+    conversion_vecs = {}
+    for units_t in feats2norm:
         if units_t == 'L':
-            conversion_vec = 1/median_length_vec
+            conversion_vecs[units_t] = 1/median_length_vec
         elif units_t == '1/L':
-            conversion_vec = median_length_vec
+            conversion_vecs[units_t] = median_length_vec
         elif units_t == 'L^2':
-            conversion_vec = median_length_vec**2
-        return conversion_vec
-    
-    timeseries_data = timeseries_data.copy()
-    
-    median_length = timeseries_data.groupby('worm_index').agg({'length':'median'})
-    median_length_vec = timeseries_data['worm_index'].map(median_length['length'])
-    
-    changed_feats_l = []
-    for units_t, feats in feats2norm.items():
-        feats_f = [x for x in timeseries_data if any(x.startswith(f) for f in feats)]
-        conversion_vec = _get_conversion_vec(units_t, median_length_vec)
-        for f in feats_f:
-            timeseries_data[f] *= conversion_vec
-        changed_feats_l += feats_f
+            conversion_vecs[units_t] = median_length_vec**2
+    return conversion_vecs
 
-    changed_feats = {x: x + '_norm' for x in changed_feats_l}    
-    timeseries_data = timeseries_data.rename(columns = changed_feats)
+def _nanquantiles(feat_data, q_vals):
+    '''
+    Get the quantiles (linear interpolation) of each of the arrays in the list `feat_data` ignoring the NaNs. 
+    The arrays with the same dtype are sorted together, and then the ones with the same number of valid 
+    values are interpolated in a single call. The result is equivalent to call np.nanpercentile in each array, 
+    but it avoids a very slow python loop when there are many features.
+    returns:
+        quantiles: list with an array of shape (len(q_vals),) for each element in feat_data
+    '''
+    q_percent = np.asarray(q_vals, dtype=np.float64)*100.
+    
+    by_dtype = {}
+    for ii, dat in enumerate(feat_data):
+        by_dtype.setdefault(dat.dtype, []).append(ii)
     
-    return timeseries_data, changed_feats
+    quantiles = [None]*len(feat_data)
+    for dtype, inds in by_dtype.items():
+        #the nan are sorted at the end so the valid values are in data_sorted[:n_valid]
+        data_sorted = np.sort(np.stack([feat_data[ii] for ii in inds], axis=1), axis=0)
+        n_valid = np.count_nonzero(~np.isnan(data_sorted), axis=0)
+        
+        res_dtype = dtype if dtype.kind == 'f' else np.float64
+        Q = np.full((q_percent.size, len(inds)), np.nan, dtype=res_dtype)
+        for n in np.unique(n_valid):
+            if n == 0:
+                continue
+            good = n_valid == n
+            Q[:, good] = np.percentile(data_sorted[:n, good], q_percent, axis=0)
+        
+        for icol, ii in enumerate(inds):
+            quantiles[ii] = Q[:, icol]
+    return quantiles
 
 def get_df_quantiles(df,
                      feats2check = timeseries_feats_columns,
@@ -107,74 +125,93 @@ def get_df_quantiles(df,
     iqr_limits = (0.25, 0.75) # range of percentiles used for the interquantile distance
     valid_q = q_vals + iqr_limits
     
-    df = df.copy() #like this i can modify directoy the df without long lasting consequences
-    
-    #filter features to be abs
-    def _filter_ventral_features(feats2check):#%%
-        valid_f = [x for x in feats2check if any(x.startswith(f) for f in feats2abs)]
-        return valid_f
-    
     #filter default columns in case they are not present
-    feats2check = [x for x in feats2check if x in df]
+    df_columns = set(df.columns)
+    feats2check = [x for x in feats2check if x in df_columns]
     
     #filter default columns in case they are not present. Same for the subdivision dictionary.
     subdivision_dict_r = {}
-    for e_subdivide, feats2subdivide in subdivision_dict.items():
-        ff = [x for x in feats2check if x in feats2subdivide]
-        if e_subdivide in df and ff:
+    feats2subdivide = set()
+    for e_subdivide, feats2subdivide_e in subdivision_dict.items():
+        feats2subdivide |= set(feats2subdivide_e)
+        ff = [x for x in feats2check if x in feats2subdivide_e]
+        if e_subdivide in df_columns and ff:
             subdivision_dict_r[e_subdivide] = ff
     subdivision_dict = subdivision_dict_r
     
+    #I work directly with the numpy arrays of the features used. 
+    #This is much faster than modify a copy of the whole dataframe.
+    feat_data = _get_columns_values(df, feats2check)
     
     #subdivide a feature using the event features
-    subdivided_df = _get_subdivided_features(df, subdivision_dict = subdivision_dict)
-    df = df.join(subdivided_df)
-    feats2check += subdivided_df.columns.tolist()
+    subdivided_data = _get_subdivided_features(df, feat_data, subdivision_dict = subdivision_dict)
+    feat_data.update(subdivided_data)
+    feats2check += list(subdivided_data.keys())
     if is_remove_subdivided:
-        df = df[[x for x  in df if not x in feats2subdivide]]
         feats2check = [x for x in feats2check if x not in feats2subdivide]
     
+    feat_names = {x:x for x in feats2check}
+    
     #add normalized features
     if is_normalize:
-        df, changed_feats = _normalize_by_w_length(df, feats2norm = feats2norm)
-        feats2check = [x if not x in changed_feats else changed_feats[x] for x in feats2check]
+        conversion_vecs = _get_length_conversion(df, feats2norm)
+        for feat in set(feats2check):
+            is_changed = False
+            for units_t, feats in feats2norm.items():
+                if feat.startswith(tuple(feats)):
+                    feat_data[feat] = feat_data[feat]*conversion_vecs[units_t]
+                    is_changed = True
+            if is_changed:
+                feat_names[feat] += '_norm'
     
     #abs features that are ventral/dorsal side
     if is_abs_ventral:
-        feats2abs = _filter_ventral_features(feats2check)
-        #find features that match ventral_signed_columns
-        if feats2abs:
-            #normalize
-            if df.size > 0:
-                df[feats2abs] = df[feats2abs].abs()
-            #change name
-            df.columns = [x + '_abs' if x in feats2abs else x for x in df.columns]
-            feats2check = [x + '_abs' if x in feats2abs else x for x in feats2check]
+        for feat in set(feats2check):
+            if feat_names[feat].startswith(tuple(feats2abs)):
+                feat_data[feat] = np.abs(feat_data[feat])
+                feat_names[feat] += '_abs'
     
     #calculate quantiles
-    feat_mean = None
-    Q = df[feats2check].quantile(valid_q)
-    feat_mean = pd.concat((feat_mean, Q), axis=1)
-
+    Q = _nanquantiles([feat_data[x] for x in feats2check], valid_q)
+    if Q:
+        #same type promotion as if the quantiles were in a dataframe row
+        Q = np.stack(Q, axis=1).astype(np.result_type(*Q), copy=False)
+    
     #name correctly
     dat = []
-    for q in q_vals:
-        q_dat = feat_mean.loc[q]
+    for iq, q in enumerate(q_vals):
         q_str = '_{}th'.format(int(round(q*100)))
-        for feat, val in q_dat.iteritems():
-            dat.append((val, feat+q_str))
+        dat += [(Q[iq, ii], feat_names[feat] + q_str) for ii, feat in enumerate(feats2check)]
     
-    
-    IQR = feat_mean.loc[0.75] - feat_mean.loc[0.25]
-    dat += [(val, feat + '_IQR') for feat, val in IQR.iteritems()]
+    if feats2check:
+        IQR = Q[valid_q.index(0.75)] - Q[valid_q.index(0.25)]
+        dat += [(val, feat_names[feat] + '_IQR') for feat, val in zip(feats2check, IQR)]
     
     feat_mean_s = pd.Series(*list(zip(*dat)))
     return feat_mean_s
 
 
-def _get_subdivided_features(timeseries_data, subdivision_dict):
+def _get_columns_values(df, columns):
+    '''
+    Get a dictionary with the numpy arrays of the given columns. The columns with the same 
+    dtype are extracted together, that is much faster than get them one by one.
+    '''
+    col_dtypes = dict(zip(df.columns, df.dtypes))
+    by_dtype = {}
+    for col in columns:
+        by_dtype.setdefault(col_dtypes[col], []).append(col)
+    
+    columns_values = {}
+    for dtype, cols in by_dtype.items():
+        cols = list(dict.fromkeys(cols)) #remove duplicates
+        values = df[cols].to_numpy(dtype=dtype)
+        columns_values.update(zip(cols, values.T))
+    return columns_values
+
+def _get_subdivided_features(timeseries_data, feat_data, subdivision_dict):
     '''
     subdivision_dict = {event_v1: [feature_v1, feature_v2, ...], event_v2: [feature_vn ...], ...}
+    feat_data = {feature_v1: feature_vector, ...}
     
     event_vector = [-1, -1, 0, 0, 1, 1]
     feature_vector = [1, 3, 4, 5, 6, 6]
@@ -194,7 +231,7 @@ def _get_subdivided_features(timeseries_data, subdivision_dict):
             'food_region' : '_in_',
             'motion_mode' : '_w_'
             }
-    subdivided_data = []
+    subdivided_data = {}
     for e_col, timeseries_cols in subdivision_dict.items():
         e_data = timeseries_data[e_col].values
         
@@ -207,28 +244,18 @@ def _get_subdivided_features(timeseries_data, subdivision_dict):
             _flag = e_data != flag
             
             for f_col in timeseries_cols:
-                f_data = timeseries_data[f_col].values.copy()
-                
-                try:
-                    f_data[_flag] = np.nan
-                except:
-                    import pdb
-                    pdb.set_trace()
+                f_data = feat_data[f_col].copy()
+                f_data[_flag] = np.nan
                 new_name = f_col + str_l + label
                 
-                subdivided_data.append((new_name, f_data))
-    
+                subdivided_data[new_name] = f_data
     
-    if not subdivided_data:
-        #return empty df if nothing was subdivided
-        return pd.DataFrame([])
-    
-
-    columns, data = zip(*subdivided_data)
-    subdivided_df = pd.DataFrame(np.array(data).T, columns = columns)
-    subdivided_df.index = timeseries_data.index
+    #all the subdivided features share the same type
+    if subdivided_data:
+        subdivided_dtype = np.result_type(*subdivided_data.values())
+        subdivided_data = {k : v.astype(subdivided_dtype, copy=False) for k,v in subdivided_data.items()}
 
-    return subdivided_df
+    return subdivided_data
 
 
 def process_blob_data(blob_features, derivate_delta_time, fps):
@@ -3,14 +3,19 @@ from tierpsy.gui.HDF5VideoPlayer_ui import Ui_HDF5VideoPlayer
 import sys
 import tables
 import os
+import threading
+import traceback
 from pathlib import Path
 import numpy as np
+from collections import OrderedDict
 from functools import partial
 
 from PyQt5 import QtWidgets, QtCore, QtGui
 from PyQt5.QtCore import Qt
 from PyQt5.QtWidgets import QApplication
 
+from tierpsy.helper.misc import HDF5_LOCK
+
 try:
     import imgstore
 except ModuleNotFoundError:
@@ -302,6 +307,127 @@ class _HDF5Reader():
     def close(self):
         self.fid.close()
 
+class FrameServer(QtCore.QObject):
+    '''
+    Serve the frames of a video reader. The frames are read by a worker thread and kept in a LRU 
+    cache (up to `max_cache_mb`). After a frame is requested, the worker also reads ahead up to 
+    `n_prefetch` frames in the direction of the requested step.
+
+    `frameReady(frame_number)` is emitted each time a frame is added to the cache. The signal is 
+    delivered in the thread of the receiver (usually the GUI thread).
+
+    The HDF5 library used by pytables is not thread safe, so the worker only reads while it holds 
+    HDF5_LOCK. Any other code that uses HDF5 in this process (e.g. the viewers or the summarizer) 
+    must take the same lock.
+    '''
+    frameReady = QtCore.pyqtSignal(int)
+
+    def __init__(self, video_reader, max_cache_mb = 512, n_prefetch = 8):
+        super().__init__()
+        self.video_reader = video_reader
+        self.max_cache_bytes = max_cache_mb*2**20
+        self.n_prefetch = n_prefetch
+
+        #the state shared with the worker is only modified while holding this condition
+        self._cond = threading.Condition()
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._next_frame = None
+        self._step = 1
+        #it is increased each time the cache is cleared, so the frames read before are discarded
+        self._generation = 0
+        self._is_closed = False
+
+        self._worker = threading.Thread(target=self._read_frames, daemon=True)
+        self._worker.start()
+
+    def _add2cache(self, frame_number, img):
+        if img is None or frame_number in self._cache:
+            return
+        
+        self._cache[frame_number] = img
+        self._cache_bytes += img.nbytes
+        while self._cache_bytes > self.max_cache_bytes and len(self._cache) > 1:
+            _, old_img = self._cache.popitem(last=False)
+            self._cache_bytes -= old_img.nbytes
+
+    def _get_frame2read(self):
+        if self._next_frame is None:
+            return None
+        tot_frames = len(self.video_reader)
+        for ii in range(self.n_prefetch + 1):
+            frame_number = self._next_frame + ii*self._step
+            if frame_number < 0 or frame_number >= tot_frames:
+                break
+            if not frame_number in self._cache:
+                return frame_number
+        return None
+
+    def _read_frames(self):
+        while True:
+            with self._cond:
+                frame_number = self._get_frame2read()
+                while frame_number is None and not self._is_closed:
+                    self._cond.wait()
+                    frame_number = self._get_frame2read()
+                if self._is_closed:
+                    return
+                generation = self._generation
+            
+            try:
+                with HDF5_LOCK:
+                    #the reader can be closed while waiting for the lock
+                    if self._is_closed:
+                        return
+                    img = self.video_reader[frame_number]
+            except Exception:
+                #stop reading. It will be tried again when a frame is requested.
+                traceback.print_exc()
+                with self._cond:
+                    if generation == self._generation:
+                        self._next_frame = None
+                continue
+            
+            with self._cond:
+                if generation != self._generation:
+                    continue
+                self._add2cache(frame_number, img)
+            self.frameReady.emit(frame_number)
+
+    def get_nowait(self, frame_number, step = 1):
+        '''
+        Return the frame if it is already in the cache, otherwise return None. 
+        In both cases the worker reads the frames frame_number, frame_number + step, ... that are not in the cache. 
+        '''
+        with self._cond:
+            img = self._cache.get(frame_number, None)
+            if img is not None:
+                self._cache.move_to_end(frame_number)
+            
+            self._next_frame = frame_number
+            self._step = step if step != 0 else 1
+            self._cond.notify()
+        return img
+
+    def clear(self):
+        '''
+        Remove all the frames in the cache. It must be called if the data of the reader changes.
+        '''
+        with self._cond:
+            self._generation += 1
+            self._next_frame = None
+            self._cache = OrderedDict()
+            self._cache_bytes = 0
+
+    def close(self):
+        '''
+        Stop the worker. The reader can be closed after calling this function while holding HDF5_LOCK.
+        '''
+        with self._cond:
+            self._is_closed = True
+            self._cond.notify()
+        self.clear()
+
 
 class HDF5VideoPlayerGUI(SimplePlayer):
 
@@ -315,6 +441,10 @@ class HDF5VideoPlayerGUI(SimplePlayer):
         self.ui.setupUi(self)
 
         self.video_reader = None
+        self.frame_server = None
+        self._waiting_frame = None
+        self.play_direction = 1
+        self._last_frame_number = 0
         self.isPlay = False
         self.videos_dir = ''
         self.frame_img = None
@@ -376,13 +506,37 @@ class HDF5VideoPlayerGUI(SimplePlayer):
     # update image: get the next frame_number, and resize it to fix in the GUI
     # area
     def updateImage(self):
-        self.readCurrentFrame()
+        if not self.readCurrentFrame():
+            return
         self.mainImage.setPixmap(self.frame_qimg)
 
     def readCurrentFrame(self):
-        if self.is_video_opened:
-            self.frame_img = self.video_reader[self.frame_number]
-            self._normalizeImage()
+        '''
+        Get the current frame from the frame server. Returns False if the frame is not read yet, 
+        in that case updateImage is called again when the frame arrives.
+        '''
+        if not self.is_video_opened:
+            return False
+        
+        #prefetch the frames in the direction the video is moving
+        if self.frame_number != self._last_frame_number:
+            self.play_direction = 1 if self.frame_number > self._last_frame_number else -1
+        self._last_frame_number = self.frame_number
+        
+        img = self.frame_server.get_nowait(self.frame_number, self.play_direction*self.frame_step)
+        if img is None:
+            self._waiting_frame = self.frame_number
+            return False
+        
+        self._waiting_frame = None
+        self.frame_img = img
+        self._normalizeImage()
+        return True
+    
+    def _frameReady(self, frame_number):
+        #redraw if this is the frame that is waiting to be displayed
+        if frame_number == self._waiting_frame and frame_number == self.frame_number:
+            self.updateImage()
         
 
     def _normalizeImage(self):
@@ -423,22 +577,31 @@ class HDF5VideoPlayerGUI(SimplePlayer):
 
         self.updateVideoFile(vfilename)
 
+    def _closeVideoReader(self):
+        with HDF5_LOCK:
+            if self.frame_server is not None:
+                self.frame_server.frameReady.disconnect(self._frameReady)
+                self.frame_server.close()
+                self.frame_server = None
+            self.video_reader.close()
+            self.video_reader = None
+
     def updateVideoFile(self, vfilename):
         # close the if there was another file opened before.
         if self.video_reader is not None:
-            self.video_reader.close()
+            self._closeVideoReader()
             self.mainImage.cleanCanvas()
-            self.video_reader = None
 
         self.vfilename = Path(vfilename)
         self.ui.lineEdit_video.setText(str(self.vfilename))
         self.videos_dir = self.vfilename.parent
 
         try:
-            if self.vfilename.name == 'metadata.yaml':
-                self.video_reader = _LoopBioReader(self.vfilename)
-            else:
-                self.video_reader = _HDF5Reader(self.vfilename)
+            with HDF5_LOCK:
+                if self.vfilename.name == 'metadata.yaml':
+                    self.video_reader = _LoopBioReader(self.vfilename)
+                else:
+                    self.video_reader = _HDF5Reader(self.vfilename)
 
 
         except (IOError, tables.exceptions.HDF5ExtError):
@@ -450,6 +613,9 @@ class HDF5VideoPlayerGUI(SimplePlayer):
                 QtWidgets.QMessageBox.Ok)
             return
 
+        self.frame_server = FrameServer(self.video_reader)
+        self.frame_server.frameReady.connect(self._frameReady)
+
         self.ui.comboBox_h5path.clear()
         for kk in self.video_reader.groupnames:
             self.ui.comboBox_h5path.addItem(kk)
@@ -460,14 +626,15 @@ class HDF5VideoPlayerGUI(SimplePlayer):
         if self.video_reader is None:
             return
 
-        self.video_reader.update_groupnames()
+        with HDF5_LOCK:
+            self.video_reader.update_groupnames()
         if not self.video_reader.groupnames:
             QtWidgets.QMessageBox.critical(
                 self,
                 '',
                 "No valid video groups were found. Dataset with three dimensions and uint8 data type. Closing file.",
                 QtWidgets.QMessageBox.Ok)
-            self.video_reader.close()
+            self._closeVideoReader()
             self.mainImage.cleanCanvas()
 
             return
@@ -490,7 +657,8 @@ class HDF5VideoPlayerGUI(SimplePlayer):
         
         self.h5path = h5path
         try:
-            self.video_reader.update_data(self.h5path)
+            with HDF5_LOCK:
+                self.video_reader.update_data(self.h5path)
         except ValueError:
             self.mainImage.cleanCanvas()
             QtWidgets.QMessageBox.critical(
@@ -499,6 +667,9 @@ class HDF5VideoPlayerGUI(SimplePlayer):
                 "Invalid groupset.",
                 QtWidgets.QMessageBox.Ok)
         
+        #the cached frames belong to the previous dataset
+        self.frame_server.clear()
+        
         self.tot_frames = len(self.video_reader)
         self.image_height = self.video_reader.height
         self.image_width = self.video_reader.width
@@ -522,7 +693,7 @@ class HDF5VideoPlayerGUI(SimplePlayer):
 
     def closeEvent(self, event):
         if self.video_reader is not None:
-            self.video_reader.close()
+            self._closeVideoReader()
         super(HDF5VideoPlayerGUI, self).closeEvent(event)
 
     @property
@@ -12,10 +12,10 @@ from PyQt5.QtWidgets import QApplication, QMessageBox
 from tierpsy.analysis.ske_create.helperIterROI import getWormROI
 
 from tierpsy.gui.MWTrackerViewer_ui import Ui_MWTrackerViewer
-from tierpsy.gui.TrackerViewerAux import TrackerViewerAuxGUI
+from tierpsy.gui.TrackerViewerAux import TrackerViewerAuxGUI, TrajectoriesIndex
 from tierpsy.gui.PlotFeatures import PlotFeatures
 
-from tierpsy.helper.misc import WLAB, save_modified_table
+from tierpsy.helper.misc import WLAB, save_modified_table, HDF5_LOCK
 
 class WellsDrawer(TrackerViewerAuxGUI):
     '''
@@ -34,7 +34,8 @@ class WellsDrawer(TrackerViewerAuxGUI):
         # check if /fov_wells exists in masked video
         
         try:
-            self.wells = pd.DataFrame(self.video_reader.fid.get_node('/fov_wells').read())
+            with HDF5_LOCK:
+                self.wells = pd.DataFrame(self.video_reader.fid.get_node('/fov_wells').read())
         except:
             self.wells = None
             
@@ -92,22 +93,23 @@ class FoodContourDrawer(TrackerViewerAuxGUI):
         self.ui.checkBox_showFood.setChecked(True)
         
     def updateSkelFile(self, skeletons_file):
+        with HDF5_LOCK:
 
-        super().updateSkelFile(skeletons_file)
-        if not self.skeletons_file or self.trajectories_data is None:
-            self.food_coordinates = None
-            return
-
-        with tables.File(self.skeletons_file, 'r') as fid:
-            if not '/food_cnt_coord' in fid:
+            super().updateSkelFile(skeletons_file)
+            if not self.skeletons_file or self.trajectories_data is None:
                 self.food_coordinates = None
-                self.ui.checkBox_showFood.setEnabled(False)
-            else:
-                #change from microns to pixels
-                self.food_coordinates = fid.get_node('/food_cnt_coord')[:]
-                self.food_coordinates /= self.microns_per_pixel
+                return
+
+            with tables.File(self.skeletons_file, 'r') as fid:
+                if not '/food_cnt_coord' in fid:
+                    self.food_coordinates = None
+                    self.ui.checkBox_showFood.setEnabled(False)
+                else:
+                    #change from microns to pixels
+                    self.food_coordinates = fid.get_node('/food_cnt_coord')[:]
+                    self.food_coordinates /= self.microns_per_pixel
                 
-                self.ui.checkBox_showFood.setEnabled(True)
+                    self.ui.checkBox_showFood.setEnabled(True)
 
     def draw_food_contour(self, image):
         if self.food_coordinates is None or not self.ui.checkBox_showFood.isChecked():
@@ -143,7 +145,8 @@ class IntensityLabeler(TrackerViewerAuxGUI):
             #get mean intensity information.
             #Useful for the optogenetic experiments. 
             try:
-                mean_int = self.video_reader.fid.get_node('/mean_intensity')[:]
+                with HDF5_LOCK:
+                    mean_int = self.video_reader.fid.get_node('/mean_intensity')[:]
                 
                 #calculate the intensity range and normalize the data. 
                 #I am ignoring any value less than 1. The viewer only works with uint8 data.
@@ -407,6 +410,14 @@ class TrajectoryEditor(ROIManager):
         self.ui.pushButton_join.setEnabled(value)
         self.ui.pushButton_split.setEnabled(value)
 
+    def updateWormIndexGroups(self):
+        #recalculate the grouped indexes. They must be updated every time a worm index is modified.
+        self.traj_worm_index_grouped = self.trajectories_data.groupby(self.worm_index_type)
+        self.traj_worm_index = TrajectoriesIndex(self.trajectories_data, 
+                                                 self.worm_index_type, 
+                                                 sort_column = 'frame_number',
+                                                 cache_columns = ['frame_number', 'coord_x', 'coord_y'])
+
     def joinTraj(self):
         if self.worm_index_type != 'worm_index_manual' \
         or self.frame_data is None:
@@ -465,8 +476,7 @@ class TrajectoryEditor(ROIManager):
         self.rois[0].worm_index = worm_ind1
         self.rois[1].worm_index = worm_ind1
 
-        #this might be too slow. I might need to change it
-        self.traj_worm_index_grouped = self.trajectories_data.groupby(self.worm_index_type)
+        self.updateWormIndexGroups()
 
         self.updateImage()
 
@@ -504,8 +514,7 @@ class TrajectoryEditor(ROIManager):
         self.rois[0].index = new_ind1
         self.rois[1].index = new_ind2
 
-        #this might be too slow. I might need to change it
-        self.traj_worm_index_grouped = self.trajectories_data.groupby(self.worm_index_type)
+        self.updateWormIndexGroups()
 
         self.updateImage()
 
@@ -520,38 +529,40 @@ class FeatureReaderBase(TrackerViewerAuxGUI):
         super().__init__(ui)
         
     def updateSkelFile(self, skeletons_file):
-        super().updateSkelFile(skeletons_file)
-        try:
-            self.traj_colors = {}
-            #with pd.HDFStore(self.skeletons_file, 'r') as skel_file_id:
-            for field in self.valid_fields:
-                if field in self.skel_file_id:
-                    self.timeseries_data = self.skel_file_id[field]
-
-                    if field == '/timeseries_data':
-                        blob_features = self.skel_file_id['/blob_features']
-                        blob_features.columns = ['blob_' + x for x in blob_features.columns]                            
-                        self.timeseries_data = pd.concat((self.timeseries_data, blob_features), axis=1)
-                    break
-            else:
-                raise KeyError
+        with HDF5_LOCK:
+            super().updateSkelFile(skeletons_file)
+            try:
+                self.traj_colors = {}
+                #with pd.HDFStore(self.skeletons_file, 'r') as skel_file_id:
+                for field in self.valid_fields:
+                    if field in self.skel_file_id:
+                        self.timeseries_data = self.skel_file_id[field]
+
+                        if field == '/timeseries_data':
+                            blob_features = self.skel_file_id['/blob_features']
+                            blob_features.columns = ['blob_' + x for x in blob_features.columns]                            
+                            self.timeseries_data = pd.concat((self.timeseries_data, blob_features), axis=1)
+                        break
+                else:
+                    raise KeyError
 
-            if not len(self.timeseries_data) != len(self.trajectories_data):
-                ValueError('timeseries_data and trajectories_data does not match. You might be using an old version of featuresN.hdf5')
+                if not len(self.timeseries_data) != len(self.trajectories_data):
+                    ValueError('timeseries_data and trajectories_data does not match. You might be using an old version of featuresN.hdf5')
 
 
-            self.valid_features = [x for x in self.timeseries_data.columns if x not in self.index_cols]
+                self.valid_features = [x for x in self.timeseries_data.columns if x not in self.index_cols]
             
 
-        except (TypeError, AttributeError, IOError, KeyError, tables.exceptions.HDF5ExtError):
-            self.valid_features = None
-            self.timeseries_data = None
+            except (TypeError, AttributeError, IOError, KeyError, tables.exceptions.HDF5ExtError):
+                self.valid_features = None
+                self.timeseries_data = None
 
 class MarkersDrawer(FeatureReaderBase):
     def __init__(self, ui):
         super().__init__(ui)
         
         self.traj_colors = {}
+        self.frame_skeletons = {}
         self.n_points_traj = 250
         self.n_colors = 256
         cmap = matplotlib.cm.get_cmap("bwr")
@@ -627,9 +638,10 @@ class MarkersDrawer(FeatureReaderBase):
 
 
     def _h_assign_feat_color(self, irow):
-
         feat_val = self.timeseries_data.loc[irow, self.feat_column]
+        return self._h_feat_color(feat_val)
 
+    def _h_feat_color(self, feat_val):
         if (feat_val != feat_val):
             return Qt.black
         
@@ -673,6 +685,9 @@ class MarkersDrawer(FeatureReaderBase):
         if not self.label_type in self.frame_data:
             self.frame_data[self.label_type] = self.wlab['U']
 
+        if self.ui.comboBox_drawType.currentIndex() == self.drawT['skel']:
+            self._h_read_frame_skeletons()
+
         for row_id, row_data in self.frame_data.iterrows():
             # check if the coordinates are nan
             if np.isnan(row_data['coord_x']) or np.isnan(row_data['coord_y']):
@@ -696,30 +711,39 @@ class MarkersDrawer(FeatureReaderBase):
         painter.end()
     
     def _h_get_trajectory(self, worm_index, current_frame):
-        worm_data = self.traj_worm_index_grouped.get_group(worm_index)
-        valid_index = worm_data.index[worm_data['frame_number']<= current_frame]
-
-        ini = max(0, valid_index.size - self.frame_step*self.n_points_traj)
-        traj_ind = valid_index.values[ini::self.frame_step]
-        traj_data = worm_data.loc[traj_ind]
-        return traj_data
+        '''
+        Slice of self.traj_worm_index with the last points of the trajectory up to current_frame.
+        '''
+        worm_slice = self.traj_worm_index.get_slice(worm_index)
+        if worm_slice is None:
+            return slice(0, 0)
+        
+        worm_frames = self.traj_worm_index.data['frame_number'][worm_slice]
+        n_valid = np.searchsorted(worm_frames, current_frame, side='right')
+        
+        ini = max(0, n_valid - self.frame_step*self.n_points_traj)
+        return slice(worm_slice.start + ini, worm_slice.start + n_valid, self.frame_step)
     
 
     def draw_trajectories(self, painter, row_data, is_current_index):
-        if self.traj_worm_index_grouped is None:
+        if self.traj_worm_index is None:
             return
         worm_index = int(row_data[self.worm_index_type])
         current_frame = row_data['frame_number']
-        traj_data = self._h_get_trajectory(worm_index, current_frame)
-        traj_data = traj_data.dropna(subset=['coord_x', 'coord_y'])
-
-        x_v = traj_data['coord_x'].round()
-        y_v = traj_data['coord_y'].round()
+        traj_slice = self._h_get_trajectory(worm_index, current_frame)
+        
+        x_v = self.traj_worm_index.data['coord_x'][traj_slice]
+        y_v = self.traj_worm_index.data['coord_y'][traj_slice]
+        valid = ~(np.isnan(x_v) | np.isnan(y_v))
+        
+        x_v = np.round(x_v[valid])
+        y_v = np.round(y_v[valid])
         points = [QPointF(*map(int, c)) for c in zip(x_v, y_v)]
 
         if self.ui.is_color_features.isChecked():
-
-            vec_color = [self._h_assign_feat_color(x) for x in traj_data.index]
+            traj_index = self.traj_worm_index.index_labels[traj_slice][valid]
+            feat_vals = self.timeseries_data.loc[traj_index, self.feat_column].values
+            vec_color = [self._h_feat_color(x) for x in feat_vals]
             
             pen = QPen()
             pen.setWidth(self.penwidth)
@@ -774,6 +798,39 @@ class MarkersDrawer(FeatureReaderBase):
             offset = bb/2 - b_size
             painter.fillRect(x + offset, y + offset, b_size, b_size, QBrush(label_color))
 
+    def _h_read_frame_skeletons(self):
+        '''
+        Read the skeletons of all the worms in the current frame at once. 
+        This is much faster than to read them one by one from the hdf5 file.
+        '''
+        self.frame_skeletons = {}
+        if self.coordinates_fields is None or 'skeleton' not in self.coordinates_fields:
+            return
+        
+        skel_ids = self.frame_data['skeleton_id'].values.astype(int)
+        skel_ids = np.unique(skel_ids[skel_ids >= 0])
+        if skel_ids.size == 0:
+            return
+
+        field = self.coordinates_group + self.coordinates_fields['skeleton']
+        with HDF5_LOCK:
+            if not field in self.skel_file_id:
+                return
+            
+            skel_node = self.skel_file_id.get_node(field)
+            if skel_ids[-1] - skel_ids[0] < 2*skel_ids.size:
+                #the skeletons are close together, it is faster to read the whole block
+                skels = skel_node[skel_ids[0]:skel_ids[-1] + 1][skel_ids - skel_ids[0]]
+            else:
+                skels = skel_node[skel_ids.tolist(), :, :]
+        
+        skels /= self.microns_per_pixel
+        if self.stage_position_pix is not None and self.stage_position_pix.size > 0:
+            #subtract stage motion if necessary
+            skels -= self.stage_position_pix[self.frame_number]
+        
+        self.frame_skeletons = dict(zip(skel_ids, skels))
+
     def draw_skeletons(self, painter, roi_id, row_data, is_current_index):
         if self.traj_worm_index_grouped is None:
             return
@@ -785,25 +842,11 @@ class MarkersDrawer(FeatureReaderBase):
         if self.coordinates_fields is None or skel_id < 0:
             return
         
-        #with tables.File(self.skeletons_file, 'r') as skel_file_id:
-        field = self.coordinates_group + self.coordinates_fields['skeleton']
-        if field in self.skel_file_id:
-            dat = self.skel_file_id.get_node(field)[skel_id]
-            dat /= self.microns_per_pixel
-            
-            if self.stage_position_pix is not None and self.stage_position_pix.size > 0:
-                #subtract stage motion if necessary
-                dat -= self.stage_position_pix[self.frame_number]
-            
-            #dat[:, 0] = (dat[:, 0] - roi_corner[0] + 0.5) * c_ratio_x
-            #dat[:, 1] = (dat[:, 1] - roi_corner[1] + 0.5) * c_ratio_y
-
+        if skel_id in self.frame_skeletons:
+            dat = self.frame_skeletons[skel_id]
         else:
             dat = np.full((1,2), np.nan)
 
-        
-
-
         if not worm_index in self.traj_colors:
             self.traj_colors[worm_index] = QColor(*np.random.randint(50, 230, 3))
         col = self.traj_colors[worm_index]
@@ -917,10 +960,11 @@ class MWTrackerViewer_GUI( MarkersDrawer, PlotCommunicator,
                         self, field_name).replace(
                         '/', os.sep))
 
-        self.skel_file_id.close() #I need to reopen the file in write mode
-        self.skel_file_id = None
-        
-        save_modified_table(self.skeletons_file, self.trajectories_data, 'trajectories_data')
+        with HDF5_LOCK:
+            self.skel_file_id.close() #I need to reopen the file in write mode
+            self.skel_file_id = None
+            
+            save_modified_table(self.skeletons_file, self.trajectories_data, 'trajectories_data')
         self.updateSkelFile(self.skeletons_file)
 
     def updateVideoFile(self, vfilename):
@@ -988,7 +1032,7 @@ class MWTrackerViewer_GUI( MarkersDrawer, PlotCommunicator,
             self.enable_label_buttons(False)
 
         #recalculate the grouped indexes
-        self.traj_worm_index_grouped = self.trajectories_data.groupby(self.worm_index_type)
+        self.updateWormIndexGroups()
 
         self.updateImage()
 
@@ -998,7 +1042,8 @@ class MWTrackerViewer_GUI( MarkersDrawer, PlotCommunicator,
         if not self.is_video_opened:
             return
 
-        super(TrackerViewerAuxGUI, self).readCurrentFrame()
+        if not super(TrackerViewerAuxGUI, self).readCurrentFrame():
+            return
 
         # read the data of the particles that exists in the frame
         self.frame_data = self.getFrameData(self.frame_number)
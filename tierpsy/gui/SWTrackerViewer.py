@@ -9,8 +9,9 @@ from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QPainter, QPen
 from PyQt5.QtWidgets import QApplication, QMessageBox
 from tierpsy.gui.SWTrackerViewer_ui import Ui_SWTrackerViewer
-from tierpsy.gui.TrackerViewerAux import TrackerViewerAuxGUI
+from tierpsy.gui.TrackerViewerAux import TrackerViewerAuxGUI, TrajectoriesIndex
 from tierpsy.analysis.int_ske_orient.correctHeadTailIntensity import createBlocks, _fuseOverlapingGroups
+from tierpsy.helper.misc import HDF5_LOCK
 
 class EggWriter():
     def __init__(self):
@@ -100,98 +101,99 @@ class SWTrackerViewer_GUI(TrackerViewerAuxGUI):
         super().keyPressEvent(event)
 
     def updateSkelFile(self, skel_file, dflt_skel_size = 10):
-        super().updateSkelFile(skel_file)
+        with HDF5_LOCK:
+            super().updateSkelFile(skel_file)
         
-        self.ui.spinBox_skelBlock.setMaximum(max(len(self.skel_block) - 1, 0))
-        self.ui.spinBox_skelBlock.setMinimum(0)
+            self.ui.spinBox_skelBlock.setMaximum(max(len(self.skel_block) - 1, 0))
+            self.ui.spinBox_skelBlock.setMinimum(0)
 
-        if self.skel_block_n != 0:
-            self.skel_block_n = 0
-            self.ui.spinBox_skelBlock.setValue(0)
-        else:
-            self.changeSkelBlock(0)
-
-
-        self.skel_block = []
-        self.is_stage_move = []
-        self.is_feat_file = False
-
-        VALID_ERRORS = (IOError, KeyError, tables.exceptions.HDF5ExtError, tables.exceptions.NoSuchNodeError)
-        #try to read the information from the features file if possible
-        if not self.trajectories_data is None:
-            try:
-                # I am reading an skeleton file, so there is information about the intensity blocks
-                with tables.File(self.skeletons_file, 'r') as fid:
-                    #only used for skeletons, and to test the head/tail orientation. I leave it but probably should be removed for in the future
-                    prov_str = fid.get_node('/provenance_tracking/INT_SKE_ORIENT').read()
-                    func_arg_str = json.loads(
-                        prov_str.decode("utf-8"))['func_arguments']
-                    gap_size = json.loads(func_arg_str)['gap_size']
-
-                    good = (self.trajectories_data['int_map_id'] > 0).values
-                    has_skel_group = createBlocks(good, min_block_size=0)
-                    if len(has_skel_group) > 0:
-                        self.skel_block = _fuseOverlapingGroups(
-                            has_skel_group, gap_size=gap_size)
+            if self.skel_block_n != 0:
+                self.skel_block_n = 0
+                self.ui.spinBox_skelBlock.setValue(0)
+            else:
+                self.changeSkelBlock(0)
+
+
+            self.skel_block = []
+            self.is_stage_move = []
+            self.is_feat_file = False
+
+            VALID_ERRORS = (IOError, KeyError, tables.exceptions.HDF5ExtError, tables.exceptions.NoSuchNodeError)
+            #try to read the information from the features file if possible
+            if not self.trajectories_data is None:
+                try:
+                    # I am reading an skeleton file, so there is information about the intensity blocks
+                    with tables.File(self.skeletons_file, 'r') as fid:
+                        #only used for skeletons, and to test the head/tail orientation. I leave it but probably should be removed for in the future
+                        prov_str = fid.get_node('/provenance_tracking/INT_SKE_ORIENT').read()
+                        func_arg_str = json.loads(
+                            prov_str.decode("utf-8"))['func_arguments']
+                        gap_size = json.loads(func_arg_str)['gap_size']
+
+                        good = (self.trajectories_data['int_map_id'] > 0).values
+                        has_skel_group = createBlocks(good, min_block_size=0)
+                        if len(has_skel_group) > 0:
+                            self.skel_block = _fuseOverlapingGroups(
+                                has_skel_group, gap_size=gap_size)
                 
-            except VALID_ERRORS:
-                self.skel_block = []
+                except VALID_ERRORS:
+                    self.skel_block = []
 
-        else:
-            try:
-                if self.stage_position_pix is None:
-                    try:
-                        self.stage_position_pix = self.video_reader.fid.get_node('/stage_position_pix')[:]
-                    except:
-                        n_frames = len(self.video_reader)
-                        self.stage_position_pix = np.full((n_frames,2), np.nan)
+            else:
+                try:
+                    if self.stage_position_pix is None:
+                        try:
+                            self.stage_position_pix = self.video_reader.fid.get_node('/stage_position_pix')[:]
+                        except:
+                            n_frames = len(self.video_reader)
+                            self.stage_position_pix = np.full((n_frames,2), np.nan)
                 
-                timestamp = self.video_reader.fid.get_node('/timestamp/raw')[:]
-                with pd.HDFStore(self.skeletons_file, 'r') as ske_file_id:
-                    #this could be better so I do not have to load everything into memory, but this is faster
-                    self.trajectories_data = ske_file_id['/features_timeseries']
+                    timestamp = self.video_reader.fid.get_node('/timestamp/raw')[:]
+                    with pd.HDFStore(self.skeletons_file, 'r') as ske_file_id:
+                        #this could be better so I do not have to load everything into memory, but this is faster
+                        self.trajectories_data = ske_file_id['/features_timeseries']
                     
-                    if self.trajectories_data['worm_index'].unique().size !=1:
-                        QMessageBox.critical(
-                        self,
-                        '',
-                        "There is more than one worm index. This file does not seem to have been analyzed with the WT2 option.",
-                        QMessageBox.Ok
-                        )
+                        if self.trajectories_data['worm_index'].unique().size !=1:
+                            QMessageBox.critical(
+                            self,
+                            '',
+                            "There is more than one worm index. This file does not seem to have been analyzed with the WT2 option.",
+                            QMessageBox.Ok
+                            )
                         
-                        raise KeyError()
+                            raise KeyError()
 
-                    good = self.trajectories_data['timestamp'].isin(timestamp)
-                    self.trajectories_data = self.trajectories_data[good]
-                    self.trajectories_data.sort_values(by='timestamp', inplace=True)
+                        good = self.trajectories_data['timestamp'].isin(timestamp)
+                        self.trajectories_data = self.trajectories_data[good]
+                        self.trajectories_data.sort_values(by='timestamp', inplace=True)
                     
-                    if np.any(self.trajectories_data['timestamp'] < 0) or np.any(self.trajectories_data['timestamp'].isnull()):
-                        QMessageBox.critical(
-                        self,
-                        '',
-                        'There are invalid values in the timestamp. I cannot get the stage movement information.',
-                        QMessageBox.Ok)
-                        raise KeyError()
+                        if np.any(self.trajectories_data['timestamp'] < 0) or np.any(self.trajectories_data['timestamp'].isnull()):
+                            QMessageBox.critical(
+                            self,
+                            '',
+                            'There are invalid values in the timestamp. I cannot get the stage movement information.',
+                            QMessageBox.Ok)
+                            raise KeyError()
 
-                    first_frame = np.where(timestamp==self.trajectories_data['timestamp'].min())[0][0]
-                    last_frame = np.where(timestamp==self.trajectories_data['timestamp'].max())[0][0]
+                        first_frame = np.where(timestamp==self.trajectories_data['timestamp'].min())[0][0]
+                        last_frame = np.where(timestamp==self.trajectories_data['timestamp'].max())[0][0]
 
-                    self.trajectories_data['frame_number'] = np.arange(first_frame, last_frame+1, dtype=np.int)
-                    self.trajectories_data['skeleton_id'] = self.trajectories_data.index
+                        self.trajectories_data['frame_number'] = np.arange(first_frame, last_frame+1, dtype=np.int)
+                        self.trajectories_data['skeleton_id'] = self.trajectories_data.index
 
-                    self.traj_time_grouped = self.trajectories_data.groupby('frame_number')
+                        self.traj_time_index = TrajectoriesIndex(self.trajectories_data, 'frame_number')
 
                     
-                self.is_feat_file = True
+                    self.is_feat_file = True
 
-            except VALID_ERRORS:
-                self.trajectories_data = None
-                self.traj_time_grouped = None
-                self.is_feat_file = False
+                except VALID_ERRORS:
+                    self.trajectories_data = None
+                    self.traj_time_index = None
+                    self.is_feat_file = False
 
-            if self.stage_position_pix is not None:
-                self.is_stage_move = np.isnan(self.stage_position_pix[:, 0])
-        self.updateImage()
+                if self.stage_position_pix is not None:
+                    self.is_stage_move = np.isnan(self.stage_position_pix[:, 0])
+            self.updateImage()
 
     def drawSkelSingleWorm(self):
         frame_data = self.getFrameData(self.frame_number)
@@ -213,7 +215,8 @@ class SWTrackerViewer_GUI(TrackerViewerAuxGUI):
         return self.frame_qimg
 
     def updateImage(self):
-        self.readCurrentFrame()
+        if not self.readCurrentFrame():
+            return
         self.drawSkelSingleWorm()
 
         #draw stage movement if necessary
@@ -15,7 +15,7 @@ from tierpsy.gui.TrackerViewerAux_ui import Ui_TrackerViewerAux
 from tierpsy.analysis.ske_create.getSkeletonsTables import getWormMask
 from tierpsy.analysis.ske_create.segWormPython.mainSegworm import getSkeleton
 from tierpsy.helper.params import read_unit_conversions
-from tierpsy.helper.misc import WLAB
+from tierpsy.helper.misc import WLAB, HDF5_LOCK
 
 BAD_SKEL_COLOURS = dict(
     skeleton = (102, 0, 0),
@@ -78,6 +78,47 @@ def _estimate_trajectories_data(ow_feat_file, timestamp, microns_per_pixel, stag
     
     return trajectories_data
 #%%
+class TrajectoriesIndex():
+    '''
+    Index the rows of trajectories_data by the values of `column` (e.g. frame_number or worm_index). 
+    The row positions are sorted by `column` (and `sort_column` within each group), so the rows 
+    with the same value are a contiguous slice that can be found with a binary search, instead of
+    filtering or calling groupby(...).get_group(...) every time the data is needed.
+    
+    Only the positions are stored, so the dataframe can be modified after creating the index 
+    as long as `column` is not changed. The values of `cache_columns` are copied in the same 
+    order as the index, so they can be read directly as a slice.
+    '''
+    def __init__(self, trajectories_data, column, sort_column = None, cache_columns = []):
+        keys = trajectories_data[column].values
+        if sort_column is None:
+            self.rows_order = np.argsort(keys, kind='stable')
+        else:
+            self.rows_order = np.lexsort((trajectories_data[sort_column].values, keys))
+        
+        keys_sorted = keys[self.rows_order]
+        self.keys, first_rows = np.unique(keys_sorted, return_index = True)
+        self.limits = np.append(first_rows, keys_sorted.size)
+        
+        self.data = {col : trajectories_data[col].values[self.rows_order] for col in cache_columns}
+        self.index_labels = trajectories_data.index.values[self.rows_order]
+
+    def get_slice(self, key):
+        ind = np.searchsorted(self.keys, key)
+        if ind >= self.keys.size or self.keys[ind] != key:
+            return None
+        return slice(self.limits[ind], self.limits[ind + 1])
+
+    def get_rows(self, key):
+        '''
+        Positions (to be used with iloc) of the rows with `column == key`. 
+        '''
+        key_slice = self.get_slice(key)
+        if key_slice is None:
+            return np.zeros(0, self.rows_order.dtype)
+        return self.rows_order[key_slice]
+
+#%%
 
 class TrackerViewerAuxGUI(HDF5VideoPlayerGUI):
 
@@ -92,8 +133,9 @@ class TrackerViewerAuxGUI(HDF5VideoPlayerGUI):
         self.skel_file_id = None
 
         self.trajectories_data = None
-        self.traj_time_grouped = None
+        self.traj_time_index = None
         self.traj_worm_index_grouped = None
+        self.traj_worm_index = None
         
         self.skel_dat = {}
 
@@ -125,108 +167,110 @@ class TrackerViewerAuxGUI(HDF5VideoPlayerGUI):
         self.updateSkelFile(selected_file)
 
     def updateSkelFile(self, selected_file, dflt_skel_size = 5):
-        self.trajectories_data = None
-        self.traj_time_grouped = None
-        self.traj_worm_index_grouped = None
-        self.skel_dat = {}
+        with HDF5_LOCK:
+            self.trajectories_data = None
+            self.traj_time_index = None
+            self.traj_worm_index_grouped = None
+            self.traj_worm_index = None
+            self.skel_dat = {}
         
-        self.skeletons_file = selected_file
-        self.ui.lineEdit_skel.setText(str(self.skeletons_file))
+            self.skeletons_file = selected_file
+            self.ui.lineEdit_skel.setText(str(self.skeletons_file))
 
-        if self.skel_file_id is not None:
-            self.skel_file_id.close()
-            self.skel_file_id = None
+            if self.skel_file_id is not None:
+                self.skel_file_id.close()
+                self.skel_file_id = None
 
-        try:
-            #find were to read the skeletons and pixel2microns transforming factor
-            self.stage_position_pix =  None
+            try:
+                #find were to read the skeletons and pixel2microns transforming factor
+                self.stage_position_pix =  None
 
-            #read units data
-            fps_out, microns_per_pixel_out, _ = read_unit_conversions(self.skeletons_file)
-            self.fps, _, self.time_units = fps_out
-            self.microns_per_pixel, self.xy_units = microns_per_pixel_out
+                #read units data
+                fps_out, microns_per_pixel_out, _ = read_unit_conversions(self.skeletons_file)
+                self.fps, _, self.time_units = fps_out
+                self.microns_per_pixel, self.xy_units = microns_per_pixel_out
             
-            self.skel_file_id = tables.File(self.skeletons_file, 'r')
-            #with tables.File(self.skeletons_file, 'r') as skel_file_id:
-            if '/coordinates' in self.skel_file_id:
+                self.skel_file_id = tables.File(self.skeletons_file, 'r')
+                #with tables.File(self.skeletons_file, 'r') as skel_file_id:
+                if '/coordinates' in self.skel_file_id:
                 
-                self.coordinates_group = '/coordinates/'
-                self.coordinates_fields = {
-                    'contour_side2' : 'dorsal_contours', 
-                    'skeleton' : 'skeletons', 
-                    'contour_side1' : 'ventral_contours'
-                }
-
-                try:
-                    self.video_reader.fid.get_node('/stage_position_pix')[:]
-                except:
-                    pass
+                    self.coordinates_group = '/coordinates/'
+                    self.coordinates_fields = {
+                        'contour_side2' : 'dorsal_contours', 
+                        'skeleton' : 'skeletons', 
+                        'contour_side1' : 'ventral_contours'
+                    }
+
+                    try:
+                        self.video_reader.fid.get_node('/stage_position_pix')[:]
+                    except:
+                        pass
                 
-            else:
-                self.microns_per_pixel = 1.
-                self.coordinates_group = '/'
+                else:
+                    self.microns_per_pixel = 1.
+                    self.coordinates_group = '/'
 
-                self.coordinates_fields = {
-                    'contour_side1':'contour_side1', 
-                    'skeleton':'skeleton', 
-                    'contour_side2':'contour_side2'
-                }
+                    self.coordinates_fields = {
+                        'contour_side1':'contour_side1', 
+                        'skeleton':'skeleton', 
+                        'contour_side2':'contour_side2'
+                    }
 
-            self.coordinates_fields = {k:v for k,v in self.coordinates_fields.items() if (self.coordinates_group + v) in self.skel_file_id }
+                self.coordinates_fields = {k:v for k,v in self.coordinates_fields.items() if (self.coordinates_group + v) in self.skel_file_id }
             
-            #read trajectories data, and other useful factors
-            #with pd.HDFStore(self.skeletons_file, 'r') as skel_file_id:
-            if '/trajectories_data' in self.skel_file_id:
-                #self.trajectories_data = self.skel_file_id['/trajectories_data']
-                rec = self.skel_file_id.get_node('/trajectories_data')[:]
-                self.trajectories_data = pd.DataFrame(rec)
-                self.is_estimated_trajectories_data = False
-            else:
-                timestamp = [np.nan]
+                #read trajectories data, and other useful factors
+                #with pd.HDFStore(self.skeletons_file, 'r') as skel_file_id:
+                if '/trajectories_data' in self.skel_file_id:
+                    #self.trajectories_data = self.skel_file_id['/trajectories_data']
+                    rec = self.skel_file_id.get_node('/trajectories_data')[:]
+                    self.trajectories_data = pd.DataFrame(rec)
+                    self.is_estimated_trajectories_data = False
+                else:
+                    timestamp = [np.nan]
                 
-                try:
-                    timestamp = self.video_reader.fid.get_node('/timestamp/raw')[:]
-                except:
-                    pass
+                    try:
+                        timestamp = self.video_reader.fid.get_node('/timestamp/raw')[:]
+                    except:
+                        pass
                 
 
-                if np.any(np.isnan(timestamp)):
-                    tot = len(self.video_reader)
-                    timestamp = np.arange(tot)
+                    if np.any(np.isnan(timestamp)):
+                        tot = len(self.video_reader)
+                        timestamp = np.arange(tot)
 
 
-                self.trajectories_data = _estimate_trajectories_data(self.skeletons_file, timestamp, self.microns_per_pixel, self.stage_position_pix)
-                self.is_estimated_trajectories_data = True 
+                    self.trajectories_data = _estimate_trajectories_data(self.skeletons_file, timestamp, self.microns_per_pixel, self.stage_position_pix)
+                    self.is_estimated_trajectories_data = True 
             
-            #group data
-            self.traj_time_grouped = self.trajectories_data.groupby('frame_number')
-            self.traj_worm_index_grouped = self.trajectories_data.groupby('worm_index_joined')
-
-            # read the size of the structural element used in to calculate
-            # the mask
-            if '/provenance_tracking/int_ske_orient' in self.skel_file_id:
-                prov_str = self.skel_file_id.get_node(
-                    '/provenance_tracking/ske_create').read()
-                func_arg_str = json.loads(
-                    prov_str.decode("utf-8"))['func_arguments']
-                strel_size = json.loads(func_arg_str)['strel_size']
-                if isinstance(strel_size, (list, tuple)):
-                    strel_size = strel_size[0]
-
-                self.strel_size = strel_size
-            else:
-                # use default
-                self.strel_size = dflt_skel_size
+                #group data
+                self.traj_time_index = TrajectoriesIndex(self.trajectories_data, 'frame_number')
+                self.traj_worm_index_grouped = self.trajectories_data.groupby('worm_index_joined')
+
+                # read the size of the structural element used in to calculate
+                # the mask
+                if '/provenance_tracking/int_ske_orient' in self.skel_file_id:
+                    prov_str = self.skel_file_id.get_node(
+                        '/provenance_tracking/ske_create').read()
+                    func_arg_str = json.loads(
+                        prov_str.decode("utf-8"))['func_arguments']
+                    strel_size = json.loads(func_arg_str)['strel_size']
+                    if isinstance(strel_size, (list, tuple)):
+                        strel_size = strel_size[0]
+
+                    self.strel_size = strel_size
+                else:
+                    # use default
+                    self.strel_size = dflt_skel_size
             
             
 
-        except (IOError, KeyError, tables.exceptions.HDF5ExtError, tables.exceptions.NoSuchNodeError):
-            self.trajectories_data = None
-            self.traj_time_grouped = None
-            self.skel_dat = {}
+            except (IOError, KeyError, tables.exceptions.HDF5ExtError, tables.exceptions.NoSuchNodeError):
+                self.trajectories_data = None
+                self.traj_time_index = None
+                self.skel_dat = {}
 
-        #here i am updating the image
-        self.ui.spinBox_frame.setValue(0)
+            #here i am updating the image
+            self.ui.spinBox_frame.setValue(0)
 
     def updateVideoFile(self, vfilename, possible_ext = ['_featuresN.hdf5', '_features.hdf5', '_skeletons.hdf5', '_skeletonsNN.hdf5']):
         super().updateVideoFile(vfilename)
@@ -264,18 +308,15 @@ class TrackerViewerAuxGUI(HDF5VideoPlayerGUI):
         self.updateSkelFile(self.skeletons_file)
 
     def getFrameData(self, frame_number):
-        try:
-            if not isinstance(self.traj_time_grouped, pd.core.groupby.DataFrameGroupBy):
-                raise KeyError
-            
-            if self.is_video_opened:
-                frame_data = self.traj_time_grouped.get_group(self.video_reader.frame_save_interval*frame_number)
-                return frame_data
-            else:
-                raise ValueError
-
-        except KeyError:
+        if self.traj_time_index is None or not self.is_video_opened:
+            return None
+        
+        rows = self.traj_time_index.get_rows(self.video_reader.frame_save_interval*frame_number)
+        if rows.size == 0:
             return None
+        
+        frame_data = self.trajectories_data.iloc[rows]
+        return frame_data
 
     def drawSkelResult(self, img, qimg, row_data, isDrawSkel, 
         roi_corner=(0,0), read_center=True):
@@ -299,44 +340,45 @@ class TrackerViewerAuxGUI(HDF5VideoPlayerGUI):
         return qimg
 
     def drawSkel(self, worm_img, worm_qimg, row_data, roi_corner=(0, 0)):
-        if not self.skeletons_file or \
-        self.trajectories_data is None or \
-        worm_img.size == 0 or \
-        worm_qimg is None or \
-        self.coordinates_fields is None:
-            return
-
-        c_ratio_y = worm_qimg.width() / worm_img.shape[1]
-        c_ratio_x = worm_qimg.height() / worm_img.shape[0]
-
-        skel_id = int(row_data['skeleton_id'])
-        skel_dat = {}
-
-
-        for tt, ff in self.coordinates_fields.items():
-            field = self.coordinates_group + ff
-            if field in self.skel_file_id:
-                dat = self.skel_file_id.get_node(field)[skel_id]
-                dat /= self.microns_per_pixel
+        with HDF5_LOCK:
+            if not self.skeletons_file or \
+            self.trajectories_data is None or \
+            worm_img.size == 0 or \
+            worm_qimg is None or \
+            self.coordinates_fields is None:
+                return
+
+            c_ratio_y = worm_qimg.width() / worm_img.shape[1]
+            c_ratio_x = worm_qimg.height() / worm_img.shape[0]
+
+            skel_id = int(row_data['skeleton_id'])
+            skel_dat = {}
+
+
+            for tt, ff in self.coordinates_fields.items():
+                field = self.coordinates_group + ff
+                if field in self.skel_file_id:
+                    dat = self.skel_file_id.get_node(field)[skel_id]
+                    dat /= self.microns_per_pixel
                 
-                if self.stage_position_pix is not None and self.stage_position_pix.size > 0:
-                    #subtract stage motion if necessary
-                    dat -= self.stage_position_pix[self.frame_number]
+                    if self.stage_position_pix is not None and self.stage_position_pix.size > 0:
+                        #subtract stage motion if necessary
+                        dat -= self.stage_position_pix[self.frame_number]
                 
-                dat[:, 0] = (dat[:, 0] - roi_corner[0] + 0.5) * c_ratio_x
-                dat[:, 1] = (dat[:, 1] - roi_corner[1] + 0.5) * c_ratio_y
+                    dat[:, 0] = (dat[:, 0] - roi_corner[0] + 0.5) * c_ratio_x
+                    dat[:, 1] = (dat[:, 1] - roi_corner[1] + 0.5) * c_ratio_y
 
-            else:
-                dat = np.full((1,2), np.nan)
+                else:
+                    dat = np.full((1,2), np.nan)
 
-            skel_dat[tt] = dat
+                skel_dat[tt] = dat
 
-        if 'is_good_skel' in row_data and row_data['is_good_skel'] == 0:
-            skel_colors = BAD_SKEL_COLOURS
-        else:
-            skel_colors = GOOD_SKEL_COLOURS
+            if 'is_good_skel' in row_data and row_data['is_good_skel'] == 0:
+                skel_colors = BAD_SKEL_COLOURS
+            else:
+                skel_colors = GOOD_SKEL_COLOURS
 
-        self._drawSkel(worm_qimg, skel_dat, skel_colors = skel_colors)
+            self._drawSkel(worm_qimg, skel_dat, skel_colors = skel_colors)
 
 
     def _drawSkel(self, worm_qimg, skel_dat, skel_colors = GOOD_SKEL_COLOURS):
@@ -1,3 +1,4 @@
 from .misc import *
 from .time_counter import *
-from .file_processing import *
\ No newline at end of file
+from .file_processing import *
+from .parallel import *
\ No newline at end of file
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers to overlap IO and processing using threads.
+
+Most of the heavy lifting in tierpsy (ffmpeg/opencv decoding, opencv image
+processing, zlib compression in pytables) releases the GIL, so threads are
+enough to use several cores without paying the cost of pickling large image
+buffers between processes.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Event, RLock
+from queue import Queue, Full
+
+#The HDF5 library used by pytables is not thread safe. Any thread that uses it while other threads of 
+#the same process can be doing the same (e.g. the GUI viewers and their frames reader, or the summarizer) 
+#must hold this lock. It is reentrant, so nested functions can take it again.
+HDF5_LOCK = RLock()
+
+def _put_until_stopped(queue, item, is_stopped, timeout=0.1):
+    #block until the item is added to the queue or the consumer has stopped
+    while not is_stopped.is_set():
+        try:
+            queue.put(item, timeout=timeout)
+            return True
+        except Full:
+            continue
+    return False
+
+def iter_prefetch(iterable, max_size=1):
+    '''
+    Iterate over `iterable` in a background thread, keeping up to `max_size`
+    items ready in a bounded queue. Exceptions raised by the iterable are
+    re-raised in the consumer thread.
+    '''
+    queue = Queue(maxsize=max_size)
+    is_stopped = Event()
+
+    def _target_fun():
+        try:
+            for item in iterable:
+                if not _put_until_stopped(queue, (True, item), is_stopped):
+                    return
+        except Exception as e:
+            _put_until_stopped(queue, (False, e), is_stopped)
+        else:
+            _put_until_stopped(queue, (False, None), is_stopped)
+
+    thread = Thread(target=_target_fun, daemon=True)
+    thread.start()
+    try:
+        while True:
+            is_valid, item = queue.get()
+            if not is_valid:
+                if item is not None:
+                    raise item
+                break
+            yield item
+    finally:
+        is_stopped.set()
+        thread.join()
+
+def imap_ordered(func, iterable, n_workers, max_pending=None):
+    '''
+    Equivalent to map(func, iterable) but func is executed by a pool of
+    `n_workers` threads. The results are yielded in the same order as the input,
+    and at most `max_pending` items are processed or waiting to be consumed at
+    any given time, so the memory used is bounded.
+    '''
+    if n_workers <= 1:
+        yield from map(func, iterable)
+        return
+
+    if max_pending is None:
+        max_pending = 2*n_workers
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+def imap_ordered_pool(pool, func, iterable, max_pending):
+    '''
+    Similar to multiprocessing.Pool.imap, but at most `max_pending` items are 
+    sent to the pool before their results are consumed, so the memory used by 
+    the items and results waiting in the queues is bounded. 
+    The next item is only requested to `iterable` after the oldest result was 
+    yielded, so the producer can safely reuse the memory of consumed items.
+    '''
+    pending = deque()
+    iterator = iter(iterable)
+    while True:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        pending.append(pool.apply_async(func, (item,)))
+
+    while pending:
+        yield pending.popleft().get()
@@ -74,3 +74,21 @@ valid_analysis_types = list(sorted(dflt_analysis_points.keys()))
 
 
 
+
+'''
+Approximated resources used by each analysis point as (number of cores, memory in GB).
+They are used to decide how many files can be processed simultaneously given the
+max_cores and max_memory limits. The points that are not in the dictionary use DEFAULT.
+If the number of cores is 'n_cores_used' it is read from the corresponding tracker parameter.
+'''
+dflt_checkpoints_cost = {
+    'DEFAULT' : (1, 0.5),
+    'COMPRESS' : ('n_cores_used', 1.),
+    'TRAJ_CREATE' : ('n_cores_used', 1.),
+    'SKE_CREATE' : ('n_cores_used', 1.),
+    'BLOB_FEATS' : ('n_cores_used', 1.),
+    'INT_PROFILE' : (1, 1.),
+    'FEAT_CREATE' : (1, 2.),
+    'FEAT_MANUAL_CREATE' : (1, 2.),
+    'FEAT_TIERPSY' : ('n_cores_used', 1.5),
+    }
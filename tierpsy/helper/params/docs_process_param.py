@@ -54,6 +54,22 @@ dflt_args_list = [
         _max_num_process,
         'Maximum number of files to be processed simultaneously.'
         ),
+    ('max_cores',
+        mp.cpu_count(),
+        '''
+        Maximum number of cores used by the files processed simultaneously. 
+        The number of cores required by each file is estimated from its analysis points 
+        (some steps use n_cores_used). Set to 0 to ignore this limit.
+        '''
+        ),
+    ('max_memory',
+        0.,
+        '''
+        Maximum memory (GB) used by the files processed simultaneously. 
+        The memory required by each file is a rough estimate from its analysis points. 
+        Set to 0 to ignore this limit.
+        '''
+        ),
 
     ('pattern_include',
         '*.hdf5',
@@ -95,7 +111,7 @@ dflt_args_list = [
         ),
     ('refresh_time',
         10.,
-        'Refresh time in seconds of the progress screen.'
+        'Refresh time in seconds of the progress screen. New tasks are started as soon as a previous task finishes regardless of this value.'
         ),
     
     ('is_debug',
@@ -165,6 +165,14 @@ dflt_param_list = [
         'Max gap in frames allowed between joined trajectories.'
         ),
 
+    ('traj_n_threads',
+        1,
+        '''
+        Number of threads used by TRAJ_CREATE to process in parallel the regions of interest of each buffer.
+        Useful for plates with many worms per field of view. It can be combined with n_cores_used.
+        '''
+        ),
+
     ('traj_area_ratio_lim', 
         2, 
         'Area ratio between blob areas in different frames to be considered part of the same trajectory.'
@@ -283,6 +291,15 @@ dflt_param_list = [
         90, 
         'Time in SECONDS that a worm trajectory will be subdivided to calculate the splitted features.'
         ),
+    ('feat_openworm_names', 
+        '', 
+        '''
+        Comma separated list of the OpenWorm features calculated by FEAT_CREATE and FEAT_MANUAL_CREATE 
+        (e.g. "length,midbody_speed_forward"). Either the name of a feature or of any of its subdivisions can be used. 
+        The rest of the features are saved as NaN. Only OpenWorm feature names are valid, the Tierpsy feature sets 
+        (e.g. tierpsy_16) cannot be used here. Leave it empty to calculate all the features.
+        '''
+        ),
 
     ('ventral_side', 
         '', 
@@ -310,7 +327,7 @@ dflt_param_list = [
         1, 
         '''
         EXPERIMENTAL. Number of core used. 
-        Currently it is only suported by TRAJ_CREATE and it is only recommended at high particle densities.
+        Currently it is only suported by COMPRESS, TRAJ_CREATE, SKE_CREATE and FEAT_TIERPSY. In TRAJ_CREATE it is only recommended at high particle densities.
         '''),
 
     ('use_nn_filter', 
@@ -12,7 +12,7 @@ from functools import partial
 from tierpsy.helper.misc import TimeCounter
 from tierpsy.processing.AnalysisPoints import AnalysisPoints, init_analysis_point_lock
 from tierpsy.processing.ProcessLocal import BATCH_SCRIPT_LOCAL
-from tierpsy.processing.helper import create_script
+from tierpsy.processing.helper import create_script, get_checkpoints_cost
 from tierpsy.processing.run_multi_cmd import print_cmd_list
 
 
@@ -220,6 +220,16 @@ class CheckFilesForProcessing(object):
         B = map(self.generateIndCMD, self.filtered_files['FINISHED_BAD'])
         return list(B) + list(A)
 
+    def getCMDcosts(self):
+        #estimated (n_cores, memory) of each command, in the same order as getCMDlist
+        def _get_cost(input_d):
+            ap_obj, unfinished_points = input_d
+            return get_checkpoints_cost(unfinished_points, ap_obj.param)
+        
+        A = map(_get_cost, self.filtered_files['SOURCE_GOOD'])
+        B = map(_get_cost, self.filtered_files['FINISHED_BAD'])
+        return list(B) + list(A)
+
     def generateIndCMD(self, input_d):
         good_ap_obj, unfinished_points = input_d
 
@@ -10,6 +10,7 @@ import sys
 import fnmatch
 from tierpsy.helper.misc import RESERVED_EXT, IMG_EXT, replace_subdir
 from tierpsy.helper.params.tracker_param import valid_options
+from tierpsy.helper.params.docs_analysis_points import dflt_checkpoints_cost
 
 
 def filter_img_directories(fnames):
@@ -126,6 +127,20 @@ def get_masks_dir(videos_dir):
     else:
         return replace_subdir(videos_dir, 'RawVideos', 'MaskedVideos')
 
+def get_checkpoints_cost(checkpoints, param):
+    '''
+    Estimate the number of cores and the memory (GB) required to process a sequence of checkpoints.
+    The checkpoints are executed one after the other so the cost is the maximum of each of them.
+    '''
+    n_cores, memory = 1, 0.
+    for point in checkpoints:
+        point_cores, point_memory = dflt_checkpoints_cost.get(point, dflt_checkpoints_cost['DEFAULT'])
+        if point_cores == 'n_cores_used':
+            point_cores = param.p_dict['n_cores_used']
+        n_cores = max(n_cores, point_cores)
+        memory = max(memory, point_memory)
+    return n_cores, memory
+
 #%%
 
 if __name__ == '__main__':
@@ -57,7 +57,9 @@ def processMultipleFilesFun(
         analysis_checkpoints=[],
         unmet_requirements = False,
         copy_unfinished = False,
-        is_debug = True
+        is_debug = True,
+        max_cores = 0,
+        max_memory = 0
         ):
 
     assert video_dir_root or mask_dir_root
@@ -126,7 +128,10 @@ def processMultipleFilesFun(
             local_obj = ProcessLocalParser,
             max_num_process = max_num_process,
             refresh_time = refresh_time,
-            is_debug = is_debug)
+            is_debug = is_debug,
+            cmd_costs = files_checker.getCMDcosts(),
+            max_cores = max_cores,
+            max_memory = max_memory)
 
 def tierpsy_process():
     args = ProcessMultipleFilesParser().parse_args()
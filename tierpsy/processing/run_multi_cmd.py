@@ -13,7 +13,9 @@ import time
 import subprocess as sp
 from functools import partial
 from io import StringIO
-from tierpsy.helper.misc import TimeCounter, ReadEnqueue
+from threading import Thread
+from queue import Queue, Empty
+from tierpsy.helper.misc import TimeCounter
 
 GUI_CLEAR_SIGNAL = '+++++++++++++++++++++++++++++++++++++++++++++++++'
 
@@ -33,9 +35,16 @@ ON_POSIX = 'posix' in sys.builtin_module_names
 
 
 
+def _h_enqueue_output(task, pipe, events_queue):
+    #send each line of the process output to the scheduler. A None line indicates 
+    #that the output was closed, meaning that the process has finished.
+    for line in iter(pipe.readline, b''):
+        events_queue.put((task, line))
+    events_queue.put((task, None))
+
 class StartProcess():
 
-    def __init__(self, cmd, local_obj='', is_debug = True):
+    def __init__(self, cmd, local_obj='', is_debug = True, events_queue = None):
         self.is_debug = is_debug
         self.output = ['Started\n']
 
@@ -61,18 +70,18 @@ class StartProcess():
         self.proc = sp.Popen(self.cmd, stdout=sp.PIPE, stderr=sp.PIPE,
                              bufsize=1, close_fds=ON_POSIX,
                              env=dict(os.environ.copy(),OMP_NUM_THREADS='1'))
-        self.buf_reader = ReadEnqueue(self.proc.stdout)
         
-    def read_buff(self):
-        while True:
-            # read line without blocking
-            line = self.buf_reader.read()
-            if line is not None:
-                self.output.append(line)
-            else:
-                break
+        if events_queue is None:
+            events_queue = Queue()
+        self.events_queue = events_queue
+        self.reader_thread = Thread(target = _h_enqueue_output, 
+                                    args = (self, self.proc.stdout, self.events_queue),
+                                    daemon = True)
+        self.reader_thread.start()
+        
+    def add_output(self, line):
         # store only the last line
-        self.output = self.output[-1:]
+        self.output = [line.decode("utf-8")]
 
     def close(self):
         if self.proc.poll() != 0:
@@ -96,6 +105,7 @@ class StartProcess():
             self.output += output
 
         self.proc.wait()
+        self.reader_thread.join()
         self.proc.stdout.close()
         self.proc.stderr.close()
 
@@ -104,87 +114,122 @@ def RunMultiCMD(cmd_list,
                 local_obj='', 
                 max_num_process=3, 
                 refresh_time=10,
-                is_debug = True):
-    '''Start different process using the command is cmd_list'''
+                is_debug = True,
+                cmd_costs = None,
+                max_cores = 0,
+                max_memory = 0):
+    '''
+    Start different process using the command is cmd_list. 
+    The scheduler waits for the output of the processes, so a new task is started as 
+    soon as a previous one finishes. The progress screen is only refreshed every 
+    refresh_time seconds.
     
-
-    start_obj = partial(StartProcess, local_obj=local_obj, is_debug=is_debug)
+    cmd_costs is an optional list with the (n_cores, memory) required by each command. 
+    If it is given, a task is only started if the running tasks use less than max_cores 
+    and max_memory (a value of 0 ignores the limit). If the next task in the list does 
+    not fit, the following tasks that fit are started instead. 
+    '''
+    
+    #all the processes send their output and finishing signal to this queue
+    events_queue = Queue()
+    start_obj = partial(StartProcess, 
+                        local_obj=local_obj, 
+                        is_debug=is_debug, 
+                        events_queue=events_queue)
 
     total_timer = TimeCounter() #timer to meassure the total time 
-
-    cmd_list = cmd_list[::-1]  # since I am using pop to get the next element i need to invert the list to get athe same order
-    tot_tasks = len(cmd_list)
-    if tot_tasks < max_num_process:
-        max_num_process = tot_tasks
-
-    # initialize the first max_number_process in the list
-    finished_tasks = []
     
+    if cmd_costs is None:
+        cmd_costs = [(1, 0)]*len(cmd_list)
+    assert len(cmd_costs) == len(cmd_list)
+    
+    pending_tasks = list(zip(cmd_list, cmd_costs))
+    
+    finished_tasks = []
     current_tasks = []
-    for ii in range(max_num_process):
-        cmd = cmd_list.pop()
-        current_tasks.append(start_obj(cmd))
-
-    # keep loop tasks as long as there are tasks in the list
-    while current_tasks:
-        time.sleep(refresh_time)
-
+    used_resources = {}
+    
+    def _is_fitting(cost):
+        if not current_tasks:
+            #always allow one task, otherwise a task larger than the limits would never run
+            return True
+        
+        n_cores, memory = cost
+        if max_cores > 0 and sum(x[0] for x in used_resources.values()) + n_cores > max_cores:
+            return False
+        if max_memory > 0 and sum(x[1] for x in used_resources.values()) + memory > max_memory:
+            return False
+        return True
+    
+    def _start_tasks():
+        # add new tasks while there is still space
+        ii = 0
+        while ii < len(pending_tasks) and len(current_tasks) < max_num_process:
+            cmd, cost = pending_tasks[ii]
+            if not _is_fitting(cost):
+                ii += 1
+                continue
+            
+            pending_tasks.pop(ii)
+            task = start_obj(cmd)
+            current_tasks.append(task)
+            used_resources[task] = cost
+    
+    def _display_progress():
         print(GUI_CLEAR_SIGNAL)
         os.system(['clear', 'cls'][os.name == 'nt'])
 
         # print info of the finished tasks
         for task_finish_msg in finished_tasks:
             sys.stdout.write(task_finish_msg)
-
-        # loop along the process list to update output and see if there is any
-        # task finished
-        next_tasks = []
-        
-        #I want to close the tasks after starting the next the tasks. It has de disadvantage of 
-        #requiring more disk space, (required files for the new task + the finished files)
-        #but at least it should start a new tasks while it is copying the old results.
-        tasks_to_close = [] 
         
+        # print the last output of the running tasks
         for task in current_tasks:
-            task.read_buff()
-            if task.proc.poll() is None:
-                # add task to the new list if it hasn't complete
-                next_tasks.append(task)
-                sys.stdout.write(task.output[-1])
-            else:
-                # close the task and add its las output to the finished_tasks
-                # list
-                tasks_to_close.append(task)
-                # add new task once the previous one was finished
-                if cmd_list and len(next_tasks) < max_num_process:
-                    cmd = cmd_list.pop()
-                    next_tasks.append(start_obj(cmd))
-
-        # if there is stlll space add a new tasks.
-        while cmd_list and len(next_tasks) < max_num_process:
-            cmd = cmd_list.pop()
-            next_tasks.append(start_obj(cmd))
-
-
-        #close tasks (copy finished files to final destination)
-        for task in tasks_to_close:
-            task.close()
             sys.stdout.write(task.output[-1])
-            finished_tasks.append(task.output[-1])
-                
-        #start the new loop
-        current_tasks = next_tasks
-
-
-        #display progress
+        
         n_finished = len(finished_tasks)
-        n_remaining = len(current_tasks) + len(cmd_list)
+        n_remaining = len(current_tasks) + len(pending_tasks)
         progress_str = 'Tasks: {} finished, {} remaining. Total_time {}.'.format(
             n_finished, n_remaining, total_timer.get_time_str())
         
         print('*************************************************')
         print(progress_str)
         print('*************************************************')
+    
+    # initialize the first max_number_process in the list
+    _start_tasks()
+    
+    last_display = time.time()
+    # keep loop tasks as long as there are tasks in the list
+    while current_tasks:
+        time_to_display = refresh_time - (time.time() - last_display)
+        try:
+            task, line = events_queue.get(timeout = max(time_to_display, 0))
+        except Empty:
+            task = None
+        
+        if task is not None:
+            if line is not None:
+                task.add_output(line)
+            else:
+                # the output of the task was closed. Wait for the process to finish.
+                task.proc.wait()
+                current_tasks.remove(task)
+                del used_resources[task]
+                
+                #I want to close the tasks after starting the next the tasks. It has de disadvantage of 
+                #requiring more disk space, (required files for the new task + the finished files)
+                #but at least it should start a new tasks while it is copying the old results.
+                _start_tasks()
+                
+                #close tasks (copy finished files to final destination)
+                task.close()
+                finished_tasks.append(task.output[-1])
+        
+        #the display is refreshed independently of the scheduling
+        if time.time() - last_display >= refresh_time or not current_tasks:
+            _display_progress()
+            last_display = time.time()
 
     #if i don't add this the GUI could terminate before displaying the last text.
     sys.stdout.flush()
@@ -7,14 +7,16 @@ from functools import partial
 import os
 import glob
 import datetime
+import hashlib
+import pickle
 import tables
 import pandas as pd
 import multiprocessing as mp
 
-from tierpsy.helper.misc import TimeCounter, print_flush
+from tierpsy.helper.misc import TimeCounter, print_flush, HDF5_LOCK
 from tierpsy.summary.process_ow import ow_plate_summary, ow_trajectories_summary, ow_plate_summary_augmented
 from tierpsy.summary.process_tierpsy import tierpsy_plate_summary, tierpsy_trajectories_summary, tierpsy_plate_summary_augmented
-from tierpsy import AUX_FILES_DIR
+from tierpsy import AUX_FILES_DIR, __version__
 
 feature_files_ext = {'openworm' : ('_features.hdf5', '_feat_manual.hdf5'), 
                      'tierpsy' : ('_featuresN.hdf5', '_featuresN.hdf5')
@@ -32,22 +34,26 @@ time_windows_format_explain = 'Each time window must be defined by the start tim
 
 feat_df_id_cols = ['file_id','well_name']
 
+#subdirectory of root_dir where the summaries of each file are cached
+summaries_cache_dir = '.summaries_cache'
+
 def check_in_list(x, list_of_x, x_name):
     if not x in list_of_x:
         raise ValueError('{} invalid {}. Valid options {}.'.format(x, x_name, list_of_x))
     
 
-def get_summary_func(feature_type, summary_type, time_windows_ints, time_units, is_manual_index, **fold_args):
+def get_summary_func(feature_type, summary_type, time_windows_ints, time_units, is_manual_index, selected_feat = None, **fold_args):
     """
-    Chooses the function used for the extraction of feature summaries based on the input from the GUI
+    Chooses the function used for the extraction of feature summaries based on the input from the GUI.
+    If selected_feat is given, the tierpsy summaries only read the data needed to calculate those features.
     """
     if feature_type == 'tierpsy': 
         if summary_type == 'plate':
-            func = partial(tierpsy_plate_summary, time_windows=time_windows_ints, time_units=time_units, is_manual_index=is_manual_index)
+            func = partial(tierpsy_plate_summary, time_windows=time_windows_ints, time_units=time_units, is_manual_index=is_manual_index, selected_feat=selected_feat)
         elif summary_type == 'trajectory':
-            func = partial(tierpsy_trajectories_summary, time_windows=time_windows_ints, time_units=time_units, is_manual_index=is_manual_index)
+            func = partial(tierpsy_trajectories_summary, time_windows=time_windows_ints, time_units=time_units, is_manual_index=is_manual_index, selected_feat=selected_feat)
         elif summary_type == 'plate_augmented':
-            func = partial(tierpsy_plate_summary_augmented, time_windows=time_windows_ints, time_units=time_units, is_manual_index=is_manual_index, **fold_args)
+            func = partial(tierpsy_plate_summary_augmented, time_windows=time_windows_ints, time_units=time_units, is_manual_index=is_manual_index, selected_feat=selected_feat, **fold_args)
         
     elif feature_type == 'openworm':
         if summary_type == 'plate':
@@ -159,14 +165,50 @@ def select_features(win_summaries,keywords_in,keywords_ex,selected_feat):
     return win_summaries
     
 
-def process_helper(dat_in, summary_func, time_windows_ints, time_units):
+def get_cache_file(cache_dir, fname, summary_key):
+    """
+    Path of the file where the summaries of fname are cached. The name depends on the file path, 
+    modification time and size, and on the parameters used to calculate the summaries (summary_key), 
+    so a modified file or a change of parameters never matches old results.
+    """
+    fname = os.path.realpath(fname)
+    fstat = os.stat(fname)
+    key = repr((fname, fstat.st_mtime_ns, fstat.st_size, summary_key))
+    return os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+def read_cache_file(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as fid:
+            return pickle.load(fid)
+    except Exception:
+        #corrupted or incompatible file, the summaries will be recalculated
+        return None
+
+def save_cache_file(cache_file, df_list):
+    if cache_file is None:
+        return
+    #write a temporary file first so an interrupted run does not leave a corrupted file
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as fid:
+            pickle.dump(df_list, fid, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        print_flush('Warning: the summaries could not be saved into the cache file \'{}\'.'.format(cache_file))
+
+def process_helper(dat_in, summary_func):
     ifile, row = dat_in
     fname = row['file_name']
     try:
-        df_list = summary_func(fname, time_windows_ints, time_units)
+        #the time windows are already set in summary_func by get_summary_func. 
+        #The summarizer GUI runs this in a thread, so the files are read holding the HDF5 lock shared with the viewers.
+        with HDF5_LOCK:
+            df_list = summary_func(fname)
     except (AttributeError, IOError, KeyError, tables.exceptions.HDF5ExtError, tables.exceptions.NoSuchNodeError):
-        
-        df_list = []
+        #return None so the failed file is not cached
+        df_list = None
     return ifile, df_list
 
 def calculate_summaries(root_dir, 
@@ -175,7 +217,11 @@ def calculate_summaries(root_dir,
                         is_manual_index, 
                         time_windows, 
                         time_units, 
+                        select_feat = 'all', 
+                        keywords_include = '', 
+                        keywords_exclude = '', 
                         n_processes = 1,
+                        use_cache = True,
                         _is_debug = False, 
                         **fold_args
                         ):
@@ -183,6 +229,8 @@ def calculate_summaries(root_dir,
     """
     Gets input from the GUI, calls the function that chooses the type of summary 
     and runs the summary calculation for each file in the root_dir.
+    If use_cache is True, the summaries of each file are saved in root_dir/.summaries_cache, 
+    and only the new or modified files are processed when the same summaries are requested again.
     """
     save_base_name = 'summary_{}_{}'.format(feature_type, summary_type)
     if is_manual_index:
@@ -206,7 +254,7 @@ def calculate_summaries(root_dir,
     
     #get summary function
     # INPUT time windows time units here
-    summary_func = get_summary_func(feature_type, summary_type, time_windows_ints, time_units, is_manual_index, **fold_args)
+    summary_func = get_summary_func(feature_type, summary_type, time_windows_ints, time_units, is_manual_index, selected_feat, **fold_args)
     
     #get extension of results file
     possible_ext = feature_files_ext[feature_type]
@@ -230,40 +278,74 @@ def calculate_summaries(root_dir,
     _displayProgress(-1)
     
 
-    # EM :Make all_summaries list with one element per time window. Each element contains 
-    # the extracted feature summaries from all the files for the given time window.
-
-    all_summaries = [[] for x in range(len(time_windows_ints))]
-    
-    #i need to use partial and redifine this otherwise multiprocessing since it will not be pickable
-    _process_row = partial(process_helper, 
-            summary_func=summary_func, 
-            time_windows_ints=time_windows_ints, 
-            time_units=time_units)
-    
-    
-    data2process = [x for x in df_files[0].iterrows()]
+    #only the parameters that change the summaries of a file are used as key of the cache
+    summary_key = (__version__, pd.__version__, feature_type, summary_type, is_manual_index, 
+                   time_windows_ints, time_units)
+    if summary_type == 'plate_augmented':
+        summary_key += tuple(sorted(fold_args.items()))
+    if feature_type == 'tierpsy' and selected_feat is not None:
+        #only the data needed by the selected features is read
+        summary_key += tuple(selected_feat)
+    
+    cache_dir = None
+    if use_cache:
+        cache_dir = os.path.join(root_dir, summaries_cache_dir)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            print_flush('Warning: the cache directory \'{}\' could not be created.'.format(cache_dir))
+            cache_dir = None
+    
+    #read the summaries of the files found in the cache and process the rest
+    files_summaries = {}
+    cache_files = {}
+    data2process = []
+    for ifile, row in df_files[0].iterrows():
+        if cache_dir is not None:
+            cache_files[ifile] = get_cache_file(cache_dir, row['file_name'], summary_key)
+        
+        df_list = read_cache_file(cache_files.get(ifile, None))
+        if df_list is None:
+            data2process.append((ifile, row))
+        else:
+            files_summaries[ifile] = df_list
     
+    if len(files_summaries) > 0:
+        print_flush('The summaries of {} of {} files were found in the cache.'.format(len(files_summaries), len(df_files[0])))
     
+    #i need to use partial and redifine this otherwise multiprocessing since it will not be pickable
+    _process_row = partial(process_helper, summary_func=summary_func)
     
     n_processes = max(n_processes, 1)
     if n_processes <= 1:
+        p = None
         gen = map(_process_row, data2process)
     else:
         p = mp.Pool(n_processes)
         gen = p.imap(_process_row, data2process)
 
-
     for ii, (ifile, df_list) in enumerate(gen):
+        if df_list is None:
+            df_list = []
+        else:
+            save_cache_file(cache_files.get(ifile, None), df_list)
+        files_summaries[ifile] = df_list
+        _displayProgress(len(files_summaries) - 1)
+    
+    if p is not None:
+        p.close()
+        p.join()
+    
+    # EM :Make all_summaries list with one element per time window. Each element contains 
+    # the extracted feature summaries from all the files for the given time window.
+    all_summaries = [[] for x in range(len(time_windows_ints))]
+    for ifile in sorted(files_summaries.keys()):
         #reformat the outputs and remove any failed
-        for iwin, df in enumerate(df_list):
+        for iwin, df in enumerate(files_summaries[ifile]):
             df.insert(0, 'file_id', ifile)             
             all_summaries[iwin].append(df)
             if not df.empty:
                 df_files[iwin].loc[ifile, 'is_good'] = True
-        _displayProgress(ii + 1)
-        
-
     
     # EM : Concatenate summaries for each window into one dataframe and select features
     for iwin in range(len(time_windows_ints)):
@@ -5,22 +5,25 @@ Created on Mon Jun  4 10:30:17 2018
 
 @author: avelinojaver
 """
-from tierpsy.features.tierpsy_features.summary_stats import get_summary_stats
+from tierpsy.features.tierpsy_features.summary_stats import get_summary_stats, blob_feats_columns
+from tierpsy.features.tierpsy_features.features import timeseries_feats_columns
 from tierpsy.summary.helper import augment_data, add_trajectory_info
 from tierpsy.helper.params import read_fps
 from tierpsy.helper.misc import WLAB,print_flush
 from tierpsy.analysis.split_fov.helper import was_fov_split
 
+import numpy as np
 import pandas as pd
+import tables
 import pdb
 
 #%%
-def time_to_frame_nb(time_windows,time_units,fps,timestamp,fname):
+def time_to_frame_nb(time_windows,time_units,fps,last_frame,fname):
     """
     Converts the time windows to units of frame numbers (if they were defined in seconds).
     It also defines the end frame of a window, if the index is set to -1 (end).
     """
-    if timestamp.empty:
+    if last_frame is None:
         return
     
     from copy import deepcopy
@@ -32,7 +35,6 @@ def time_to_frame_nb(time_windows,time_units,fps,timestamp,fname):
                 if time_windows_frames[iwin][ilim]!=-1:
                     time_windows_frames[iwin][ilim] = round(time_windows_frames[iwin][ilim]*fps)
     
-    last_frame = timestamp.sort_values().iloc[-1]
     for iwin in range(len(time_windows_frames)): 
         # If a window ends with -1, replace with the frame number of the last frame (or the start frame of the window+1 if window out of bounds)
         if time_windows_frames[iwin][1]==-1:
@@ -56,9 +58,57 @@ def no_fps(time_units,fps):
     else:
         return False
 #%%
-def read_data(fname, time_windows, time_units, fps, is_manual_index):
+def _h_get_name_prefixes(feat_names):
+    """
+    All the prefixes of the given summary names that end before a '_', including the full names.
+    """
+    prefixes = set()
+    for feat in feat_names:
+        parts = feat.split('_')
+        prefixes.update('_'.join(parts[:ii]) for ii in range(1, len(parts) + 1))
+    return prefixes
+
+def _h_get_cols2read(colnames, feat_prefixes, is_blob = False):
+    """
+    Columns of /timeseries_data or /blob_features required to calculate the summaries that 
+    start with any of feat_prefixes (all the columns if feat_prefixes is None). Only the feature columns 
+    are filtered. The rest (indexes, coordinates, events, length...) are used by several summaries.
+    """
+    if feat_prefixes is None:
+        return list(colnames)
+    
+    cols2read = []
+    for col in colnames:
+        if is_blob:
+            feat = col if col.startswith('blob_') else 'blob_' + col
+            is_feat = feat in blob_feats_columns
+        else:
+            feat = col
+            is_feat = (col in timeseries_feats_columns) and (col != 'length')
+        
+        #the summaries of a feature start with its name or with the name of its derivative
+        if not is_feat or (feat in feat_prefixes) or ('d_' + feat in feat_prefixes):
+            cols2read.append(col)
+    return cols2read
+
+def _h_table2df(data, columns):
+    """
+    Converts the rows read from a pytables table into a dataframe with the same format 
+    as the one returned by pd.HDFStore (strings are decoded).
+    """
+    df = {}
+    for col in columns:
+        if data.dtype[col].kind == 'S':
+            df[col] = np.char.decode(data[col], 'utf-8').astype(object)
+        else:
+            df[col] = data[col]
+    return pd.DataFrame(df, columns = columns)
+
+def read_data(fname, time_windows, time_units, fps, is_manual_index, selected_feat = None):
     """
     Reads the timeseries_data and the blob_features for a given file within every time window.
+    If selected_feat is given, only the columns needed to calculate those summaries are read.
+    If the timestamp is indexed (CSI), only the rows in each time window are read.
     return:
         timeseries_data_list: list of timeseries_data for each time window (length of lists = number of windows)
         blob_features_list: list of blob_features for each time window (length of lists = number of windows)
@@ -67,53 +117,87 @@ def read_data(fname, time_windows, time_units, fps, is_manual_index):
     #     Make this check here, to avoid wasting time reading the file 
     if no_fps(time_units,fps):
         return
-            
-    with pd.HDFStore(fname, 'r') as fid:        
-        timeseries_data = fid['/timeseries_data']
-        blob_features = fid['/blob_features']
-        if timeseries_data.empty:
+    
+    feat_prefixes = None if selected_feat is None else _h_get_name_prefixes(selected_feat)
+    
+    with tables.File(fname, 'r') as fid:
+        timeseries_tab = fid.get_node('/timeseries_data')
+        blob_tab = fid.get_node('/blob_features')
+        if timeseries_tab.nrows == 0:
             #no data, nothing to do here
             return
         
-        if is_manual_index:
-            #keep only data labeled as worm or worm clusters
-            valid_labels = [WLAB[x] for x in ['WORM', 'WORMS']]
-            trajectories_data = fid['/trajectories_data']
-            if not 'worm_index_manual' in trajectories_data:
-                #no manual index, nothing to do here
-                return
+        timeseries_cols = _h_get_cols2read(timeseries_tab.colnames, feat_prefixes)
+        blob_cols = _h_get_cols2read(blob_tab.colnames, feat_prefixes, is_blob = True)
+        
+        is_indexed = timeseries_tab.cols.timestamp.is_indexed and \
+            timeseries_tab.cols.timestamp.index.is_csi
+        
+        if is_indexed and not is_manual_index:
+            #only read the rows of each window using the index
+            last_frame = timeseries_tab.read_sorted('timestamp', field='timestamp', 
+                                                    start=timeseries_tab.nrows - 1)[0]
+            time_windows_frames = time_to_frame_nb(time_windows,time_units,fps,last_frame,fname)
             
-            good = trajectories_data['worm_label'].isin(valid_labels)
-            good = good & (trajectories_data['skeleton_id'] >= 0)
-            skel_id = trajectories_data['skeleton_id'][good]
+            timeseries_data_list = []
+            blob_features_list = []
+            for window in time_windows_frames:
+                cond = '(timestamp >= {}) & (timestamp < {})'.format(*window)
+                rows = timeseries_tab.get_where_list(cond, sort=True)
+                if rows.size == timeseries_tab.nrows:
+                    timeseries_w, blob_w = timeseries_tab.read(), blob_tab.read()
+                else:
+                    timeseries_w = timeseries_tab.read_coordinates(rows)
+                    blob_w = blob_tab.read_coordinates(rows)
+                timeseries_data_list.append(_h_table2df(timeseries_w, timeseries_cols))
+                blob_features_list.append(_h_table2df(blob_w, blob_cols))
             
-            timeseries_data = timeseries_data.loc[skel_id]
-            timeseries_data['worm_index'] = trajectories_data['worm_index_manual'][good].values
-            timeseries_data = timeseries_data.reset_index(drop=True)
+            return timeseries_data_list, blob_features_list
+        
+        timeseries_data = _h_table2df(timeseries_tab.read(), timeseries_cols)
+        blob_features = _h_table2df(blob_tab.read(), blob_cols)
             
-            blob_features = blob_features.loc[skel_id].reset_index(drop=True)
+    if is_manual_index:
+        #keep only data labeled as worm or worm clusters
+        valid_labels = [WLAB[x] for x in ['WORM', 'WORMS']]
+        with pd.HDFStore(fname, 'r') as fid:
+            trajectories_data = fid['/trajectories_data']
+        if not 'worm_index_manual' in trajectories_data:
+            #no manual index, nothing to do here
+            return
         
-        # convert time windows to frame numbers for the given file
-        time_windows_frames = time_to_frame_nb(time_windows,time_units,fps,timeseries_data['timestamp'],fname)
+        good = trajectories_data['worm_label'].isin(valid_labels)
+        good = good & (trajectories_data['skeleton_id'] >= 0)
+        skel_id = trajectories_data['skeleton_id'][good]
         
-        #extract the timeseries_data and blob_features corresponding to each 
-        #time window and store them in a list (length of lists = number of windows)
-        timeseries_data_list = []
-        blob_features_list = []
-        for window in time_windows_frames:
-            in_window = (timeseries_data['timestamp']>=window[0]) & (timeseries_data['timestamp']<window[1])
-            timeseries_data_list.append(timeseries_data.iloc[in_window.values,:].reset_index(drop=True))
-            blob_features_list.append(blob_features.iloc[in_window.values].reset_index(drop=True))
+        timeseries_data = timeseries_data.loc[skel_id]
+        timeseries_data['worm_index'] = trajectories_data['worm_index_manual'][good].values
+        timeseries_data = timeseries_data.reset_index(drop=True)
+        
+        blob_features = blob_features.loc[skel_id].reset_index(drop=True)
+    
+    # convert time windows to frame numbers for the given file
+    last_frame = timeseries_data['timestamp'].max() if not timeseries_data.empty else None
+    time_windows_frames = time_to_frame_nb(time_windows,time_units,fps,last_frame,fname)
+    
+    #extract the timeseries_data and blob_features corresponding to each 
+    #time window and store them in a list (length of lists = number of windows)
+    timeseries_data_list = []
+    blob_features_list = []
+    for window in time_windows_frames:
+        in_window = (timeseries_data['timestamp']>=window[0]) & (timeseries_data['timestamp']<window[1])
+        timeseries_data_list.append(timeseries_data.iloc[in_window.values,:].reset_index(drop=True))
+        blob_features_list.append(blob_features.iloc[in_window.values].reset_index(drop=True))
 
     return timeseries_data_list, blob_features_list
 #%%    
-def tierpsy_plate_summary(fname, time_windows, time_units, is_manual_index = False, delta_time = 1/3):
+def tierpsy_plate_summary(fname, time_windows, time_units, is_manual_index = False, delta_time = 1/3, selected_feat = None):
     """
     Calculate the plate summaries for a given file fname, within a given time window 
     (units of start time and end time are in frame numbers). 
     """
     fps = read_fps(fname)
-    data_in = read_data(fname, time_windows, time_units, fps, is_manual_index)
+    data_in = read_data(fname, time_windows, time_units, fps, is_manual_index, selected_feat)
     
     # if manual annotation was chosen and the trajectories_data does not contain 
     # worm_index_manual, then data_in is None
@@ -164,13 +248,13 @@ def tierpsy_plate_summary(fname, time_windows, time_units, is_manual_index = Fal
 
     return plate_feats_list
 
-def tierpsy_trajectories_summary(fname, time_windows, time_units, is_manual_index = False, delta_time = 1/3):
+def tierpsy_trajectories_summary(fname, time_windows, time_units, is_manual_index = False, delta_time = 1/3, selected_feat = None):
     """
     Calculate the trajectory summaries for a given file fname, within a given time window 
     (units of start time and end time are in frame numbers). 
     """
     fps = read_fps(fname)
-    data_in = read_data(fname, time_windows, time_units, fps, is_manual_index)
+    data_in = read_data(fname, time_windows, time_units, fps, is_manual_index, selected_feat)
     if data_in is None:
         return [pd.DataFrame() for iwin in range(len(time_windows))]
     timeseries_data, blob_features = data_in
@@ -206,9 +290,9 @@ def tierpsy_trajectories_summary(fname, time_windows, time_units, is_manual_inde
 
 #%%
     
-def tierpsy_plate_summary_augmented(fname, time_windows, time_units, is_manual_index = False, delta_time = 1/3, **fold_args):
+def tierpsy_plate_summary_augmented(fname, time_windows, time_units, is_manual_index = False, delta_time = 1/3, selected_feat = None, **fold_args):
     fps = read_fps(fname)
-    data_in = read_data(fname, time_windows, time_units, fps, is_manual_index)
+    data_in = read_data(fname, time_windows, time_units, fps, is_manual_index, selected_feat)
     if data_in is None:
         return [pd.DataFrame() for iwin in range(len(time_windows))]
     timeseries_data, blob_features = data_in
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the thresholds calculated in getBlobTrajectories.
+"""
+import numpy as np
+
+from tierpsy.analysis.traj_create.getBlobTrajectories import getBuffersThresh, getBufferThresh
+
+def _light_background_buffer():
+    #bright background with darker worms and some masked (zero) pixels
+    rng = np.random.RandomState(0)
+    ROI_buffer = np.where(rng.rand(3, 40, 40) < 0.2, 60, 200) + rng.randint(-10, 11, (3, 40, 40))
+    ROI_buffer[:, :5] = 0
+    return ROI_buffer.astype(np.uint8)
+
+def test_getBuffersThresh_empty_constant():
+    empty = np.zeros((2, 10, 10), np.uint8)
+    constant = np.zeros((2, 10, 10), np.uint8)
+    constant[:, 2:8] = 100
+    
+    thresh = getBuffersThresh([empty, constant], 1, True, 'WORM')
+    np.testing.assert_array_equal(thresh, [np.nan, 100])
+    
+    thresh = getBuffersThresh([empty, constant], 1, False, 'PHARYNX')
+    np.testing.assert_array_equal(thresh, [np.nan, 100])
+
+def test_getBuffersThresh_light_background():
+    ROI_buffers = [_light_background_buffer(), _light_background_buffer()[:, ::-1, 10:]]
+    thresh = getBuffersThresh(ROI_buffers, 1.05, True, 'WORM')
+    expected = [getBufferThresh(x, 1.05, True, 'WORM') for x in ROI_buffers]
+    np.testing.assert_array_equal(thresh, expected)
+    #the threshold must be between the worm and the background intensities
+    assert all(70*1.05 < x < 190*1.05 for x in thresh)
+
+def test_getBuffersThresh_fluorescence():
+    #few bright pixels in a dark background. The mean is used as threshold.
+    ROI_buffer = np.full((1, 10, 10), 10, np.uint8)
+    ROI_buffer[0, 0] = 200
+    thresh = getBuffersThresh([ROI_buffer], 1, False, 'WORM')
+    np.testing.assert_allclose(thresh, [29])
+    
+    thresh = getBuffersThresh([ROI_buffer, ROI_buffer], 1, False, 'ZEBRAFISH')
+    assert thresh == [255, 255]
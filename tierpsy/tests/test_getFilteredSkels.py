@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the possible coils filter in getFilteredSkels.
+"""
+import numpy as np
+import pandas as pd
+import tables
+
+from tierpsy.analysis.ske_filt.getFilteredSkels import filterPossibleCoils, _h_isGoodSkel, _h_isGoodSkelBlock
+
+def _straight_worm(midbody_w=10, cnt_scale=1):
+    #horizontal worm with a tapered width. The contours are scaled by cnt_scale around the skeleton.
+    s = np.linspace(0, 1, 49)
+    skeleton = np.stack((100*s, np.zeros_like(s)), axis=1)
+    contour_width = 5 + (midbody_w - 5)*np.sin(np.pi*s)**4
+    offset = np.stack((np.zeros_like(s), cnt_scale*contour_width/2), axis=1)
+    return [x.astype(np.float32) for x in (skeleton, skeleton + offset, skeleton - offset, contour_width)]
+
+def _worms_block():
+    worms = [_straight_worm(), #good
+             _straight_worm(midbody_w=20), #the midbody is too wide compared to the head and tail
+             _straight_worm(cnt_scale=0), #the contours are in the skeleton, all the areas are zero
+             _straight_worm()]
+    worms[3][0][:] = np.nan #missing skeleton
+    return [np.stack(x) for x in zip(*worms)]
+
+def test_isGoodSkelBlock():
+    block_data = _worms_block()
+    ht_limits = 8
+    is_good, is_ambiguous = _h_isGoodSkelBlock(*block_data, ht_limits, 2.25, 6)
+    np.testing.assert_array_equal(is_good[[0, 1, 3]], [True, False, False])
+    
+    #the zero areas are within the rounding error so this row must be checked by _h_isGoodSkel
+    np.testing.assert_array_equal(is_ambiguous, [False, False, True, False])
+    assert not _h_isGoodSkel(*[x[2] for x in block_data], ht_limits, 2.25, 6)
+
+def test_filterPossibleCoils(tmp_path):
+    block_data = _worms_block()
+    trajectories_data = pd.DataFrame({'skeleton_id': np.arange(4),
+                                      'worm_index_joined': 1,
+                                      'has_skeleton': np.array([1, 1, 1, 0], np.uint8)})
+    
+    skeletons_file = str(tmp_path / 'test_skeletons.hdf5')
+    with tables.File(skeletons_file, 'w') as fid:
+        fid.create_table('/', 'trajectories_data', obj=trajectories_data.to_records(index=False))
+        for field, dat in zip(['skeleton', 'contour_side1', 'contour_side2', 'contour_width'], block_data):
+            fid.create_carray('/', field, obj=dat)
+    
+    #a small block_size so the rows are processed in several blocks
+    filterPossibleCoils(skeletons_file, block_size=3)
+    is_good_skel = pd.read_hdf(skeletons_file, '/trajectories_data')['is_good_skel'].values
+    np.testing.assert_array_equal(is_good_skel, [1, 0, 0, 0])
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the worms straightening and the intensity maps writer in getIntensityProfile.
+"""
+import numpy as np
+import tables
+
+from tierpsy.analysis.int_profile.getIntensityProfile import getStraightenWormIntBatch, ChunkedRowsWriter
+
+def test_getStraightenWormIntBatch_linear():
+    #the cubic splines interpolate exactly a linear intensity gradient
+    n_rows, n_cols = 40, 60
+    yy, xx = np.mgrid[:n_rows, :n_cols]
+    worm_imgs = np.stack((2*xx + 3*yy + 1, xx - yy + 50)).astype(np.uint8)
+    
+    #horizontal skeletons, the perpendicular lines go along the y axis
+    skel_x = np.linspace(10, 45, 21)
+    skeletons = np.zeros((2, skel_x.size, 2))
+    skeletons[..., 0] = skel_x
+    skeletons[..., 1] = [[20], [15.5]]
+    half_widths = np.array([5., 2.5])
+    
+    straighten_worms = getStraightenWormIntBatch(worm_imgs, skeletons, half_widths, 11)
+    assert straighten_worms.shape == (2, 11, skel_x.size)
+    
+    r_ind = np.linspace(-1, 1, 11)[:, None]
+    grid_y = skeletons[:, None, :, 1] - half_widths[:, None, None]*r_ind
+    expected = np.stack((2*skel_x + 3*grid_y[0] + 1, skel_x - grid_y[1] + 50))
+    np.testing.assert_allclose(straighten_worms, expected, atol=1e-8)
+
+def test_ChunkedRowsWriter(tmp_path):
+    with tables.File(str(tmp_path / 'test.hdf5'), 'w') as fid:
+        dataset = fid.create_carray('/', 'data', 
+                                    atom=tables.Float32Atom(), 
+                                    shape=(8, 2), 
+                                    chunkshape=(3, 2))
+        
+        #the last frames of the chunks are 5, 3 and 4 
+        rows_frame = np.array([5, 0, 1, 2, 2, 3, 0, 4])
+        writer = ChunkedRowsWriter(dataset, rows_frame)
+        
+        expected = np.zeros((8, 2), np.float32)
+        def _add_frame(frame):
+            rows, = np.where(rows_frame == frame)
+            data = np.stack((rows, rows_frame[rows]), axis=1).astype(np.float32)
+            writer.add(rows, data)
+        
+        #the rows are added in the frames order, so they are not in the rows order 
+        for frame in range(3):
+            _add_frame(frame)
+        writer.flush(2)
+        np.testing.assert_array_equal(dataset[:], expected)
+        
+        _add_frame(3)
+        writer.flush(3)
+        expected[3:6] = [[3, 2], [4, 2], [5, 3]]
+        np.testing.assert_array_equal(dataset[:], expected)
+        
+        _add_frame(4)
+        writer.flush(4)
+        expected[6:] = [[6, 0], [7, 4]]
+        np.testing.assert_array_equal(dataset[:], expected)
+        
+        #the final flush writes the remaining chunks
+        _add_frame(5)
+        writer.flush()
+        expected[:3] = [[0, 5], [1, 0], [2, 1]]
+        np.testing.assert_array_equal(dataset[:], expected)
+        assert not writer.buffers
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the trajectories linking in joinBlobsTrajectories.
+"""
+import numpy as np
+import pandas as pd
+
+from tierpsy.analysis.traj_join.joinBlobsTrajectories import assignBlobTrajDF, joinGapsTrajectoriesDF
+
+def _blobs_df(rows):
+    #rows are (frame_number, coord_x, coord_y, area)
+    df = pd.DataFrame(rows, columns=['frame_number', 'coord_x', 'coord_y', 'area'])
+    df[['coord_x', 'coord_y', 'area']] = df[['coord_x', 'coord_y', 'area']].astype(np.float32)
+    return df
+
+def test_assignBlobTrajDF_tie():
+    #X is at the same distance of A and B, the tie is resolved by the smallest index (A).
+    #B is closer to Y, so there is no merge.
+    traj_df = _blobs_df([(0, 0, 0, 100), (0, 10, 0, 100),
+                         (1, 5, 0, 100), (1, 14, 0, 100)])
+    traj_ind = assignBlobTrajDF(traj_df, 20, (0.5, 2))
+    np.testing.assert_array_equal(traj_ind, [1, 2, 1, 2])
+
+def test_assignBlobTrajDF_merge_split():
+    #two blobs merge in the second frame and split again in the third one. 
+    #All the merged and splitted blobs start a new trajectory.
+    traj_df = _blobs_df([(0, 0, 0, 100), (0, 4, 0, 100),
+                         (1, 2, 0, 100),
+                         (2, 0, 0, 100), (2, 4, 0, 100)])
+    traj_ind = assignBlobTrajDF(traj_df, 20, (0.5, 2))
+    np.testing.assert_array_equal(traj_ind, [1, 2, 3, 4, 5])
+
+def test_assignBlobTrajDF_max_dist():
+    #a blob exactly at max_allowed_dist is linked, a blob further away is not.
+    traj_df = _blobs_df([(0, 0, 0, 100), (1, 20, 0, 100), (2, 40.5, 0, 100)])
+    traj_ind = assignBlobTrajDF(traj_df, 20, (0.5, 2))
+    np.testing.assert_array_equal(traj_ind, [1, 1, 2])
+
+def test_assignBlobTrajDF_area_ratio():
+    #the ratio 100/250 is outside the limits, 250/200 and 200/100 (the limit) are valid.
+    traj_df = _blobs_df([(0, 0, 0, 100), (1, 1, 0, 250), (2, 2, 0, 200), (3, 3, 0, 100)])
+    traj_ind = assignBlobTrajDF(traj_df, 20, (0.5, 2))
+    np.testing.assert_array_equal(traj_ind, [1, 2, 2, 2])
+
+def test_assignBlobTrajDF_row_order():
+    #the indexes are returned in the order of the rows, not of the frames.
+    traj_df = _blobs_df([(1, 20, 0, 100), (0, 0, 0, 100), (1, 1000, 0, 100)])
+    traj_ind = assignBlobTrajDF(traj_df, 20, (0.5, 2))
+    np.testing.assert_array_equal(traj_ind, [1, 1, 2])
+
+def _tracks_df(tracks):
+    #tracks are (worm_index, first_frame, last_frame, coord_x, coord_y, area). The worms do not move.
+    rows = []
+    for worm_index, ini, fin, x, y, area in tracks:
+        rows += [(worm_index, frame, x, y, area, 10.) for frame in range(ini, fin + 1)]
+    columns = ['worm_index_blob', 'frame_number', 'coord_x', 'coord_y', 'area', 'box_length']
+    df = pd.DataFrame(rows, columns=columns)
+    df[columns[2:]] = df[columns[2:]].astype(np.float32)
+    return df
+
+def _check_joined(tracks, expected):
+    plate_worms = _tracks_df(tracks)
+    worm_index_joined = joinGapsTrajectoriesDF(plate_worms, 
+                                               min_track_size=3, 
+                                               max_frames_gap=10, 
+                                               area_ratio_lim=(0.67, 1.5))
+    expected = plate_worms['worm_index_blob'].map(expected).values
+    np.testing.assert_array_equal(worm_index_joined, expected)
+
+def test_joinGapsTrajectoriesDF_gap_limit():
+    #2 starts exactly max_frames_gap after the end of 1, 3 starts one frame later than that after 2. 
+    #4 is shorter than min_track_size.
+    tracks = [(1, 0, 4, 0, 0, 100), (2, 14, 18, 0, 0, 100), (3, 29, 33, 0, 0, 100),
+              (4, 100, 101, 0, 0, 100)]
+    _check_joined(tracks, {1:1, 2:1, 3:3, 4:-1})
+
+def test_joinGapsTrajectoriesDF_distance():
+    #1 is joined with the closest trajectory (3) that is at most at box_length. 2 is too far.
+    tracks = [(1, 0, 4, 0, 0, 100), (2, 6, 10, 10.5, 0, 100), (3, 7, 11, 10, 0, 100)]
+    _check_joined(tracks, {1:1, 2:2, 3:1})
+
+def test_joinGapsTrajectoriesDF_area_ratio():
+    #the area ratio 100/150 is outside area_ratio_lim, 150/140 is valid.
+    tracks = [(1, 0, 4, 0, 0, 100), (2, 6, 10, 0, 0, 150), (3, 12, 16, 0, 0, 140)]
+    _check_joined(tracks, {1:1, 2:2, 3:2})
+
+def test_joinGapsTrajectoriesDF_ties():
+    #1 and 2 are at the same distance of the start of 3, the largest index (2) is joined.
+    _check_joined([(1, 0, 4, -5, 0, 100), (2, 0, 4, 5, 0, 100), (3, 6, 10, 0, 0, 100)], 
+                  {1:1, 2:2, 3:2})
+    #the starts of 2 and 3 are at the same distance of the end of 1, the smallest index (2) is joined.
+    _check_joined([(1, 0, 4, 0, 0, 100), (2, 6, 10, -5, 0, 100), (3, 6, 10, 5, 0, 100)], 
+                  {1:1, 2:1, 3:3})
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the openworm features statistics calculated by WormStats.
+"""
+import warnings
+
+import numpy as np
+import pytest
+
+from tierpsy.analysis.feat_create import _get_feats_param
+from tierpsy.analysis.feat_create.obtainFeaturesHelper import WormStats
+from tierpsy.helper.params.tracker_param import TrackerParams
+
+STAT_FUNCS = {'means' : np.mean, 'medians' : np.median}
+
+def _worm_features():
+    #length is a timeseries, midbody_speed a signed timeseries and worm_dwelling an event
+    return {'motion_modes' : np.array([1, 1, -1, 0]),
+            'length' : np.array([1, 2, 3, np.nan]),
+            'midbody_speed' : np.array([-2, 4, -1, 3.]),
+            'worm_dwelling' : np.array([1, 2, np.nan, 6])
+            }
+
+EXPECTED_MEANS = {
+    'length' : 2, 'length_forward' : 1.5, 'length_paused' : np.nan, 'length_backward' : 3,
+    'midbody_speed' : 1, 'midbody_speed_abs' : 2.5, 'midbody_speed_neg' : -1.5, 'midbody_speed_pos' : 3.5,
+    'midbody_speed_forward' : 1, 'midbody_speed_forward_abs' : 3, 
+    'midbody_speed_forward_neg' : -2, 'midbody_speed_forward_pos' : 4,
+    'midbody_speed_paused' : 3, 'midbody_speed_paused_abs' : 3, 
+    'midbody_speed_paused_neg' : np.nan, 'midbody_speed_paused_pos' : 3,
+    'midbody_speed_backward' : -1, 'midbody_speed_backward_abs' : 1, 
+    'midbody_speed_backward_neg' : -1, 'midbody_speed_backward_pos' : np.nan,
+    'worm_dwelling' : 3
+    }
+
+def _get_stats(wStats):
+    #the statistics of empty subdivisions are nan
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return wStats.getWormStatsMulti(_worm_features(), STAT_FUNCS)
+
+def _check_stats(feat_stats, expected):
+    for field, val in expected.items():
+        np.testing.assert_array_equal(feat_stats[field], np.float32(val), err_msg=field)
+
+def test_getWormStatsMulti():
+    worm_stats = _get_stats(WormStats())
+    assert set(worm_stats) == set(STAT_FUNCS)
+    
+    _check_stats(worm_stats['means'], EXPECTED_MEANS)
+    #the medians only differ in the event
+    _check_stats(worm_stats['medians'], {**EXPECTED_MEANS, 'worm_dwelling' : 2})
+    
+    #the features that are not given are nan
+    assert np.isnan(worm_stats['means']['head_speed'])
+
+def test_getWormStatsMulti_selected():
+    #the features are selected by their name or by the name of any of their subdivisions
+    wStats = WormStats(['length', 'midbody_speed_forward'])
+    assert wStats.feat_selected == {'length', 'midbody_speed'}
+    assert wStats.openworm_specs == ['locomotion.motion_mode', 
+                                     'morphology.length', 
+                                     'locomotion.velocity.midbody.speed']
+    
+    worm_stats = _get_stats(wStats)
+    _check_stats(worm_stats['means'], {**EXPECTED_MEANS, 'worm_dwelling' : np.nan})
+    
+    with pytest.raises(KeyError):
+        WormStats(['length_90th'])
+
+def test_get_feats_param():
+    param = TrackerParams()
+    assert _get_feats_param(param)['feat_names'] is None
+    
+    param.p_dict['feat_openworm_names'] = ' length, midbody_speed_forward,'
+    assert _get_feats_param(param)['feat_names'] == ['length', 'midbody_speed_forward']
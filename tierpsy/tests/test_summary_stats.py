@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the quantiles calculated by the tierpsy features summary_stats.
+"""
+import numpy as np
+import pandas as pd
+
+from tierpsy.features.tierpsy_features.summary_stats import get_df_quantiles
+
+def _timeseries_df(is_nan=True):
+    #0 to 10 with a missing value. The quantiles are 1, 5 and 9, and the IQR is 5. 
+    vals = np.arange(12, dtype=np.float32)
+    vals[-1] = np.nan if is_nan else 11
+    df = pd.DataFrame({'worm_index' : 1,
+                       'length' : vals,
+                       'curvature_head' : -vals,
+                       'food_region' : np.repeat([-1, 1], 6).astype(np.float32)
+                       })
+    return df
+
+def _quantiles_s(feat, q10, q50, q90, iqr):
+    return {feat + '_10th' : q10, feat + '_50th' : q50, feat + '_90th' : q90, feat + '_IQR' : iqr}
+
+def _check_quantiles(feat_stats, expected):
+    assert sorted(feat_stats.index) == sorted(expected)
+    np.testing.assert_allclose(feat_stats[list(expected)].values, list(expected.values()), rtol=1e-6)
+
+def test_get_df_quantiles():
+    #the ventral signed features (curvature_head) are changed to their absolute value
+    feat_stats = get_df_quantiles(_timeseries_df(), 
+                                  feats2check = ['length', 'curvature_head'],
+                                  subdivision_dict = {})
+    assert feat_stats.index.tolist() == ['length_10th', 'curvature_head_abs_10th', 
+                                         'length_50th', 'curvature_head_abs_50th',
+                                         'length_90th', 'curvature_head_abs_90th',
+                                         'length_IQR', 'curvature_head_abs_IQR']
+    _check_quantiles(feat_stats, {**_quantiles_s('length', 1, 5, 9, 5), 
+                                  **_quantiles_s('curvature_head_abs', 1, 5, 9, 5)})
+    
+    feat_stats = get_df_quantiles(_timeseries_df(), 
+                                  feats2check = ['length', 'curvature_head'],
+                                  subdivision_dict = {},
+                                  is_abs_ventral = False)
+    _check_quantiles(feat_stats, {**_quantiles_s('length', 1, 5, 9, 5), 
+                                  **_quantiles_s('curvature_head', -9, -5, -1, 5)})
+
+def test_get_df_quantiles_normalize():
+    #the median length is 5. Curvatures are multiplied by the length.
+    feat_stats = get_df_quantiles(_timeseries_df(), 
+                                  feats2check = ['length', 'curvature_head'],
+                                  subdivision_dict = {},
+                                  is_normalize = True)
+    _check_quantiles(feat_stats, {**_quantiles_s('length_norm', 0.2, 1, 1.8, 1), 
+                                  **_quantiles_s('curvature_head_norm_abs', 5, 25, 45, 25)})
+
+def test_get_df_quantiles_subdivision():
+    #outside the food the length goes from 0 to 5 and inside from 6 to 10. There is not data in the edge.
+    feat_stats = get_df_quantiles(_timeseries_df(), 
+                                  feats2check = ['length'],
+                                  subdivision_dict = {'food_region' : ['length']})
+    _check_quantiles(feat_stats, {**_quantiles_s('length_in_outside', 0.5, 2.5, 4.5, 2.5), 
+                                  **_quantiles_s('length_in_inside', 6.4, 8, 9.6, 2), 
+                                  **_quantiles_s('length_in_edge', np.nan, np.nan, np.nan, np.nan)})
+
+def test_get_df_quantiles_dtype():
+    #the quantiles keep the float32 type of the features, even if there are not missing values
+    for is_nan in (True, False):
+        feat_stats = get_df_quantiles(_timeseries_df(is_nan), 
+                                      feats2check = ['length'],
+                                      subdivision_dict = {})
+        assert feat_stats.dtype == np.float32
+        
+        q_90th = 9 if is_nan else 9.9
+        assert feat_stats['length_90th'] == np.float32(q_90th)
+
+def test_get_df_quantiles_empty():
+    feat_stats = get_df_quantiles(_timeseries_df().iloc[:0], 
+                                  feats2check = ['length'],
+                                  subdivision_dict = {})
+    _check_quantiles(feat_stats, _quantiles_s('length', np.nan, np.nan, np.nan, np.nan))